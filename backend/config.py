@@ -9,9 +9,82 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 # Configuración de directorios
 BASE_DIR = Path(__file__).parent
 FOTOS_DIR = os.getenv("FOTOS_DIR", str(BASE_DIR / "fotos"))
+# Índices de fotos por denuncia (fuera de FOTOS_DIR, que se sirve públicamente en /fotos)
+FOTOS_INDICE_DIR = os.getenv("FOTOS_INDICE_DIR", str(BASE_DIR / "indices_fotos"))
 
 # Configuración del servidor para URLs (usado solo cuando sea necesario)
 SERVER_HOST = os.getenv("SERVER_HOST", "localhost")
 SERVER_PORT = os.getenv("SERVER_PORT", "8000")
 SERVER_PROTOCOL = os.getenv("SERVER_PROTOCOL", "http")
 BASE_URL = f"{SERVER_PROTOCOL}://{SERVER_HOST}:{SERVER_PORT}"
+
+# Cache en memoria de /denuncias/{id}/detalles (segundos; 0 deshabilita)
+DENUNCIA_DETALLE_CACHE_TTL = int(os.getenv("DENUNCIA_DETALLE_CACHE_TTL", "30"))
+DENUNCIA_DETALLE_CACHE_MAX = int(os.getenv("DENUNCIA_DETALLE_CACHE_MAX", "256"))
+
+# Paginación keyset de listados (tamaño por defecto y máximo por página)
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "500"))
+
+# Pool de procesos para renderizar PDFs fuera del event loop
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", str(min(2, os.cpu_count() or 1))))  # 0 = hilo en el mismo proceso
+PDF_POOL_MAX_PENDING = int(os.getenv("PDF_POOL_MAX_PENDING", "8"))  # renders en curso + en cola
+PDF_RENDER_TIMEOUT = float(os.getenv("PDF_RENDER_TIMEOUT", "120"))  # segundos
+PDF_TEMPLATE_CACHE_DIR = os.getenv("PDF_TEMPLATE_CACHE_DIR", str(BASE_DIR / "cache" / "jinja"))
+# Reportes grandes: evidencias por parte al renderizar por lotes (0 = siempre en un solo documento)
+PDF_CHUNK_EVIDENCIAS = int(os.getenv("PDF_CHUNK_EVIDENCIAS", "60"))
+
+# Cache en disco de artefactos exportados (PDF/KMZ), con expulsión LRU por tamaño total
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", str(BASE_DIR / "cache" / "exports"))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Exportación KMZ: hilos de lectura de fotos y bloques del stream de respuesta
+KMZ_PHOTO_READ_WORKERS = int(os.getenv("KMZ_PHOTO_READ_WORKERS", "4"))
+KMZ_STREAM_CHUNK_BYTES = int(os.getenv("KMZ_STREAM_CHUNK_BYTES", str(64 * 1024)))
+KMZ_STREAM_MAX_CHUNKS = int(os.getenv("KMZ_STREAM_MAX_CHUNKS", "16"))  # bloques en espera antes de frenar al productor
+
+# Exportación masiva de análisis (ZIP): exportaciones simultáneas y máximo de análisis por solicitud
+BULK_EXPORT_CONCURRENCY = int(os.getenv("BULK_EXPORT_CONCURRENCY", "4"))
+BULK_EXPORT_MAX_ANALISIS = int(os.getenv("BULK_EXPORT_MAX_ANALISIS", "500"))
+
+# Exportación KML regionada (super-overlay) de concesiones y denuncias
+KML_REGION_MAX_FEATURES = int(os.getenv("KML_REGION_MAX_FEATURES", "200"))  # elementos por tile
+KML_REGION_MAX_NIVEL = int(os.getenv("KML_REGION_MAX_NIVEL", "8"))  # profundidad máxima del quadtree
+KML_REGION_MIN_LOD_PIXELS = int(os.getenv("KML_REGION_MIN_LOD_PIXELS", "128"))
+
+# Tiles de los mapas estáticos: servidor ($z/$x/$y; vacío = OSM), cache en disco y modo offline
+MAP_TILE_URL = os.getenv("MAP_TILE_URL") or None
+MAP_TILE_CACHE_DIR = os.getenv("MAP_TILE_CACHE_DIR", str(BASE_DIR / "cache" / "tiles"))
+MAP_TILE_CACHE_MAX_BYTES = int(os.getenv("MAP_TILE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+MAP_TILE_OFFLINE = os.getenv("MAP_TILE_OFFLINE", "0").lower() in ("1", "true")  # solo tiles cacheados
+MAP_TILE_TIMEOUT = float(os.getenv("MAP_TILE_TIMEOUT", "10"))  # segundos por tile
+MAP_OUTPUT_FORMAT = os.getenv("MAP_OUTPUT_FORMAT", "png").lower()  # png (con paleta) o jpeg
+MAP_JPEG_QUALITY = int(os.getenv("MAP_JPEG_QUALITY", "90"))
+MAP_THUMBNAIL_WIDTHS = [int(w) for w in os.getenv("MAP_THUMBNAIL_WIDTHS", "320,640").split(",") if w.strip()]
+MAP_MARKER_CACHE_MAX = int(os.getenv("MAP_MARKER_CACHE_MAX", "1024"))  # sprites de marcadores en memoria
+
+# Subidas (fotos, GPX): área de staging en disco y límites por solicitud (bytes)
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", str(BASE_DIR / "cache" / "staging"))
+UPLOAD_MAX_FOTO_BYTES = int(os.getenv("UPLOAD_MAX_FOTO_BYTES", str(30 * 1024 * 1024)))
+UPLOAD_MAX_FOTOS_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_FOTOS_REQUEST_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_MAX_FOTOS_POR_REQUEST = int(os.getenv("UPLOAD_MAX_FOTOS_POR_REQUEST", "300"))
+UPLOAD_MAX_GPX_BYTES = int(os.getenv("UPLOAD_MAX_GPX_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_SESION_TTL_HORAS = float(os.getenv("UPLOAD_SESION_TTL_HORAS", "24"))  # subidas reanudables sin actividad
+
+# Tracks GPX: tolerancia Douglas-Peucker de la línea (m) y diezmado de evidencias (m / s)
+GPX_TRACK_TOLERANCIA_M = float(os.getenv("GPX_TRACK_TOLERANCIA_M", "5"))
+GPX_TRACK_DISTANCIA_M = float(os.getenv("GPX_TRACK_DISTANCIA_M", "50"))
+GPX_TRACK_INTERVALO_S = float(os.getenv("GPX_TRACK_INTERVALO_S", "300"))
+
+# Pool de procesos para procesar fotos subidas (0 = en el mismo proceso)
+FOTO_POOL_WORKERS = int(os.getenv("FOTO_POOL_WORKERS", str(os.cpu_count() or 1)))
+
+# Derivados de fotos para reportes PDF (lado mayor en px, calidad JPEG)
+REPORT_PHOTO_MAX_PX = int(os.getenv("REPORT_PHOTO_MAX_PX", "480"))
+REPORT_PHOTO_QUALITY = int(os.getenv("REPORT_PHOTO_QUALITY", "80"))
+
+# Derivados de fotos bajo demanda (/fotos/...?w=320&fmt=webp): tamaños permitidos, cache en disco (LRU)
+FOTO_DERIVADOS_ANCHOS = [int(w) for w in os.getenv("FOTO_DERIVADOS_ANCHOS", "160,320,640,1280").split(",") if w.strip()]
+FOTO_DERIVADOS_QUALITY = int(os.getenv("FOTO_DERIVADOS_QUALITY", "80"))
+FOTO_DERIVADOS_DIR = os.getenv("FOTO_DERIVADOS_DIR", str(BASE_DIR / "cache" / "fotos"))
+FOTO_DERIVADOS_MAX_BYTES = int(os.getenv("FOTO_DERIVADOS_MAX_BYTES", str(256 * 1024 * 1024)))
@@ -26,6 +26,6 @@ if ENVIRONMENT == "production":
     if JWT_SECRET_KEY == "dev-secret-key-change-in-production-playas-limpias-2025":
         raise ValueError("⚠️ SECURITY WARNING: Debes cambiar SECRET_KEY en producción!")
 
-# Configuración de rate limiting (para implementar a futuro)
-RATE_LIMIT_AUTH_REQUESTS = 5  # máximo 5 intentos de login por minuto
-RATE_LIMIT_AUTH_WINDOW = 60   # ventana de 60 segundos
\ No newline at end of file
+# Configuración de rate limiting (aplicado en /auth/login y /auth/register, ver security/rate_limit.py)
+RATE_LIMIT_AUTH_REQUESTS = int(os.getenv("RATE_LIMIT_AUTH_REQUESTS", "5"))  # máximo 5 intentos por ventana (por IP y por email)
+RATE_LIMIT_AUTH_WINDOW = int(os.getenv("RATE_LIMIT_AUTH_WINDOW", "60"))     # ventana de 60 segundos
\ No newline at end of file
@@ -35,8 +35,11 @@ def log_event(logger: logging.Logger, level: str, event: str, **fields: Any) ->
     event: nombre del evento (p.ej. user_login_success)
     fields: datos adicionales (ids, contadores, duraciones)
     """
-    line = f'event="{event}" ' + kv(**fields)
     level_method = getattr(logger, level.lower(), logger.info)
+    # No formatear la línea si el nivel está deshabilitado (p.ej. DEBUG en loops)
+    if not logger.isEnabledFor(getattr(logging, level.upper(), logging.INFO)):
+        return
+    line = f'event="{event}" ' + kv(**fields)
     level_method(line)
 
 
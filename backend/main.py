@@ -1,12 +1,12 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from routes import usuarios, denuncias, evidencias, concesiones, analisis, estados, auth, map_data, search, reincidencias, dashboard
 import os
 import time
 import uuid
 import logging
 from logging_config import setup_logging
+from routes.fotos import FotosStaticFiles
 
 setup_logging()
 app = FastAPI()
@@ -18,11 +18,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Upload-Offset"],  # Cursor de paginación keyset, offset de subidas reanudables
 )
 
-# Montar archivos estáticos para las fotos
+# Montar archivos estáticos para las fotos (originales y derivados ?w=&fmt=)
 if os.path.exists("fotos"):
-    app.mount("/fotos", StaticFiles(directory="fotos"), name="fotos")
+    app.mount("/fotos", FotosStaticFiles(directory="fotos"), name="fotos")
 
 # Incluir rutas
 app.include_router(auth.router, prefix="/auth", tags=["Autenticación"])
@@ -37,6 +38,14 @@ app.include_router(search.router, prefix="/search", tags=["Búsqueda"])
 app.include_router(reincidencias.router, prefix="/reincidencias", tags=["Reincidencias"])
 app.include_router(dashboard.router, prefix="/dashboard", tags=["Dashboard"])
 
+@app.on_event("shutdown")
+def shutdown_pools():
+    # Terminar los workers de los pools de PDF y fotos junto con la aplicación
+    from services.pdf_pool import pdf_render_pool
+    from services.foto_pipeline import foto_pool
+    pdf_render_pool.shutdown()
+    foto_pool.shutdown()
+
 # Middleware de access log simple (request_id, duración, status)
 access_logger = logging.getLogger("access")
 
@@ -0,0 +1,14 @@
+from sqlalchemy import Column, Integer, ForeignKey, TIMESTAMP
+from geoalchemy2 import Geometry
+from db import Base
+
+class TrackDenuncia(Base):
+    __tablename__ = "tracks_denuncia"
+
+    id_track = Column(Integer, primary_key=True, index=True)
+    id_denuncia = Column(Integer, ForeignKey("denuncias.id_denuncia"), nullable=False)
+    geom = Column(Geometry(geometry_type="LINESTRING", srid=4326), nullable=False)
+    fecha_inicio = Column(TIMESTAMP)
+    fecha_fin = Column(TIMESTAMP)
+    puntos_originales = Column(Integer)
+    puntos_simplificados = Column(Integer)
@@ -1,27 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
-from sqlalchemy import text
 from db import SessionLocal
 from models.analisis import AnalisisDenuncia, ResultadoAnalisis
 from models.denuncias import Denuncia
-from models.concesiones import Concesion
-from models.evidencias import Evidencia
-from models.usuarios import Usuario
-from models.estados import EstadoDenuncia
 from schemas.analisis import AnalisisCreate, AnalisisResponseGeoJSON, ResultadoAnalisisResponse, AnalisisPreviewRequest, AnalisisPreviewResponse, ResultadoAnalisisResponse
 from security.auth import verificar_token
 from services.geoprocessing.buffer import generar_buffer_union
 from services.geoprocessing.interseccion import intersectar_concesiones
+from services.geoprocessing.codec import a_geojson
+from services.analisis_datos import cargar_datos_analisis
+from services.response_cache import invalidar_denuncia
 from services.map_generator import MapGenerator
-from services.kmz_generator import KMZGenerator
-from datetime import datetime, timezone
+from services.pdf_pool import PDFPoolOcupado
+from services.artifact_cache import export_cache
+from services.exportaciones import Artefacto, EXPORTADORES, exportar_pdf, exportar_kmz_stream, exportar_lote
+from config import BULK_EXPORT_MAX_ANALISIS
+from datetime import date, datetime, timedelta, timezone
 import time
 from logging_utils import log_event
-from typing import List
-import json
-import tempfile
-import os
+from typing import Optional
+import asyncio
 import logging
 
 # Configurar logger
@@ -76,6 +76,7 @@ def ejecutar_analisis(data: AnalisisCreate, db: Session = Depends(get_db)):
         ))
 
     db.commit()
+    invalidar_denuncia(data.id_denuncia)
     
     # Generar mapa estático del análisis
     try:
@@ -88,10 +89,7 @@ def ejecutar_analisis(data: AnalisisCreate, db: Session = Depends(get_db)):
     except Exception as e:
         logger.error(f"Error generando mapa para análisis {nuevo_analisis.id_analisis}: {e}")
 
-    buffer_geojson = db.execute(
-        text("SELECT ST_AsGeoJSON(buffer_geom) FROM analisis_denuncia WHERE id_analisis = :id"),
-        {"id": nuevo_analisis.id_analisis}
-    ).scalar()
+    buffer_geojson = a_geojson(buffer_geom)
     # Log wizard paso 4
     try:
         intersections_count = len(resultados)
@@ -111,7 +109,7 @@ def ejecutar_analisis(data: AnalisisCreate, db: Session = Depends(get_db)):
         metodo=nuevo_analisis.metodo,
         observaciones=nuevo_analisis.observaciones,
         resultados=resultados,
-        buffer_geom=json.loads(buffer_geojson)
+        buffer_geom=buffer_geojson
     )
 
 @router.post("/preview", response_model=AnalisisPreviewResponse, dependencies=[Depends(verificar_token)])
@@ -126,10 +124,7 @@ def previsualizar_analisis(data: AnalisisPreviewRequest, db: Session = Depends(g
     buffer_geom = generar_buffer_union(db, data.id_denuncia, data.distancia_buffer)
     intersecciones = intersectar_concesiones(db, buffer_geom)
 
-    buffer_geojson = db.execute(
-        text("SELECT ST_AsGeoJSON(:geom)"),
-        {"geom": buffer_geom}
-    ).scalar()
+    buffer_geojson = a_geojson(buffer_geom)
 
     resultados = [
         ResultadoAnalisisResponse(
@@ -141,152 +136,115 @@ def previsualizar_analisis(data: AnalisisPreviewRequest, db: Session = Depends(g
     ]
 
     return AnalisisPreviewResponse(
-        buffer_geom=json.loads(buffer_geojson),
+        buffer_geom=buffer_geojson,
         resultados=resultados
     )
 
+@router.get("/exportar", dependencies=[Depends(verificar_token)])
+async def exportar_analisis_lote(
+    desde: Optional[date] = Query(None, description="Fecha de análisis desde (inclusive)"),
+    hasta: Optional[date] = Query(None, description="Fecha de análisis hasta (inclusive)"),
+    id_usuario: Optional[int] = Query(None, description="Usuario de la denuncia"),
+    id_estado: Optional[int] = Query(None, description="Estado de la denuncia"),
+    formatos: str = Query("pdf,kmz", description="Formatos a incluir: pdf, kmz"),
+    db: Session = Depends(get_db)
+):
+    """
+    Exporta los PDF/KMZ de todos los análisis que cumplen el filtro en un único ZIP,
+    enviado en streaming a medida que cada artefacto está listo (reutiliza la cache).
+    """
+    lista_formatos = [f.strip().lower() for f in formatos.split(",") if f.strip()]
+    if not lista_formatos or any(f not in EXPORTADORES for f in lista_formatos):
+        raise HTTPException(status_code=400, detail="Formatos válidos: pdf, kmz")
+    
+    query = db.query(AnalisisDenuncia.id_analisis).join(
+        Denuncia, Denuncia.id_denuncia == AnalisisDenuncia.id_denuncia
+    )
+    if desde:
+        query = query.filter(AnalisisDenuncia.fecha_analisis >= desde)
+    if hasta:
+        query = query.filter(AnalisisDenuncia.fecha_analisis < hasta + timedelta(days=1))
+    if id_usuario is not None:
+        query = query.filter(Denuncia.id_usuario == id_usuario)
+    if id_estado is not None:
+        query = query.filter(Denuncia.id_estado == id_estado)
+    ids = [fila.id_analisis for fila in query.order_by(AnalisisDenuncia.id_analisis).limit(BULK_EXPORT_MAX_ANALISIS + 1)]
+    
+    if not ids:
+        raise HTTPException(status_code=404, detail="No hay análisis que cumplan el filtro")
+    if len(ids) > BULK_EXPORT_MAX_ANALISIS:
+        raise HTTPException(status_code=400, detail=f"El filtro incluye más de {BULK_EXPORT_MAX_ANALISIS} análisis, acote el rango")
+    
+    log_event(logger, "INFO", "analisis_bulk_export_started",
+              analisis_count=len(ids), formatos=lista_formatos,
+              desde=str(desde) if desde else None, hasta=str(hasta) if hasta else None,
+              id_usuario=id_usuario, id_estado=id_estado)
+    
+    filename = f"analisis_{desde or 'inicio'}_{hasta or 'hoy'}.zip"
+    return StreamingResponse(
+        exportar_lote(ids, lista_formatos),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def _respuesta_artefacto(request: Request, artefacto: Artefacto, media_type: str, filename: str):
+    """
+    Sirve un artefacto cacheado con ETag (304 si el cliente ya lo tiene).
+    El enlace retenido del artefacto se libera al terminar el envío.
+    """
+    etag = f'"{artefacto.etag}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        export_cache.liberar(artefacto.path)
+        return Response(status_code=304, headers=headers)
+    return FileResponse(
+        path=artefacto.path,
+        media_type=media_type,
+        filename=filename,
+        headers=headers,
+        background=BackgroundTask(export_cache.liberar, artefacto.path)
+    )
+
 @router.get("/{id_analisis}/pdf", dependencies=[Depends(verificar_token)])
 async def generar_pdf_analisis(
     id_analisis: int,
-    background_tasks: BackgroundTasks,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """
-    Genera y descarga PDF completo del análisis
+    Genera y descarga PDF completo del análisis (reutiliza el PDF cacheado si el análisis no cambió)
     """
     try:
-        # 1. Verificar que el análisis existe
-        analisis = db.query(AnalisisDenuncia).filter(
-            AnalisisDenuncia.id_analisis == id_analisis
-        ).first()
+        # 1. Cargar análisis y datos relacionados (DTOs compartidos con KMZ y mapa)
+        datos = cargar_datos_analisis(db, id_analisis)
         
-        if not analisis:
+        if not datos:
             raise HTTPException(status_code=404, detail="Análisis no encontrado")
         
-        # 2. Obtener datos relacionados
-        denuncia = db.query(Denuncia).filter(
-            Denuncia.id_denuncia == analisis.id_denuncia
-        ).first()
-        
-        # Obtener evidencias con coordenadas convertidas
-        evidencias_raw = db.query(Evidencia).filter(
-            Evidencia.id_denuncia == analisis.id_denuncia
-        ).all()
-        
-        # Convertir coordenadas usando consulta SQL correcta para WKBElement
-        evidencias = []
-        for ev in evidencias_raw:
-            try:
-                # Convertir WKBElement a coordenadas legibles usando ST_X y ST_Y
-                coords_query = db.execute(
-                    text("SELECT ST_X(coordenadas) as lon, ST_Y(coordenadas) as lat FROM evidencias WHERE id_evidencia = :id"),
-                    {"id": ev.id_evidencia}
-                ).fetchone()
-                
-                if coords_query:
-                    # Crear diccionario GeoJSON manualmente
-                    coordenadas_dict = {
-                        "type": "Point",
-                        "coordinates": [float(coords_query.lon), float(coords_query.lat)]
-                    }
-                else:
-                    coordenadas_dict = None
-                
-                # Crear objeto procesado compatible con el nuevo PDFGenerator
-                ev_dict = {
-                    'id_evidencia': ev.id_evidencia,
-                    'id_denuncia': ev.id_denuncia,
-                    'coordenadas': coordenadas_dict,
-                    'descripcion': ev.descripcion,
-                    'foto_url': ev.foto_url,
-                    'fecha': ev.fecha,
-                    'hora': ev.hora
-                }
-                evidencias.append(type('Evidencia', (), ev_dict))
-            except Exception as e:
-                logger.warning(f"Error procesando evidencia {ev.id_evidencia}: {e}")
-                # Agregar evidencia sin coordenadas en caso de error
-                ev_dict = {
-                    'id_evidencia': ev.id_evidencia,
-                    'id_denuncia': ev.id_denuncia,
-                    'coordenadas': None,
-                    'descripcion': ev.descripcion,
-                    'foto_url': ev.foto_url,
-                    'fecha': ev.fecha,
-                    'hora': ev.hora
-                }
-                evidencias.append(type('Evidencia', (), ev_dict))
-        
-        resultados = db.query(ResultadoAnalisis).filter(
-            ResultadoAnalisis.id_analisis == id_analisis
-        ).all()
-        
-        concesiones_ids = [r.id_concesion for r in resultados]
-        concesiones = []
-        if concesiones_ids:
-            concesiones = db.query(Concesion).filter(
-                Concesion.id_concesion.in_(concesiones_ids)
-            ).all()
-        
-        usuario = None
-        if denuncia and denuncia.id_usuario:
-            usuario = db.query(Usuario).filter(
-                Usuario.id_usuario == denuncia.id_usuario
-            ).first()
-        
-        estado = None
-        if denuncia and denuncia.id_estado:
-            estado = db.query(EstadoDenuncia).filter(
-                EstadoDenuncia.id_estado == denuncia.id_estado
-            ).first()
-        
-        # 3. Generar PDF (por ahora, crear PDF básico de prueba)
-        from services.pdf_generator import PDFGenerator
-        
-        pdf_generator = PDFGenerator()
+        # 2. Obtener PDF desde la cache o generarlo (render en el pool de procesos)
         start = time.perf_counter()
-        pdf_bytes = await pdf_generator.generate_analysis_pdf(
-            analisis=analisis,
-            denuncia=denuncia,
-            evidencias=evidencias,
-            resultados=resultados,
-            concesiones=concesiones,
-            usuario=usuario,
-            estado=estado
-        )
+        artefacto = await exportar_pdf(datos)
         
-        # 4. Crear archivo temporal
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            temp_file.write(pdf_bytes)
-            temp_path = temp_file.name
-        
-        # 5. Función de limpieza
-        def cleanup():
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except Exception as e:
-                logger.warning(f"Error eliminando archivo temporal: {e}")
-        
-        # 6. Programar limpieza
-        background_tasks.add_task(cleanup)
-        
-        # 7. Retornar archivo para descarga
-        sector_name = denuncia.lugar if denuncia else "sector"
+        # 3. Retornar archivo para descarga
+        denuncia = datos.denuncia
+        sector_name = (denuncia.lugar if denuncia else None) or "sector"
         filename = f"inspeccion_{sector_name.replace(' ', '_')}_{id_analisis}.pdf"
         
         duration_ms = int((time.perf_counter() - start) * 1000)
         log_event(logging.getLogger("wizard"), "INFO", "wizard_step5_pdf_generated",
-                  analisis_id=id_analisis, output_bytes=len(pdf_bytes), duration_ms=duration_ms)
+                  analisis_id=id_analisis, output_bytes=artefacto.size,
+                  cache_hit=artefacto.cache_hit, duration_ms=duration_ms)
 
-        return FileResponse(
-            path=temp_path,
-            media_type="application/pdf",
-            filename=filename
-        )
+        return _respuesta_artefacto(request, artefacto, "application/pdf", filename)
         
     except HTTPException:
         raise
+    except PDFPoolOcupado as e:
+        logger.warning(f"Pool de PDF saturado para análisis {id_analisis}: {e}")
+        raise HTTPException(status_code=503, detail="Servidor ocupado generando reportes, intente nuevamente en unos segundos")
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout generando PDF para análisis {id_analisis}")
+        raise HTTPException(status_code=504, detail="La generación del PDF excedió el tiempo máximo")
     except Exception as e:
         logger.error(f"Error generando PDF para análisis {id_analisis}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error generando PDF: {str(e)}")
@@ -294,185 +252,47 @@ async def generar_pdf_analisis(
 @router.get("/{id_analisis}/kmz", dependencies=[Depends(verificar_token)])
 async def generar_kmz_analisis(
     id_analisis: int,
-    background_tasks: BackgroundTasks,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """
-    Genera y descarga archivo KMZ para Google Earth
+    Genera y descarga archivo KMZ para Google Earth (reutiliza el KMZ cacheado si el análisis no cambió)
     """
     try:
-        # 1. Verificar que el análisis existe
-        analisis = db.query(AnalisisDenuncia).filter(
-            AnalisisDenuncia.id_analisis == id_analisis
-        ).first()
+        # 1. Cargar análisis, evidencias, concesiones con geometría y buffer
+        datos = cargar_datos_analisis(db, id_analisis)
         
-        if not analisis:
+        if not datos:
             raise HTTPException(status_code=404, detail="Análisis no encontrado")
         
-        # 2. Obtener evidencias con coordenadas convertidas
-        evidencias_raw = db.query(Evidencia).filter(
-            Evidencia.id_denuncia == analisis.id_denuncia
-        ).all()
-        
-        # Convertir coordenadas usando consulta SQL correcta para WKBElement
-        evidencias = []
-        for ev in evidencias_raw:
-            try:
-                # Convertir WKBElement a coordenadas legibles usando ST_X y ST_Y
-                coords_query = db.execute(
-                    text("SELECT ST_X(coordenadas) as lon, ST_Y(coordenadas) as lat FROM evidencias WHERE id_evidencia = :id"),
-                    {"id": ev.id_evidencia}
-                ).fetchone()
-                
-                if coords_query:
-                    # Crear diccionario GeoJSON manualmente
-                    coordenadas_dict = {
-                        "type": "Point",
-                        "coordinates": [float(coords_query.lon), float(coords_query.lat)]
-                    }
-                else:
-                    coordenadas_dict = None
-                
-                # Crear objeto procesado compatible con KMZGenerator
-                ev_dict = {
-                    'id_evidencia': ev.id_evidencia,
-                    'id_denuncia': ev.id_denuncia,
-                    'coordenadas': coordenadas_dict,
-                    'descripcion': ev.descripcion,
-                    'foto_url': ev.foto_url,
-                    'fecha': ev.fecha,
-                    'hora': ev.hora
-                }
-                evidencias.append(type('Evidencia', (), ev_dict))
-            except Exception as e:
-                logger.warning(f"Error procesando evidencia {ev.id_evidencia}: {e}")
-                # Agregar evidencia sin coordenadas en caso de error
-                ev_dict = {
-                    'id_evidencia': ev.id_evidencia,
-                    'id_denuncia': ev.id_denuncia,
-                    'coordenadas': None,
-                    'descripcion': ev.descripcion,
-                    'foto_url': ev.foto_url,
-                    'fecha': ev.fecha,
-                    'hora': ev.hora
-                }
-                evidencias.append(type('Evidencia', (), ev_dict))
-        
-        # 3. Obtener concesiones intersectadas con geometrías
-        resultados = db.query(ResultadoAnalisis).filter(
-            ResultadoAnalisis.id_analisis == id_analisis
-        ).all()
-        
-        concesiones_ids = [r.id_concesion for r in resultados]
-        concesiones = []
-        if concesiones_ids:
-            # Obtener concesiones con geometrías GeoJSON
-            concesiones_query = text("""
-                SELECT 
-                    c.id_concesion,
-                    c.nombre,
-                    c.codigo_centro,
-                    c.titular,
-                    c.tipo,
-                    c.region,
-                    ST_AsGeoJSON(c.geom) as geom_json
-                FROM concesiones c
-                WHERE c.id_concesion = ANY(:concesiones_ids)
-            """)
-            
-            concesiones_result = db.execute(concesiones_query, {"concesiones_ids": concesiones_ids}).fetchall()
-            
-            for row in concesiones_result:
-                try:
-                    # Parsear geometría GeoJSON
-                    geom_dict = json.loads(row.geom_json) if row.geom_json else None
-                    
-                    # Log para debugging
-                    if geom_dict:
-                        logger.info(f"Concesión {row.id_concesion}: geometría tipo {geom_dict.get('type', 'unknown')}")
-                    else:
-                        logger.warning(f"Concesión {row.id_concesion}: sin geometría")
-                    
-                    # Crear objeto concesión con geometría procesada
-                    concesion_dict = {
-                        'id_concesion': row.id_concesion,
-                        'nombre': row.nombre,
-                        'codigo_centro': row.codigo_centro,
-                        'titular': row.titular,
-                        'tipo': row.tipo,
-                        'region': row.region,
-                        'geom': geom_dict
-                    }
-                    concesiones.append(type('Concesion', (), concesion_dict))
-                except Exception as e:
-                    logger.warning(f"Error procesando concesión {row.id_concesion}: {e}")
-                    # Agregar concesión sin geometría en caso de error
-                    concesion_dict = {
-                        'id_concesion': row.id_concesion,
-                        'nombre': row.nombre,
-                        'codigo_centro': row.codigo_centro,
-                        'titular': row.titular,
-                        'tipo': row.tipo,
-                        'region': row.region,
-                        'geom': None
-                    }
-                    concesiones.append(type('Concesion', (), concesion_dict))
-        
-        # 4. Obtener buffer geometry
-        buffer_geojson = db.execute(
-            text("SELECT ST_AsGeoJSON(buffer_geom) FROM analisis_denuncia WHERE id_analisis = :id"),
-            {"id": analisis.id_analisis}
-        ).scalar()
-        
-        buffer_geom = None
-        if buffer_geojson:
-            try:
-                buffer_geom = json.loads(buffer_geojson)
-            except (json.JSONDecodeError, TypeError) as e:
-                logger.warning(f"Error parseando buffer_geom para análisis {analisis.id_analisis}: {e}")
-                buffer_geom = None
-        
-        # 5. Generar KMZ
-        kmz_generator = KMZGenerator()
+        # 2. Obtener KMZ desde la cache, o generarlo enviándolo a medida que se produce
         start = time.perf_counter()
-        kmz_bytes = await kmz_generator.generate_analysis_kmz(
-            analisis=analisis,
-            evidencias=evidencias,
-            concesiones=concesiones,
-            buffer_geom=buffer_geom
-        )
-        
-        # 6. Crear archivo temporal
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".kmz") as temp_file:
-            temp_file.write(kmz_bytes)
-            temp_path = temp_file.name
-        
-        # 7. Función de limpieza
-        def cleanup():
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except Exception as e:
-                logger.warning(f"Error eliminando archivo temporal: {e}")
-        
-        # 8. Programar limpieza
-        background_tasks.add_task(cleanup)
+        artefacto = await exportar_kmz_stream(datos)
         
-        # 9. Retornar archivo para descarga
+        # 3. Retornar archivo para descarga
         filename = f"inspeccion_analisis_{id_analisis}.kmz"
+        media_type = "application/vnd.google-earth.kmz"
         
         duration_ms = int((time.perf_counter() - start) * 1000)
+        cache_hit = isinstance(artefacto, Artefacto)
         log_event(logging.getLogger("wizard"), "INFO", "wizard_step5_kmz_generated",
-                  analisis_id=id_analisis, output_bytes=len(kmz_bytes), duration_ms=duration_ms)
+                  analisis_id=id_analisis, output_bytes=artefacto.size if cache_hit else None,
+                  cache_hit=cache_hit, streamed=not cache_hit, duration_ms=duration_ms)
 
-        return FileResponse(
-            path=temp_path,
-            media_type="application/vnd.google-earth.kmz",
-            filename=filename
+        if cache_hit:
+            return _respuesta_artefacto(request, artefacto, media_type, filename)
+        return StreamingResponse(
+            artefacto.bloques,
+            media_type=media_type,
+            headers={
+                "ETag": f'"{artefacto.etag}"',
+                "Cache-Control": "private, no-cache",
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            }
         )
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error generando KMZ para análisis {id_analisis}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error generando KMZ: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error generando KMZ: {str(e)}")
\ No newline at end of file
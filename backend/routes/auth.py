@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
@@ -19,6 +19,7 @@ from security.utils import (
     verify_token,
     get_token_expiration_time
 )
+from security.rate_limit import verificar_rate_limit_auth
 import logging
 import time
 from logging_utils import log_event, mask_email
@@ -69,12 +70,19 @@ async def get_current_user(
     return user
 
 @router.post("/register", response_model=Token, status_code=status.HTTP_201_CREATED)
-async def register_user(user_data: UsuarioRegister, db: Session = Depends(get_db)):
+async def register_user(user_data: UsuarioRegister, request: Request, db: Session = Depends(get_db)):
     """
     Registro de nuevo usuario
     """
-    # Verificar si el email ya existe
     start = time.perf_counter()
+    # Rate limiting por IP/email antes de tocar la BD o hashear
+    try:
+        verificar_rate_limit_auth(request, user_data.email)
+    except HTTPException:
+        log_event(logger, "WARNING", "user_register_rate_limited", email_mask=mask_email(user_data.email))
+        raise
+
+    # Verificar si el email ya existe
     existing_user = db.query(Usuario).filter(Usuario.email == user_data.email).first()
     if existing_user:
         # Log de conflicto por email ya registrado
@@ -114,11 +122,18 @@ async def register_user(user_data: UsuarioRegister, db: Session = Depends(get_db
     )
 
 @router.post("/login", response_model=Token)
-async def login_user(user_credentials: UsuarioLogin, db: Session = Depends(get_db)):
+async def login_user(user_credentials: UsuarioLogin, request: Request, db: Session = Depends(get_db)):
     """
     Login de usuario existente
     """
     start = time.perf_counter()
+    # Rate limiting por IP/email antes de verificar la contraseña
+    try:
+        verificar_rate_limit_auth(request, user_credentials.email)
+    except HTTPException:
+        log_event(logger, "WARNING", "user_login_rate_limited", email_mask=mask_email(user_credentials.email))
+        raise
+
     # Buscar usuario por email
     user = db.query(Usuario).filter(
         and_(Usuario.email == user_credentials.email, Usuario.activo == True)
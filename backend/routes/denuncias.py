@@ -1,24 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import TIMESTAMP, func, literal, literal_column, text, tuple_
 from db import SessionLocal
 from models.denuncias import Denuncia
 from models.usuarios import Usuario
 from models.estados import EstadoDenuncia
 from models.evidencias import Evidencia
-from models.analisis import AnalisisDenuncia
 from schemas.denuncias import DenunciaCreate, DenunciaResponse, DenunciaDetalleResponse, DenunciaHistorialResponse
 from schemas.evidencias import EvidenciaResponseGeoJSON, FotoInfo
 from schemas.analisis import AnalisisResponseGeoJSON, ResultadoAnalisisResponse
 from security.auth import verificar_token
+from services.geoprocessing.codec import puntos_geojson
+from services.response_cache import detalle_denuncia_cache, invalidar_denuncia
+from services.paginacion import decodificar_cursor, limite_pagina, paginar
 from typing import List, Optional
 import logging
 import time
 from logging_utils import log_event
 from pydantic import BaseModel
-import json
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 def get_db():
     db = SessionLocal()
@@ -53,66 +55,113 @@ def crear_denuncia(denuncia: DenunciaCreate, db: Session = Depends(get_db)):
               duration_ms=int((time.perf_counter()-start)*1000))
     return nueva
 
+# fecha_ingreso admite NULL: en la clave de orden vale -infinity, así esas denuncias
+# van al final (DESC) y un cursor con fecha NULL sigue comparando
+MENOS_INFINITO = literal_column("'-infinity'::timestamp")
+FECHA_INGRESO_ORDEN = func.coalesce(Denuncia.fecha_ingreso, MENOS_INFINITO)
+
+def _clave_denuncia(d):
+    return (d.fecha_ingreso, d.id_denuncia)
+
+def _pagina_denuncias(query, cursor: Optional[str], limit: int):
+    """Aplica orden (fecha_ingreso, id_denuncia) descendente y el cursor keyset."""
+    posicion = decodificar_cursor(cursor, 2)
+    if posicion:
+        fecha_cursor = func.coalesce(literal(posicion[0], TIMESTAMP), MENOS_INFINITO)
+        query = query.filter(
+            tuple_(FECHA_INGRESO_ORDEN, Denuncia.id_denuncia) < tuple_(fecha_cursor, posicion[1])
+        )
+    return query.order_by(
+        FECHA_INGRESO_ORDEN.desc(), Denuncia.id_denuncia.desc()
+    ).limit(limit + 1).all()
+
 @router.get("/", response_model=List[DenunciaResponse], dependencies=[Depends(verificar_token)])
-def listar_denuncias(db: Session = Depends(get_db)):
-    return db.query(Denuncia).all()
+def listar_denuncias(
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Cursor opaco de la página siguiente (cabecera X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Tamaño de página"),
+    db: Session = Depends(get_db)
+):
+    limit = limite_pagina(limit)
+    filas = _pagina_denuncias(db.query(Denuncia), cursor, limit)
+    return paginar(filas, limit, response, _clave_denuncia)
 
 @router.get("/mis-denuncias", response_model=List[DenunciaResponse])
 def obtener_mis_denuncias(
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Cursor opaco de la página siguiente (cabecera X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Tamaño de página"),
     usuario_actual: Usuario = Depends(verificar_token),
     db: Session = Depends(get_db)
 ):
     """
-    Obtiene las denuncias del usuario autenticado
+    Obtiene las denuncias del usuario autenticado (paginadas por cursor)
     """
-    denuncias = db.query(Denuncia).filter(
-        Denuncia.id_usuario == usuario_actual.id_usuario
-    ).order_by(Denuncia.fecha_ingreso.desc()).all()
-    
-    return denuncias
+    limit = limite_pagina(limit)
+    query = db.query(Denuncia).filter(Denuncia.id_usuario == usuario_actual.id_usuario)
+    filas = _pagina_denuncias(query, cursor, limit)
+    return paginar(filas, limit, response, _clave_denuncia)
 
 @router.get("/historial", response_model=List[DenunciaHistorialResponse])
 def obtener_historial_denuncias(
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Cursor opaco de la página siguiente (cabecera X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Tamaño de página"),
     usuario_actual: Usuario = Depends(verificar_token),
     db: Session = Depends(get_db)
 ):
     """
-    Obtiene el historial completo de denuncias con información adicional
+    Obtiene el historial de denuncias con información adicional, paginado por cursor.
+    Los conteos se calculan solo para las denuncias de la página.
     """
-    # Consulta principal con JOIN para obtener información del usuario
-    query = text("""
+    limit = limite_pagina(limit)
+    posicion = decodificar_cursor(cursor, 2)
+    params = {"id_usuario": usuario_actual.id_usuario, "limit": limit + 1}
+    filtro_cursor = ""
+    if posicion:
+        filtro_cursor = """
+            AND (COALESCE(d.fecha_ingreso, '-infinity'::timestamp), d.id_denuncia)
+                < (COALESCE(CAST(:cursor_fecha AS timestamp), '-infinity'::timestamp), :cursor_id)
+        """
+        params["cursor_fecha"], params["cursor_id"] = posicion
+
+    query = text(f"""
+        WITH pagina AS (
+            SELECT 
+                d.id_denuncia,
+                d.id_usuario,
+                d.id_estado,
+                d.fecha_inspeccion,
+                d.fecha_ingreso,
+                d.lugar,
+                d.observaciones
+            FROM denuncias d
+            WHERE d.id_usuario = :id_usuario
+            {filtro_cursor}
+            ORDER BY COALESCE(d.fecha_ingreso, '-infinity'::timestamp) DESC, d.id_denuncia DESC
+            LIMIT :limit
+        )
         SELECT 
-            d.id_denuncia,
-            d.id_usuario,
-            d.id_estado,
-            d.fecha_inspeccion,
-            d.fecha_ingreso,
-            d.lugar,
-            d.observaciones,
+            p.*,
             u.nombre as usuario_nombre,
             u.email as usuario_email,
-            COALESCE(ev_count.total_evidencias, 0) as total_evidencias,
-            COALESCE(con_count.total_concesiones, 0) as total_concesiones_afectadas
-        FROM denuncias d
-        LEFT JOIN usuarios u ON d.id_usuario = u.id_usuario
-        LEFT JOIN (
-            SELECT id_denuncia, COUNT(*) as total_evidencias
-            FROM evidencias
-            GROUP BY id_denuncia
-        ) ev_count ON d.id_denuncia = ev_count.id_denuncia
-        LEFT JOIN (
-            SELECT 
-                ad.id_denuncia,
-                COUNT(DISTINCT ra.id_concesion) as total_concesiones
-            FROM analisis_denuncia ad
-            LEFT JOIN resultado_analisis ra ON ad.id_analisis = ra.id_analisis
-            GROUP BY ad.id_denuncia
-        ) con_count ON d.id_denuncia = con_count.id_denuncia
-        WHERE d.id_usuario = :id_usuario
-        ORDER BY d.fecha_ingreso DESC
+            (
+                SELECT COUNT(*)
+                FROM evidencias e
+                WHERE e.id_denuncia = p.id_denuncia
+            ) as total_evidencias,
+            (
+                SELECT COUNT(DISTINCT ra.id_concesion)
+                FROM analisis_denuncia ad
+                JOIN resultado_analisis ra ON ad.id_analisis = ra.id_analisis
+                WHERE ad.id_denuncia = p.id_denuncia
+            ) as total_concesiones_afectadas
+        FROM pagina p
+        LEFT JOIN usuarios u ON p.id_usuario = u.id_usuario
+        ORDER BY COALESCE(p.fecha_ingreso, '-infinity'::timestamp) DESC, p.id_denuncia DESC
     """)
     
-    result = db.execute(query, {"id_usuario": usuario_actual.id_usuario}).fetchall()
+    result = paginar(db.execute(query, params).fetchall(), limit, response, _clave_denuncia)
     
     historial = []
     for row in result:
@@ -141,8 +190,14 @@ def obtener_detalles_denuncia(
     db: Session = Depends(get_db)
 ):
     """
-    Obtiene los detalles completos de una denuncia específica
+    Obtiene los detalles completos de una denuncia específica.
+    Usa un número constante de consultas (denuncia, evidencias y análisis con
+    resultados agregados vía json_agg), independiente de la cantidad de análisis.
     """
+    cached = detalle_denuncia_cache.get(id_denuncia)
+    if cached is not None and cached.id_usuario == usuario_actual.id_usuario:
+        return cached
+
     # Verificar que la denuncia existe y pertenece al usuario
     denuncia = db.query(Denuncia).filter(
         Denuncia.id_denuncia == id_denuncia,
@@ -155,141 +210,90 @@ def obtener_detalles_denuncia(
             detail="Denuncia no encontrada o no tienes permisos para acceder a ella"
         )
     
-    # Obtener evidencias de la denuncia
+    # Obtener evidencias de la denuncia (también alimentan la lista de fotos)
     evidencias = db.query(Evidencia).filter(
         Evidencia.id_denuncia == id_denuncia
-    ).all()
+    ).order_by(Evidencia.id_evidencia).all()
     
-    # Convertir evidencias a GeoJSON
+    # Convertir evidencias a GeoJSON (decodificación en Python, sin consultas por fila)
+    coordenadas = puntos_geojson(e.coordenadas for e in evidencias)
     evidencias_geojson = []
-    for evidencia in evidencias:
-        try:
-            coords_json = db.execute(
-                text("SELECT ST_AsGeoJSON(coordenadas) FROM evidencias WHERE id_evidencia = :id"),
-                {"id": evidencia.id_evidencia}
-            ).scalar()
-            
-            evidencias_geojson.append(EvidenciaResponseGeoJSON(
+    fotos = []
+    for evidencia, coords in zip(evidencias, coordenadas):
+        if coords is None:
+            logger.warning(f"Error procesando evidencia {evidencia.id_evidencia}: coordenadas vacías")
+            continue
+        evidencias_geojson.append(EvidenciaResponseGeoJSON(
+            id_evidencia=evidencia.id_evidencia,
+            id_denuncia=evidencia.id_denuncia,
+            coordenadas=coords,
+            fecha=evidencia.fecha,
+            hora=evidencia.hora,
+            descripcion=evidencia.descripcion,
+            foto_url=evidencia.foto_url
+        ))
+        if evidencia.foto_url is not None:
+            lon, lat = coords["coordinates"]
+            fotos.append(FotoInfo(
                 id_evidencia=evidencia.id_evidencia,
-                id_denuncia=evidencia.id_denuncia,
-                coordenadas=json.loads(coords_json),
+                foto_url=evidencia.foto_url,
+                descripcion=evidencia.descripcion,
                 fecha=evidencia.fecha,
                 hora=evidencia.hora,
-                descripcion=evidencia.descripcion,
-                foto_url=evidencia.foto_url
+                coordenadas={"lat": lat, "lng": lon}
             ))
-        except Exception as e:
-            print(f"Error procesando evidencia {evidencia.id_evidencia}: {e}")
-            # Continuar con la siguiente evidencia
-            continue
+    fotos.sort(key=lambda f: (f.fecha, f.hora))
     
-    # Obtener análisis de la denuncia
-    analisis_list = db.query(AnalisisDenuncia).filter(
-        AnalisisDenuncia.id_denuncia == id_denuncia
-    ).all()
+    # Obtener análisis con sus resultados y concesiones en una sola consulta
+    analisis_sql = text("""
+        SELECT 
+            a.id_analisis,
+            a.id_denuncia,
+            a.fecha_analisis,
+            a.distancia_buffer,
+            a.metodo,
+            a.observaciones,
+            ST_AsGeoJSON(a.buffer_geom)::json AS buffer_geom,
+            COALESCE((
+                SELECT json_agg(json_build_object(
+                    'id_concesion', ra.id_concesion,
+                    'interseccion_valida', ra.interseccion_valida,
+                    'distancia_minima', ra.distancia_minima,
+                    'codigo_centro', c.codigo_centro::text,
+                    'nombre', c.nombre,
+                    'titular', c.titular,
+                    'tipo', c.tipo,
+                    'region', c.region
+                ) ORDER BY ra.id_resultado)
+                FROM resultado_analisis ra
+                LEFT JOIN concesiones c ON ra.id_concesion = c.id_concesion
+                WHERE ra.id_analisis = a.id_analisis
+            ), '[]'::json) AS resultados
+        FROM analisis_denuncia a
+        WHERE a.id_denuncia = :id_denuncia
+        ORDER BY a.id_analisis
+    """)
     
-    # Convertir análisis a respuesta GeoJSON
     analisis_geojson = []
-    for analisis in analisis_list:
+    for row in db.execute(analisis_sql, {"id_denuncia": id_denuncia}).fetchall():
         try:
-            # Obtener resultados del análisis con datos de concesiones
-            resultados_sql = text("""
-                SELECT 
-                    ra.id_concesion,
-                    ra.interseccion_valida,
-                    ra.distancia_minima,
-                    c.codigo_centro,
-                    c.nombre,
-                    c.titular,
-                    c.tipo,
-                    c.region
-                FROM resultado_analisis ra
-                LEFT JOIN concesiones c ON ra.id_concesion = c.id_concesion
-                WHERE ra.id_analisis = :id_analisis
-            """)
-            
-            resultados = db.execute(resultados_sql, {"id_analisis": analisis.id_analisis}).fetchall()
-            
-            resultados_response = [
-                ResultadoAnalisisResponse(
-                    id_concesion=row.id_concesion,
-                    interseccion_valida=row.interseccion_valida,
-                    distancia_minima=row.distancia_minima,
-                    codigo_centro=str(row.codigo_centro) if row.codigo_centro else None,
-                    nombre=row.nombre,
-                    titular=row.titular,
-                    tipo=row.tipo,
-                    region=row.region
-                ) for row in resultados
-            ]
-            
-            # Obtener buffer geom como GeoJSON
-            buffer_geojson = None
-            if analisis.buffer_geom:
-                try:
-                    # Usar el método correcto de GeoAlchemy2 para obtener WKB
-                    buffer_wkb = bytes(analisis.buffer_geom)
-                    buffer_json = db.execute(
-                        text("SELECT ST_AsGeoJSON(ST_GeomFromWKB(:buffer_wkb))"),
-                        {"buffer_wkb": buffer_wkb}
-                    ).scalar()
-                    if buffer_json:
-                        buffer_geojson = json.loads(buffer_json)
-                except Exception as e:
-                    print(f"Error convirtiendo buffer geom: {e}")
-                    # No hacer rollback, solo continuar sin buffer_geom
-                    buffer_geojson = None
-            
             analisis_geojson.append(AnalisisResponseGeoJSON(
-                id_analisis=analisis.id_analisis,
-                id_denuncia=analisis.id_denuncia,
-                fecha_analisis=analisis.fecha_analisis,
-                distancia_buffer=analisis.distancia_buffer,
-                metodo=analisis.metodo,
-                observaciones=analisis.observaciones,
-                resultados=resultados_response,
-                buffer_geom=buffer_geojson
+                id_analisis=row.id_analisis,
+                id_denuncia=row.id_denuncia,
+                fecha_analisis=row.fecha_analisis,
+                distancia_buffer=row.distancia_buffer,
+                metodo=row.metodo,
+                observaciones=row.observaciones,
+                resultados=[ResultadoAnalisisResponse(**r) for r in row.resultados],
+                buffer_geom=row.buffer_geom
             ))
         except Exception as e:
-            print(f"Error procesando análisis {analisis.id_analisis}: {e}")
+            logger.warning(f"Error procesando análisis {row.id_analisis}: {e}")
             # Continuar con el siguiente análisis
             continue
     
-    # Obtener fotos de la denuncia
-    fotos_sql = text("""
-        SELECT 
-            e.id_evidencia,
-            e.foto_url,
-            e.descripcion,
-            e.fecha,
-            e.hora,
-            ST_X(e.coordenadas) as lat,
-            ST_Y(e.coordenadas) as lng
-        FROM evidencias e
-        WHERE e.id_denuncia = :id_denuncia AND e.foto_url IS NOT NULL
-        ORDER BY e.fecha, e.hora
-    """)
-    
-    try:
-        fotos_result = db.execute(fotos_sql, {"id_denuncia": id_denuncia}).fetchall()
-        
-        fotos = [
-            FotoInfo(
-                id_evidencia=row.id_evidencia,
-                foto_url=row.foto_url,
-                descripcion=row.descripcion,
-                fecha=row.fecha,
-                hora=row.hora,
-                coordenadas={"lat": row.lat, "lng": row.lng}
-            ) for row in fotos_result
-        ]
-    except Exception as e:
-        print(f"Error obteniendo fotos: {e}")
-        # Si hay error, continuar con lista vacía
-        fotos = []
-    
     # Crear respuesta detallada
-    return DenunciaDetalleResponse(
+    respuesta = DenunciaDetalleResponse(
         id_denuncia=denuncia.id_denuncia,
         id_usuario=denuncia.id_usuario,
         id_estado=denuncia.id_estado,
@@ -304,6 +308,8 @@ def obtener_detalles_denuncia(
         total_analisis=len(analisis_geojson),
         total_fotos=len(fotos)
     )
+    detalle_denuncia_cache.set(id_denuncia, respuesta)
+    return respuesta
 
 @router.put("/{id_denuncia}/estado", response_model=DenunciaResponse)
 def cambiar_estado_denuncia(
@@ -345,5 +351,6 @@ def cambiar_estado_denuncia(
     
     db.commit()
     db.refresh(denuncia)
+    invalidar_denuncia(id_denuncia)
     
     return denuncia
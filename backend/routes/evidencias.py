@@ -1,15 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import text
 from db import SessionLocal
 from models.evidencias import Evidencia
 from models.denuncias import Denuncia
-from schemas.evidencias import EvidenciaCreateGeoJSON, EvidenciaResponseGeoJSON, SubidaFotosResponse, ListaFotosResponse, FotoInfo
+from schemas.evidencias import (
+    EvidenciaCreateGeoJSON, EvidenciaResponseGeoJSON, SubidaFotosResponse, ListaFotosResponse, FotoInfo,
+    CrearSubidaRequest, SubidaEstado, FinalizarSubidasRequest
+)
 from geoalchemy2.shape import from_shape
 from shapely.geometry import shape
 from security.auth import verificar_token
 from services.foto_service import FotoService
-from typing import List
+from services.geoprocessing.codec import a_geojson, puntos_geojson
+from services.response_cache import invalidar_denuncia
+from services.paginacion import decodificar_cursor, limite_pagina, paginar
+from services.staging import (
+    ArchivoEnStaging, FormularioEnStaging, LimitesSubida, es_imagen, es_xml, leer_entero,
+    parametros_multipart, recibir_formulario
+)
+from services import subidas
+from config import (
+    UPLOAD_MAX_FOTO_BYTES, UPLOAD_MAX_FOTOS_REQUEST_BYTES, UPLOAD_MAX_FOTOS_POR_REQUEST, UPLOAD_MAX_GPX_BYTES
+)
+from typing import List, Optional
+import asyncio
 import logging
 import time
 from logging_utils import log_event
@@ -19,6 +33,20 @@ from services.geoprocessing.gpx.gpx_parser import procesar_gpx_waypoints
 router = APIRouter()
 foto_service = FotoService()
 
+# Límites de las subidas en streaming (el formulario GPX trae además dos campos de texto)
+LIMITES_FOTOS = LimitesSubida(
+    max_archivo=UPLOAD_MAX_FOTO_BYTES,
+    max_total=UPLOAD_MAX_FOTOS_REQUEST_BYTES,
+    max_archivos=UPLOAD_MAX_FOTOS_POR_REQUEST,
+    validar_firma=es_imagen,
+)
+LIMITES_GPX = LimitesSubida(
+    max_archivo=UPLOAD_MAX_GPX_BYTES,
+    max_total=UPLOAD_MAX_GPX_BYTES + 64 * 1024,
+    max_archivos=1,
+    validar_firma=es_xml,
+)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -45,16 +73,12 @@ def crear_evidencia(evidencia: EvidenciaCreateGeoJSON, db: Session = Depends(get
     db.add(nueva)
     db.commit()
     db.refresh(nueva)
-
-    coords_json = db.execute(
-        text("SELECT ST_AsGeoJSON(coordenadas) FROM evidencias WHERE id_evidencia = :id"),
-        {"id": nueva.id_evidencia}
-    ).scalar()
+    invalidar_denuncia(evidencia.id_denuncia)
 
     return EvidenciaResponseGeoJSON(
         id_evidencia=nueva.id_evidencia,
         id_denuncia=nueva.id_denuncia,
-        coordenadas=pyjson.loads(coords_json),
+        coordenadas=a_geojson(nueva.coordenadas),
         fecha=nueva.fecha,
         hora=nueva.hora,
         descripcion=nueva.descripcion,
@@ -62,21 +86,33 @@ def crear_evidencia(evidencia: EvidenciaCreateGeoJSON, db: Session = Depends(get
     )
 
 @router.get("/", response_model=List[EvidenciaResponseGeoJSON], dependencies=[Depends(verificar_token)])
-def listar_evidencias(id_denuncia: int = Query(None), db: Session = Depends(get_db)):
+def listar_evidencias(
+    response: Response,
+    id_denuncia: int = Query(None),
+    cursor: Optional[str] = Query(None, description="Cursor opaco de la página siguiente (cabecera X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Tamaño de página (sin id_denuncia se aplica el tamaño por defecto)"),
+    db: Session = Depends(get_db)
+):
+    query = db.query(Evidencia)
     if id_denuncia is not None:
-        evidencias = db.query(Evidencia).filter(Evidencia.id_denuncia == id_denuncia).all()
+        query = query.filter(Evidencia.id_denuncia == id_denuncia)
+    posicion = decodificar_cursor(cursor, 1)
+    if posicion:
+        query = query.filter(Evidencia.id_evidencia > posicion[0])
+    query = query.order_by(Evidencia.id_evidencia)
+    # Las evidencias de una denuncia se entregan completas salvo que se pida paginar
+    if id_denuncia is None or limit is not None or cursor is not None:
+        limit = limite_pagina(limit)
+        evidencias = paginar(query.limit(limit + 1).all(), limit, response, lambda e: (e.id_evidencia,))
     else:
-        evidencias = db.query(Evidencia).all()
+        evidencias = query.all()
+    coordenadas = puntos_geojson(e.coordenadas for e in evidencias)
     resultado = []
-    for e in evidencias:
-        coords_json = db.execute(
-            text("SELECT ST_AsGeoJSON(coordenadas) FROM evidencias WHERE id_evidencia = :id"),
-            {"id": e.id_evidencia}
-        ).scalar()
+    for e, coords in zip(evidencias, coordenadas):
         resultado.append(EvidenciaResponseGeoJSON(
             id_evidencia=e.id_evidencia,
             id_denuncia=e.id_denuncia,
-            coordenadas=pyjson.loads(coords_json),
+            coordenadas=coords,
             fecha=e.fecha,
             hora=e.hora,
             descripcion=e.descripcion,
@@ -84,29 +120,48 @@ def listar_evidencias(id_denuncia: int = Query(None), db: Session = Depends(get_
         ))
     return resultado
 
-@router.post("/upload_gpx", dependencies=[Depends(verificar_token)])
-def subir_archivo_gpx(
-    id_denuncia: int = Form(...),  # Ahora se recibe como campo de formulario
-    utc_offset: int = Form(...),
-    archivo_gpx: UploadFile = File(...),
-    db: Session = Depends(get_db)
-):
+@router.post(
+    "/upload_gpx",
+    dependencies=[Depends(verificar_token)],
+    openapi_extra=parametros_multipart({"id_denuncia": "integer", "utc_offset": "integer"}, {"archivo_gpx": False}),
+)
+async def subir_archivo_gpx(request: Request, db: Session = Depends(get_db)):
     """
     Sube un archivo GPX (waypoints) y los almacena como evidencias georreferenciadas.
     Cada waypoint incluye fecha y hora extraídas del timestamp del archivo GPX.
     El parámetro utc_offset indica la diferencia horaria a aplicar a los timestamps (por ejemplo, -3 o -4).
+    
+    Formulario multipart: id_denuncia, utc_offset, archivo_gpx. El archivo se recibe
+    en streaming a disco (máximo UPLOAD_MAX_GPX_BYTES).
     """
+    formulario = await recibir_formulario(request, LIMITES_GPX)
+    try:
+        return await _procesar_subida_gpx(formulario, db)
+    finally:
+        await asyncio.to_thread(formulario.limpiar)
+
+async def _procesar_subida_gpx(formulario: FormularioEnStaging, db: Session):
+    id_denuncia = leer_entero(formulario, "id_denuncia")
+    utc_offset = leer_entero(formulario, "utc_offset")
+    archivos = formulario.archivos_de("archivo_gpx")
+    if not archivos:
+        raise HTTPException(status_code=400, detail="Falta el archivo GPX (campo 'archivo_gpx')")
+    archivo_gpx = archivos[0]
+    
     # Validar que la denuncia existe
-    denuncia = db.query(Denuncia).filter(Denuncia.id_denuncia == id_denuncia).first()
+    denuncia = await asyncio.to_thread(lambda: db.query(Denuncia).filter(Denuncia.id_denuncia == id_denuncia).first())
     if not denuncia:
         raise HTTPException(status_code=404, detail="Denuncia no encontrada")
     
-    # Validar extensión del archivo
-    if not archivo_gpx.filename.endswith(".gpx"):
+    # Validar extensión y contenido del archivo
+    if not archivo_gpx.nombre.endswith(".gpx"):
         raise HTTPException(status_code=400, detail="El archivo debe tener extensión .gpx")
+    if not archivo_gpx.firma_valida:
+        raise HTTPException(status_code=400, detail="El archivo GPX no es un documento XML válido")
 
     start = time.perf_counter()
-    resultado = procesar_gpx_waypoints(archivo_gpx, id_denuncia, db, utc_offset)
+    resultado = await asyncio.to_thread(procesar_gpx_waypoints, archivo_gpx.path, id_denuncia, db, utc_offset)
+    invalidar_denuncia(id_denuncia)
     # Extraer cantidad de waypoints desde el mensaje de detalle si está disponible
     waypoints_count = None
     try:
@@ -120,17 +175,17 @@ def subir_archivo_gpx(
     except Exception:
         waypoints_count = None
     log_event(logging.getLogger("wizard"), "INFO", "wizard_step2_gpx_uploaded",
-              denuncia_id=id_denuncia, filename=archivo_gpx.filename, utc_offset=utc_offset,
+              denuncia_id=id_denuncia, filename=archivo_gpx.nombre, utc_offset=utc_offset,
               waypoints_count=waypoints_count, duration_ms=int((time.perf_counter()-start)*1000))
     return resultado
 
-@router.post("/upload_fotos/{id_denuncia}", response_model=SubidaFotosResponse, dependencies=[Depends(verificar_token)])
-def subir_fotos_denuncia(
-    id_denuncia: int, 
-    archivos: List[UploadFile] = File(...), 
-    descripciones: List[str] = Form(...),
-    db: Session = Depends(get_db)
-):
+@router.post(
+    "/upload_fotos/{id_denuncia}",
+    response_model=SubidaFotosResponse,
+    dependencies=[Depends(verificar_token)],
+    openapi_extra=parametros_multipart({"descripciones": "string"}, {"archivos": True}),
+)
+async def subir_fotos_denuncia(id_denuncia: int, request: Request, db: Session = Depends(get_db)):
     """
     Sube múltiples fotos para una denuncia y las asocia automáticamente a evidencias GPS por timestamp EXIF.
     Cada foto debe tener una descripción individual (campo 'descripciones').
@@ -147,7 +202,21 @@ def subir_fotos_denuncia(
     - Las fotos se comprimirán automáticamente a 1920x1080
     - Se asociarán por timestamp EXIF a la evidencia GPS más cercana en tiempo
     - Cada foto debe tener una descripción
+    
+    Las fotos se reciben en streaming a disco, con límites por foto y por solicitud
+    (UPLOAD_MAX_FOTO_BYTES, UPLOAD_MAX_FOTOS_REQUEST_BYTES).
     """
+    formulario = await recibir_formulario(request, LIMITES_FOTOS)
+    try:
+        archivos = formulario.archivos_de("archivos")
+        descripciones = formulario.campos.get("descripciones", [])
+        if not archivos:
+            raise HTTPException(status_code=400, detail="Debe enviar al menos una foto (campo 'archivos').")
+        return await asyncio.to_thread(_procesar_subida_fotos, id_denuncia, archivos, descripciones, db)
+    finally:
+        await asyncio.to_thread(formulario.limpiar)
+
+def _procesar_subida_fotos(id_denuncia: int, archivos: List[ArchivoEnStaging], descripciones: List[str], db: Session):
     # Validación robusta para evitar problemas futuros con el frontend
     # Si descripciones llega como un solo string (por error del cliente), intentar decodificar como JSON o dividir solo por saltos de línea
     if len(descripciones) == 1 and len(archivos) > 1:
@@ -170,6 +239,7 @@ def subir_fotos_denuncia(
         raise HTTPException(status_code=400, detail="Debe enviar una descripción por cada foto (campos 'descripciones' y 'archivos' deben tener la misma cantidad de elementos).")
     start = time.perf_counter()
     resultado = foto_service.subir_fotos_denuncia(db, id_denuncia, archivos, descripciones)
+    invalidar_denuncia(id_denuncia)
     try:
         processed = int(resultado.get("fotos_procesadas", 0))
         associated = int(resultado.get("fotos_asociadas", 0))
@@ -182,6 +252,108 @@ def subir_fotos_denuncia(
               duration_ms=int((time.perf_counter()-start)*1000))
     return SubidaFotosResponse(**resultado)
 
+# --- Subidas reanudables (services.subidas) ---
+
+def _estado_subida(sesion: subidas.SesionSubida, response: Optional[Response] = None) -> SubidaEstado:
+    offset = sesion.offset()
+    if response is not None:
+        response.headers["Upload-Offset"] = str(offset)
+    return SubidaEstado(
+        id_subida=sesion.id_subida,
+        tipo=sesion.tipo,
+        nombre=sesion.nombre,
+        tamano=sesion.tamano,
+        offset=offset,
+        completa=offset == sesion.tamano
+    )
+
+@router.post("/subidas", response_model=SubidaEstado, status_code=201, dependencies=[Depends(verificar_token)])
+def crear_subida(datos: CrearSubidaRequest, response: Response, db: Session = Depends(get_db)):
+    """
+    Crea una sesión de subida reanudable para una foto o un archivo GPX.
+    
+    Flujo:
+    1. POST /evidencias/subidas -> id_subida
+    2. PUT /evidencias/subidas/{id_subida} con Content-Range: bytes inicio-fin/total (uno o varios rangos)
+    3. Si la conexión se corta: GET /evidencias/subidas/{id_subida} entrega el offset recibido; reanudar desde ahí
+    4. POST /evidencias/subidas/finalizar con los ids completos (fotos de una misma denuncia, o un GPX):
+       se procesan igual que en /upload_fotos y /upload_gpx
+    """
+    denuncia = db.query(Denuncia).filter(Denuncia.id_denuncia == datos.id_denuncia).first()
+    if not denuncia:
+        raise HTTPException(status_code=404, detail="Denuncia no encontrada")
+    if datos.tipo == "gpx" and datos.utc_offset is None:
+        raise HTTPException(status_code=400, detail="Las subidas GPX requieren utc_offset")
+    limites = LIMITES_GPX if datos.tipo == "gpx" else LIMITES_FOTOS
+    sesion = subidas.crear_sesion(
+        datos.tipo, datos.id_denuncia, datos.nombre, datos.tamano, limites,
+        content_type=datos.content_type, descripcion=datos.descripcion, utc_offset=datos.utc_offset
+    )
+    return _estado_subida(sesion, response)
+
+@router.get("/subidas/{id_subida}", response_model=SubidaEstado, dependencies=[Depends(verificar_token)])
+def estado_subida(id_subida: str, response: Response):
+    """Offset recibido de una subida reanudable (también en la cabecera Upload-Offset)."""
+    return _estado_subida(subidas.leer_sesion(id_subida), response)
+
+@router.put("/subidas/{id_subida}", response_model=SubidaEstado, dependencies=[Depends(verificar_token)])
+async def enviar_rango_subida(id_subida: str, request: Request, response: Response):
+    """
+    Recibe un rango de bytes (cuerpo binario, cabecera Content-Range). El rango debe
+    comenzar en el offset actual; si no, responde 409 con el offset esperado.
+    """
+    sesion = subidas.leer_sesion(id_subida)
+    inicio, fin = subidas.parsear_content_range(request.headers.get("content-range"), sesion)
+    limites = LIMITES_GPX if sesion.tipo == "gpx" else LIMITES_FOTOS
+    await subidas.escribir_rango(sesion, inicio, fin, request.stream(), limites)
+    return _estado_subida(sesion, response)
+
+@router.delete("/subidas/{id_subida}", status_code=204, dependencies=[Depends(verificar_token)])
+def cancelar_subida(id_subida: str):
+    """Descarta una subida reanudable y lo recibido hasta ahora."""
+    subidas.eliminar_sesion(subidas.leer_sesion(id_subida))
+    return Response(status_code=204)
+
+@router.post("/subidas/finalizar", dependencies=[Depends(verificar_token)])
+async def finalizar_subidas(datos: FinalizarSubidasRequest, db: Session = Depends(get_db)):
+    """
+    Procesa subidas completas: varias fotos de una misma denuncia (como /upload_fotos)
+    o un archivo GPX (como /upload_gpx). Las sesiones se eliminan al terminar con éxito;
+    si el procesamiento falla se conservan para reintentar sin volver a enviar bytes.
+    """
+    ids = list(dict.fromkeys(datos.ids))
+    # Mismos límites que una subida multipart de fotos
+    if len(ids) > LIMITES_FOTOS.max_archivos:
+        raise HTTPException(status_code=413, detail=f"Máximo {LIMITES_FOTOS.max_archivos} archivos por solicitud")
+    sesiones = [subidas.leer_sesion(i) for i in ids]
+    if len({s.tipo for s in sesiones}) > 1 or len({s.id_denuncia for s in sesiones}) > 1:
+        raise HTTPException(status_code=400, detail="Las subidas a finalizar deben ser del mismo tipo y denuncia")
+    id_denuncia = sesiones[0].id_denuncia
+    
+    if sesiones[0].tipo == "gpx":
+        if len(sesiones) != 1:
+            raise HTTPException(status_code=400, detail="Se finaliza un archivo GPX a la vez")
+        sesion = sesiones[0]
+        archivo = await asyncio.to_thread(subidas.archivo_completo, sesion, "archivo_gpx", LIMITES_GPX)
+        formulario = FormularioEnStaging(
+            campos={"id_denuncia": [str(id_denuncia)], "utc_offset": [str(sesion.utc_offset)]},
+            archivos=[archivo]
+        )
+        resultado = await _procesar_subida_gpx(formulario, db)
+    else:
+        if sum(sesion.tamano for sesion in sesiones) > LIMITES_FOTOS.max_total:
+            raise HTTPException(status_code=413, detail=f"La solicitud supera el máximo de {LIMITES_FOTOS.max_total} bytes")
+        archivos = [
+            await asyncio.to_thread(subidas.archivo_completo, sesion, "archivos", LIMITES_FOTOS)
+            for sesion in sesiones
+        ]
+        descripciones = [sesion.descripcion or "" for sesion in sesiones]
+        resultado = await asyncio.to_thread(_procesar_subida_fotos, id_denuncia, archivos, descripciones, db)
+    
+    for sesion in sesiones:
+        await asyncio.to_thread(subidas.eliminar_sesion, sesion)
+    return resultado
+
 @router.get("/fotos/{id_denuncia}", response_model=ListaFotosResponse, dependencies=[Depends(verificar_token)])
 def listar_fotos_denuncia(id_denuncia: int, db: Session = Depends(get_db)):
     """
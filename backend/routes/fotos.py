@@ -0,0 +1,88 @@
+"""
+Archivos estáticos de fotos (/fotos) con derivados redimensionados bajo demanda.
+
+    /fotos/denuncia_1/foto.jpg                 -> original
+    /fotos/denuncia_1/foto.jpg?w=320&fmt=webp  -> derivado (lado mayor 320px, WebP)
+
+Los derivados se generan en la primera solicitud y se sirven desde la cache en
+disco (services.foto_derivados). Las fotos se guardan con el sha256 de su
+contenido como nombre, así que tanto originales como derivados de esos nombres
+se sirven con cabeceras immutable.
+"""
+import asyncio
+import logging
+import os
+import re
+from pathlib import Path
+from starlette.background import BackgroundTask
+from starlette.datastructures import QueryParams
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from config import FOTO_DERIVADOS_ANCHOS
+from services.foto_derivados import FORMATOS_DERIVADO, ancho_permitido, derivado_bajo_demanda, derivados_cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_CONTROL_INMUTABLE = "public, max-age=31536000, immutable"
+
+# Fotos direccionadas por contenido (services.foto_service): <sha256>.jpg|png
+NOMBRE_POR_CONTENIDO = re.compile(r"^[0-9a-f]{64}\.(jpg|png)$")
+
+# Solo se sirven imágenes: cualquier otro archivo en la carpeta (índices, temporales) da 404
+EXTENSIONES_SERVIDAS = {".jpg", ".jpeg", ".png"}
+
+
+def _es_inmutable(path: str) -> bool:
+    return bool(NOMBRE_POR_CONTENIDO.match(os.path.basename(path)))
+
+
+class FotosStaticFiles(StaticFiles):
+    """StaticFiles que atiende ?w= y ?fmt= con derivados cacheados."""
+
+    async def get_response(self, path: str, scope) -> Response:
+        if os.path.splitext(path)[1].lower() not in EXTENSIONES_SERVIDAS:
+            raise HTTPException(status_code=404)
+        params = QueryParams(scope.get("query_string", b""))
+        if "w" not in params and "fmt" not in params:
+            response = await super().get_response(path, scope)
+            if response.status_code in (200, 304) and _es_inmutable(path):
+                response.headers["Cache-Control"] = CACHE_CONTROL_INMUTABLE
+            return response
+
+        fmt = params.get("fmt", "jpeg").lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in FORMATOS_DERIVADO:
+            raise HTTPException(status_code=400, detail=f"Formato no soportado: {fmt}")
+        try:
+            # Sin w se usa el mayor tamaño permitido
+            ancho = int(params.get("w", str(max(FOTO_DERIVADOS_ANCHOS))))
+        except ValueError:
+            ancho = 0
+        if ancho <= 0:
+            raise HTTPException(status_code=400, detail="El parámetro w debe ser un entero positivo")
+        ancho = ancho_permitido(ancho)
+
+        full_path, stat_result = await asyncio.to_thread(self.lookup_path, path)
+        if stat_result is None or not os.path.isfile(full_path):
+            raise HTTPException(status_code=404)
+
+        try:
+            derivado = await asyncio.to_thread(derivado_bajo_demanda, Path(full_path), ancho, fmt)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+        except Exception as e:
+            logger.warning(f"No se pudo generar derivado de {path} ({ancho}px, {fmt}): {e}")
+            raise HTTPException(status_code=415, detail="No se pudo generar el derivado de la imagen")
+
+        response = self.file_response(str(derivado), os.stat(derivado), scope)
+        # El derivado es un enlace retenido (la cache puede expulsarlo durante el envío)
+        response.background = BackgroundTask(derivados_cache.liberar, derivado)
+        response.headers["Content-Type"] = FORMATOS_DERIVADO[fmt][2]
+        if _es_inmutable(path):
+            response.headers["Cache-Control"] = CACHE_CONTROL_INMUTABLE
+        else:
+            # Nombres antiguos (no por contenido): el original podría reemplazarse
+            response.headers["Cache-Control"] = "public, max-age=86400"
+        return response
@@ -1,4 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
 from sqlalchemy import text, func
 from db import SessionLocal
@@ -7,6 +9,8 @@ from models.evidencias import Evidencia
 from models.concesiones import Concesion
 from models.analisis import AnalisisDenuncia, ResultadoAnalisis
 from security.auth import verificar_token
+from services.artifact_cache import export_cache
+from services import kml_regionado
 from typing import List, Optional
 import json
 import logging
@@ -545,3 +549,46 @@ def obtener_estadisticas_mapa(
     except Exception as e:
         logger.error(f"Error cargando estadísticas para mapa: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
+
+@router.get("/export/regionado.kmz", dependencies=[Depends(verificar_token)])
+def exportar_kml_regionado(db: Session = Depends(get_db)):
+    """
+    Exporta concesiones y denuncias como KMZ regionado (super-overlay) para Google Earth.
+    Se regenera solo si cambiaron los datos.
+    """
+    start = time.perf_counter()
+    
+    try:
+        key = f"regionado_{kml_regionado.huella_capas(db)}"
+        # Enlace retenido: otro worker podría expulsar la entrada durante el envío
+        path = export_cache.retener(key, "kmz")
+        cache_hit = path is not None
+        resumen = None
+        
+        if not cache_hit:
+            capas = [kml_regionado.cargar_concesiones(db), kml_regionado.cargar_denuncias(db)]
+            tmp_path = export_cache.temporal()
+            try:
+                with open(tmp_path, "wb") as destino:
+                    resumen = kml_regionado.escribir_kmz(destino, capas)
+                path = export_cache.put_file(key, "kmz", tmp_path, retener=True)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+        
+        duration_ms = int((time.perf_counter() - start) * 1000)
+        log_event(logger, "INFO", "map_kml_regionado_exported",
+                  cache_hit=cache_hit, tiles=resumen, output_bytes=path.stat().st_size,
+                  duration_ms=duration_ms)
+        
+        return FileResponse(
+            path=path,
+            media_type="application/vnd.google-earth.kmz",
+            filename="playas_limpias_regionado.kmz",
+            headers={"ETag": f'"{key}"', "Cache-Control": "private, no-cache"},
+            background=BackgroundTask(export_cache.liberar, path)
+        )
+        
+    except Exception as e:
+        logger.error(f"Error exportando KML regionado: {e}")
+        raise HTTPException(status_code=500, detail="Error interno del servidor")
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.orm import Session
 from db import SessionLocal
 from models.usuarios import Usuario
 from schemas.usuarios import UsuarioCreate, UsuarioResponse
 from security.auth import verificar_token
-from typing import List
+from services.paginacion import decodificar_cursor, limite_pagina, paginar
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -27,9 +28,19 @@ def crear_usuario(usuario: UsuarioCreate, db: Session = Depends(get_db)):
     return nuevo_usuario
 
 @router.get("/", response_model=List[UsuarioResponse], dependencies=[Depends(verificar_token)])
-def listar_usuarios(id_usuario: int = Query(None), db: Session = Depends(get_db)):
+def listar_usuarios(
+    response: Response,
+    id_usuario: int = Query(None),
+    cursor: Optional[str] = Query(None, description="Cursor opaco de la página siguiente (cabecera X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Tamaño de página"),
+    db: Session = Depends(get_db)
+):
     if id_usuario is not None:
-        usuarios = db.query(Usuario).filter(Usuario.id_usuario == id_usuario).all()
-    else:
-        usuarios = db.query(Usuario).all()
-    return usuarios
+        return db.query(Usuario).filter(Usuario.id_usuario == id_usuario).all()
+    limit = limite_pagina(limit)
+    query = db.query(Usuario)
+    posicion = decodificar_cursor(cursor, 1)
+    if posicion:
+        query = query.filter(Usuario.id_usuario > posicion[0])
+    usuarios = query.order_by(Usuario.id_usuario).limit(limit + 1).all()
+    return paginar(usuarios, limit, response, lambda u: (u.id_usuario,))
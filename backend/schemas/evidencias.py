@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal
 from datetime import date, time
 
 class EvidenciaCreateGeoJSON(BaseModel):
@@ -34,8 +34,28 @@ class FotoInfo(BaseModel):
     descripcion: Optional[str]
     fecha: date
     hora: time
-    coordenadas: Dict[str, float]
+    coordenadas: Dict[str, Optional[float]]
 
 class ListaFotosResponse(BaseModel):
     fotos: List[FotoInfo]
     total: int
+
+class CrearSubidaRequest(BaseModel):
+    tipo: Literal["foto", "gpx"]
+    id_denuncia: int
+    nombre: str = Field(..., description="Nombre del archivo (con extensión)")
+    tamano: int = Field(..., gt=0, description="Tamaño total en bytes")
+    content_type: Optional[str] = None
+    descripcion: Optional[str] = Field(None, description="Descripción de la foto (tipo 'foto')")
+    utc_offset: Optional[int] = Field(None, description="Diferencia horaria de los timestamps (tipo 'gpx')")
+
+class SubidaEstado(BaseModel):
+    id_subida: str
+    tipo: str
+    nombre: str
+    tamano: int
+    offset: int
+    completa: bool
+
+class FinalizarSubidasRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, description="Sesiones completas a procesar (fotos de una misma denuncia, o un GPX)")
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import Dict, Optional
+from fastapi import HTTPException, Request, status
+from config_auth import RATE_LIMIT_AUTH_REQUESTS, RATE_LIMIT_AUTH_WINDOW
+
+
+class _Bucket:
+    """Estado de un token bucket: tokens disponibles y último refill."""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """
+    Rate limiter en memoria (token bucket) por clave.
+
+    - Memoria O(1) por clave: solo se guarda (tokens, timestamp).
+    - Los buckets que vuelven a estar llenos se eliminan en un barrido periódico,
+      así el diccionario no crece con IPs/emails que ya no consultan.
+    - Es por proceso: con varios workers cada uno aplica su propio límite.
+    """
+
+    def __init__(self, max_requests: int, window_seconds: float):
+        self.capacity = float(max_requests)
+        self.window = float(window_seconds)
+        self.refill_rate = self.capacity / self.window
+        self._buckets: Dict[str, _Bucket] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self.window
+
+    def _refill(self, bucket: _Bucket, now: float) -> None:
+        elapsed = now - bucket.updated
+        if elapsed > 0:
+            bucket.tokens = min(self.capacity, bucket.tokens + elapsed * self.refill_rate)
+            bucket.updated = now
+
+    def _sweep(self, now: float) -> None:
+        """Elimina buckets inactivos (ya recargados por completo)."""
+        expirados = [k for k, b in self._buckets.items() if now - b.updated >= self.window]
+        for key in expirados:
+            del self._buckets[key]
+        self._next_sweep = now + self.window
+
+    def hit(self, *keys: str) -> Optional[float]:
+        """
+        Consume un token de cada clave.
+
+        Returns:
+            None si se permite la solicitud, o los segundos a esperar si alguna
+            clave no tiene tokens (en ese caso no se consume ninguno).
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            buckets = []
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = _Bucket(self.capacity, now)
+                    self._buckets[key] = bucket
+                else:
+                    self._refill(bucket, now)
+                buckets.append(bucket)
+
+            faltante = max((1.0 - b.tokens for b in buckets), default=0.0)
+            if faltante > 0:
+                return faltante / self.refill_rate
+
+            for bucket in buckets:
+                bucket.tokens -= 1.0
+            return None
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+auth_rate_limiter = RateLimiter(RATE_LIMIT_AUTH_REQUESTS, RATE_LIMIT_AUTH_WINDOW)
+
+
+def verificar_rate_limit_auth(request: Request, email: str) -> None:
+    """
+    Aplica el límite de intentos de autenticación por IP y por email.
+    Debe llamarse antes de cualquier consulta o hashing de contraseña.
+    """
+    client_ip = request.client.host if request.client else "-"
+    retry_after = auth_rate_limiter.hit(f"ip:{client_ip}", f"email:{email.strip().lower()}")
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Demasiados intentos. Intente nuevamente más tarde.",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
@@ -0,0 +1,173 @@
+"""
+Carga compartida de los datos de un análisis para los exportadores (PDF, KMZ y
+mapa estático).
+
+Las filas se materializan como dataclasses con `__slots__` en lugar de objetos
+ORM o clases creadas con `type()` por fila: menos memoria por fila y sin costo
+de creación de clases en exportaciones grandes.
+"""
+import math
+from dataclasses import dataclass, field
+from datetime import date, time
+from typing import Any, Dict, List, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from models.analisis import AnalisisDenuncia
+from models.denuncias import Denuncia
+from models.estados import EstadoDenuncia
+from models.usuarios import Usuario
+from services.geoprocessing.codec import a_geojson, decodificar, puntos_lonlat
+from shapely.geometry import mapping
+
+
+@dataclass(slots=True)
+class EvidenciaDTO:
+    id_evidencia: int
+    id_denuncia: int
+    lon: Optional[float]
+    lat: Optional[float]
+    descripcion: Optional[str]
+    foto_url: Optional[str]
+    fecha: Optional[date]
+    hora: Optional[time]
+
+    @property
+    def coordenadas(self) -> Optional[Dict[str, Any]]:
+        """Punto en formato GeoJSON (como lo esperan los generadores)."""
+        if self.lon is None or self.lat is None:
+            return None
+        return {"type": "Point", "coordinates": [self.lon, self.lat]}
+
+
+@dataclass(slots=True)
+class ResultadoDTO:
+    id_concesion: int
+    interseccion_valida: Optional[bool]
+    distancia_minima: Optional[float]
+
+
+@dataclass(slots=True)
+class ConcesionDTO:
+    id_concesion: int
+    codigo_centro: Optional[int]
+    nombre: Optional[str]
+    titular: Optional[str]
+    tipo: Optional[str]
+    region: Optional[str]
+    interseccion_valida: Optional[bool]
+    geom: Optional[Dict[str, Any]]  # GeoJSON
+
+
+@dataclass(slots=True)
+class DatosAnalisis:
+    analisis: AnalisisDenuncia
+    denuncia: Optional[Denuncia]
+    usuario: Optional[Usuario]
+    estado: Optional[EstadoDenuncia]
+    buffer_geom: Optional[Dict[str, Any]]  # GeoJSON
+    evidencias: List[EvidenciaDTO] = field(default_factory=list)
+    resultados: List[ResultadoDTO] = field(default_factory=list)
+    concesiones: List[ConcesionDTO] = field(default_factory=list)
+
+    @property
+    def id_denuncia(self) -> int:
+        return self.analisis.id_denuncia
+
+
+def _float(valor) -> Optional[float]:
+    return None if valor is None else float(valor)
+
+
+def cargar_evidencias(db: Session, id_denuncia: int) -> List[EvidenciaDTO]:
+    """Carga las evidencias de una denuncia decodificando las coordenadas en bloque."""
+    filas = db.execute(text("""
+        SELECT id_evidencia, id_denuncia, coordenadas, descripcion, foto_url, fecha, hora
+        FROM evidencias
+        WHERE id_denuncia = :id_denuncia
+        ORDER BY id_evidencia
+    """), {"id_denuncia": id_denuncia}).fetchall()
+
+    lon, lat = puntos_lonlat(f.coordenadas for f in filas)
+    evidencias = []
+    for fila, x, y in zip(filas, lon.tolist(), lat.tolist()):
+        valida = not (math.isnan(x) or math.isnan(y))  # NaN si la geometría es nula
+        evidencias.append(EvidenciaDTO(
+            id_evidencia=fila.id_evidencia,
+            id_denuncia=fila.id_denuncia,
+            lon=x if valida else None,
+            lat=y if valida else None,
+            descripcion=fila.descripcion,
+            foto_url=fila.foto_url,
+            fecha=fila.fecha,
+            hora=fila.hora,
+        ))
+    return evidencias
+
+
+def cargar_datos_analisis(db: Session, id_analisis: int) -> Optional[DatosAnalisis]:
+    """
+    Carga el análisis, su denuncia, evidencias, resultados y concesiones
+    intersectadas (con geometría) en un número constante de consultas.
+
+    Returns:
+        DatosAnalisis, o None si el análisis no existe
+    """
+    analisis = db.query(AnalisisDenuncia).filter(
+        AnalisisDenuncia.id_analisis == id_analisis
+    ).first()
+    if not analisis:
+        return None
+
+    denuncia = db.get(Denuncia, analisis.id_denuncia)
+    usuario = db.get(Usuario, denuncia.id_usuario) if denuncia and denuncia.id_usuario else None
+    estado = db.get(EstadoDenuncia, denuncia.id_estado) if denuncia and denuncia.id_estado else None
+
+    filas = db.execute(text("""
+        SELECT
+            r.id_concesion,
+            r.interseccion_valida,
+            r.distancia_minima,
+            c.codigo_centro,
+            c.nombre,
+            c.titular,
+            c.tipo,
+            c.region,
+            c.geom
+        FROM resultado_analisis r
+        LEFT JOIN concesiones c ON r.id_concesion = c.id_concesion
+        WHERE r.id_analisis = :id_analisis
+        ORDER BY r.id_resultado
+    """), {"id_analisis": id_analisis}).fetchall()
+
+    resultados = []
+    concesiones = []
+    geometrias = decodificar(f.geom for f in filas)
+    for fila, geom in zip(filas, geometrias):
+        resultados.append(ResultadoDTO(
+            id_concesion=fila.id_concesion,
+            interseccion_valida=fila.interseccion_valida,
+            distancia_minima=_float(fila.distancia_minima),
+        ))
+        if fila.titular is None and geom is None:
+            continue  # concesión inexistente (LEFT JOIN sin match)
+        concesiones.append(ConcesionDTO(
+            id_concesion=fila.id_concesion,
+            codigo_centro=fila.codigo_centro,
+            nombre=fila.nombre,
+            titular=fila.titular,
+            tipo=fila.tipo,
+            region=fila.region,
+            interseccion_valida=fila.interseccion_valida,
+            geom=mapping(geom) if geom is not None and not geom.is_empty else None,
+        ))
+
+    return DatosAnalisis(
+        analisis=analisis,
+        denuncia=denuncia,
+        usuario=usuario,
+        estado=estado,
+        buffer_geom=a_geojson(analisis.buffer_geom),
+        evidencias=cargar_evidencias(db, analisis.id_denuncia),
+        resultados=resultados,
+        concesiones=concesiones,
+    )
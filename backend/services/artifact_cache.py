@@ -0,0 +1,220 @@
+"""
+Cache en disco de artefactos exportados (PDF/KMZ) direccionada por contenido.
+
+La clave es una huella (sha256) de todo lo que influye en el documento: fila del
+análisis, resultados, evidencias, mtimes de las fotos y del mapa, y la versión
+del template/generador. Si nada cambió, la descarga se sirve desde disco.
+El directorio es compartido entre workers; la expulsión es LRU por tamaño total
+(el mtime de cada archivo se actualiza en cada acierto).
+
+Como otro worker puede expulsar una entrada en cualquier momento, quien va a
+servir un artefacto lo retiene con un enlace duro privado (retener) y lo
+libera al terminar (liberar): la expulsión borra solo el nombre de la cache.
+"""
+import hashlib
+import json
+import logging
+import os
+import secrets
+import tempfile
+import time
+import threading
+from pathlib import Path
+from typing import Any, Iterable, Optional
+from config import EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES, FOTOS_DIR
+from services.map_generator import ruta_mapa_analisis
+
+logger = logging.getLogger(__name__)
+
+# Subir al cambiar la salida de los generadores sin cambiar el template
+EXPORT_FORMAT_VERSION = {"pdf": 3, "kmz": 3}
+
+# Temporales/enlaces huérfanos (worker caído) más antiguos que esto se eliminan al expulsar
+TEMPORAL_MAX_EDAD_S = 24 * 3600
+
+TEMPLATE_PDF = Path(__file__).parent.parent / "templates" / "pdf" / "inspection_report_basic_only.html"
+
+
+def ruta_foto(foto_url: str) -> Path:
+    """Ruta local de una foto a partir de su foto_url (/fotos/... o fotos/...)."""
+    url = foto_url.strip()
+    if url.startswith('/fotos/'):
+        url = url[7:]
+    elif url.startswith('fotos/'):
+        url = url[6:]
+    return Path(FOTOS_DIR) / url.lstrip('/')
+
+
+def _stat(path: Path) -> Optional[list]:
+    try:
+        st = path.stat()
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+
+def _json_default(valor: Any):
+    if hasattr(valor, "isoformat"):
+        return valor.isoformat()
+    return str(valor)
+
+
+def huella_analisis(datos, tipo: str, extras: Iterable[Any] = ()) -> str:
+    """
+    Calcula la huella de un export a partir de DatosAnalisis.
+
+    Args:
+        datos: DatosAnalisis (services.analisis_datos)
+        tipo: 'pdf' o 'kmz'
+        extras: valores adicionales que afectan la salida
+    """
+    analisis = datos.analisis
+    denuncia = datos.denuncia
+    partes = {
+        "tipo": tipo,
+        "version": EXPORT_FORMAT_VERSION.get(tipo, 0),
+        "analisis": [analisis.id_analisis, analisis.id_denuncia, analisis.fecha_analisis,
+                     analisis.distancia_buffer, analisis.metodo, analisis.observaciones],
+        "buffer": datos.buffer_geom,
+        "resultados": [[r.id_concesion, r.interseccion_valida, r.distancia_minima] for r in datos.resultados],
+        "concesiones": [[c.id_concesion, c.codigo_centro, c.nombre, c.titular, c.tipo, c.region]
+                        for c in datos.concesiones],
+        "evidencias": [[e.id_evidencia, e.lon, e.lat, e.descripcion, e.foto_url, e.fecha, e.hora]
+                       for e in datos.evidencias],
+        "fotos": [_stat(ruta_foto(e.foto_url)) for e in datos.evidencias if e.foto_url],
+        "extras": list(extras),
+    }
+    if tipo == "pdf":
+        partes["denuncia"] = [denuncia.id_denuncia, denuncia.lugar, denuncia.fecha_inspeccion,
+                              denuncia.fecha_ingreso, denuncia.observaciones] if denuncia else None
+        partes["usuario"] = datos.usuario.nombre if datos.usuario else None
+        partes["estado"] = datos.estado.estado if datos.estado else None
+        partes["template"] = _stat(TEMPLATE_PDF)
+        partes["mapa"] = _stat(ruta_mapa_analisis(analisis.id_denuncia, analisis.id_analisis))
+
+    payload = json.dumps(partes, default=_json_default, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ArtifactCache:
+    """Archivos `<huella>.<ext>` en un directorio, con tope de tamaño total (LRU)."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key: str, ext: str) -> Path:
+        return self.directory / f"{key}.{ext}"
+
+    def get(self, key: str, ext: str) -> Optional[Path]:
+        """Retorna la ruta del artefacto si existe (y lo marca como usado)."""
+        path = self._path(key, ext)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _enlazar(self, path: Path) -> Path:
+        """Enlace duro privado a `path` (nombre .tmp, ignorado por la expulsión)."""
+        enlace = self.directory / f"{secrets.token_hex(16)}.tmp"
+        os.link(path, enlace)
+        return enlace
+
+    def retener(self, key: str, ext: str) -> Optional[Path]:
+        """
+        Como get(), pero retorna un enlace duro privado al artefacto, válido
+        aunque la entrada se expulse mientras se envía. Liberar con liberar().
+        """
+        path = self.get(key, ext)
+        if path is None:
+            return None
+        try:
+            return self._enlazar(path)
+        except FileNotFoundError:
+            # Expulsado entre get() y el enlace
+            return None
+
+    @staticmethod
+    def liberar(enlace: Path) -> None:
+        """Elimina un enlace obtenido con retener() o put_file(retener=True)."""
+        try:
+            os.unlink(enlace)
+        except OSError:
+            pass
+
+    def put(self, key: str, ext: str, data: bytes) -> Path:
+        """Guarda el artefacto de forma atómica y aplica la expulsión por tamaño."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key, ext)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._expulsar(proteger=path)
+        return path
+
+    def temporal(self) -> Path:
+        """Crea un archivo temporal dentro del directorio (para generar directo a disco)."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return Path(tmp_path)
+
+    def put_file(self, key: str, ext: str, origen: Path, retener: bool = False) -> Path:
+        """
+        Mueve un archivo generado en `temporal()` a la cache (sin copiarlo a memoria).
+
+        Con retener=True retorna un enlace privado (ver retener()) en vez de la entrada.
+        """
+        path = self._path(key, ext)
+        enlace = self._enlazar(origen) if retener else None
+        os.replace(origen, path)
+        self._expulsar(proteger=path)
+        return enlace or path
+
+    def _expulsar(self, proteger: Path) -> None:
+        with self._lock:
+            entradas = []
+            total = 0
+            limite_temporal = time.time() - TEMPORAL_MAX_EDAD_S
+            try:
+                with os.scandir(self.directory) as it:
+                    for entry in it:
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                        if entry.name.endswith(".tmp"):
+                            if st.st_mtime < limite_temporal:
+                                self.liberar(Path(entry.path))
+                            continue
+                        total += st.st_size
+                        entradas.append((st.st_mtime, st.st_size, entry.path))
+            except OSError as e:
+                logger.warning(f"No se pudo recorrer la cache de exportaciones: {e}")
+                return
+
+            if total <= self.max_bytes:
+                return
+            entradas.sort()
+            for _, size, path in entradas:
+                if total <= self.max_bytes:
+                    break
+                if path == str(proteger):
+                    continue
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+export_cache = ArtifactCache(EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES)
@@ -0,0 +1,267 @@
+"""
+Generación de artefactos de exportación (PDF/KMZ) de un análisis con cache en
+disco: si la huella del análisis no cambió se reutiliza el archivo ya generado.
+Los artefactos se generan directo a un archivo temporal de la cache (o al
+cliente, en el caso del KMZ en streaming), sin armarlos completos en memoria.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Sequence, Union
+from config import PDF_CHUNK_EVIDENCIAS, BULK_EXPORT_CONCURRENCY
+from db import SessionLocal
+from services.analisis_datos import DatosAnalisis, cargar_datos_analisis
+from services.artifact_cache import export_cache, huella_analisis
+from services.kmz_generator import KMZGenerator
+from services.pdf_generator import PDFGenerator
+from services.pdf_pool import PDFPoolOcupado
+from services.streaming import stream_desde_hilo
+
+logger = logging.getLogger(__name__)
+
+pdf_generator = PDFGenerator()
+kmz_generator = KMZGenerator()
+
+
+@dataclass(slots=True)
+class Artefacto:
+    """Artefacto en disco; `path` es un enlace retenido que se libera con export_cache.liberar."""
+    path: Path
+    etag: str
+    cache_hit: bool
+
+    @property
+    def size(self) -> int:
+        return self.path.stat().st_size
+
+
+@dataclass(slots=True)
+class ArtefactoStream:
+    """Artefacto que se está generando: se envía por bloques a medida que se produce."""
+    etag: str
+    bloques: AsyncIterator[bytes]
+
+
+async def exportar_pdf(datos: DatosAnalisis) -> Artefacto:
+    """Retorna el PDF del análisis desde la cache o lo genera directo en la cache."""
+    key = huella_analisis(datos, "pdf", extras=(PDF_CHUNK_EVIDENCIAS,))
+    path = export_cache.retener(key, "pdf")
+    if path is not None:
+        return Artefacto(path, key, True)
+
+    tmp_path = export_cache.temporal()
+    try:
+        await pdf_generator.generate_analysis_pdf_file(
+            tmp_path,
+            analisis=datos.analisis,
+            denuncia=datos.denuncia,
+            evidencias=datos.evidencias,
+            resultados=datos.resultados,
+            concesiones=datos.concesiones,
+            usuario=datos.usuario,
+            estado=datos.estado
+        )
+        path = export_cache.put_file(key, "pdf", tmp_path, retener=True)
+    except BaseException:
+        _descartar(tmp_path)
+        raise
+    return Artefacto(path, key, False)
+
+
+def _advertir_concesiones_sin_geometria(datos: DatosAnalisis) -> None:
+    for concesion in datos.concesiones:
+        if not concesion.geom:
+            logger.warning(f"Concesión {concesion.id_concesion}: sin geometría")
+
+
+async def exportar_kmz(datos: DatosAnalisis) -> Artefacto:
+    """Retorna el KMZ del análisis desde la cache o lo genera directo en la cache."""
+    key = huella_analisis(datos, "kmz")
+    path = export_cache.retener(key, "kmz")
+    if path is not None:
+        return Artefacto(path, key, True)
+
+    _advertir_concesiones_sin_geometria(datos)
+    tmp_path = export_cache.temporal()
+    try:
+        def _escribir():
+            with open(tmp_path, "wb") as destino:
+                kmz_generator.escribir_kmz(destino, datos.analisis, datos.evidencias,
+                                           datos.concesiones, datos.buffer_geom)
+        await asyncio.to_thread(_escribir)
+        path = export_cache.put_file(key, "kmz", tmp_path, retener=True)
+    except BaseException:
+        _descartar(tmp_path)
+        raise
+    return Artefacto(path, key, False)
+
+
+async def exportar_kmz_stream(datos: DatosAnalisis) -> Union[Artefacto, ArtefactoStream]:
+    """
+    Como exportar_kmz, pero si no está en cache no espera a tener el archivo
+    completo: retorna un stream que se envía al cliente mientras se genera y que
+    se guarda en la cache al terminar (si el cliente corta, se descarta).
+    """
+    key = huella_analisis(datos, "kmz")
+    path = export_cache.retener(key, "kmz")
+    if path is not None:
+        return Artefacto(path, key, True)
+
+    _advertir_concesiones_sin_geometria(datos)
+    bloques = kmz_generator.stream_analysis_kmz(
+        analisis=datos.analisis,
+        evidencias=datos.evidencias,
+        concesiones=datos.concesiones,
+        buffer_geom=datos.buffer_geom
+    )
+    return ArtefactoStream(key, _guardar_mientras_envia(key, "kmz", bloques))
+
+
+async def _guardar_mientras_envia(key: str, ext: str, bloques: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    tmp_path = export_cache.temporal()
+    completo = False
+    try:
+        with open(tmp_path, "wb") as destino:
+            async for bloque in bloques:
+                destino.write(bloque)
+                yield bloque
+        export_cache.put_file(key, ext, tmp_path)
+        completo = True
+    finally:
+        await bloques.aclose()
+        if not completo:
+            _descartar(tmp_path)
+
+
+def _descartar(tmp_path: Path) -> None:
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+
+
+EXPORTADORES = {"pdf": exportar_pdf, "kmz": exportar_kmz}
+
+_FIN_LOTE = object()
+
+
+def _cargar_datos(id_analisis: int) -> Optional[DatosAnalisis]:
+    # Sesión propia: el lote se exporta mientras se envía la respuesta
+    db = SessionLocal()
+    try:
+        return cargar_datos_analisis(db, id_analisis)
+    finally:
+        db.close()
+
+
+async def _exportar_con_reintentos(formato: str, datos: DatosAnalisis, intentos: int = 3) -> Artefacto:
+    """Exporta un artefacto reintentando si el pool de PDF está momentáneamente lleno."""
+    for intento in range(intentos):
+        try:
+            return await EXPORTADORES[formato](datos)
+        except PDFPoolOcupado:
+            if intento == intentos - 1:
+                raise
+            await asyncio.sleep(1 + intento)
+
+
+async def exportar_lote(ids_analisis: List[int], formatos: Sequence[str]) -> AsyncIterator[bytes]:
+    """
+    Exporta varios análisis a un único ZIP enviado en streaming.
+
+    Los artefactos se generan en paralelo (hasta BULK_EXPORT_CONCURRENCY análisis
+    a la vez; los PDF en el pool de procesos) reutilizando la cache, y cada uno se
+    agrega al ZIP apenas está listo, en orden de término. Los que fallan se
+    listan en `errores.txt` dentro del ZIP.
+
+    El ZIP se escribe en el hilo propio de stream_desde_hilo, que espera los
+    artefactos listos sin ocupar el executor por defecto de asyncio.
+
+    Yields:
+        bytes: bloques del archivo ZIP
+    """
+    listos: queue.Queue = queue.Queue()
+    detenido = threading.Event()
+    semaforo = asyncio.Semaphore(max(1, BULK_EXPORT_CONCURRENCY))
+
+    async def _exportar(id_analisis: int) -> None:
+        async with semaforo:
+            try:
+                datos = await asyncio.to_thread(_cargar_datos, id_analisis)
+            except Exception as e:
+                logger.error(f"Error cargando análisis {id_analisis} para exportación masiva: {e}")
+                listos.put((None, f"analisis_{id_analisis}: {e}"))
+                return
+            if datos is None:
+                listos.put((None, f"analisis_{id_analisis}: no encontrado"))
+                return
+            for formato in formatos:
+                nombre = f"{formato}/analisis_{id_analisis}.{formato}"
+                try:
+                    artefacto = await _exportar_con_reintentos(formato, datos)
+                    listos.put((nombre, artefacto.path))
+                except Exception as e:
+                    logger.error(f"Error exportando {nombre}: {e}")
+                    listos.put((None, f"{nombre}: {e}"))
+
+    async def _coordinar() -> None:
+        try:
+            await asyncio.gather(*(_exportar(i) for i in ids_analisis))
+        finally:
+            listos.put(_FIN_LOTE)
+
+    def _siguiente():
+        """Próximo artefacto listo, o _FIN_LOTE si la respuesta se cerró."""
+        while not detenido.is_set():
+            try:
+                return listos.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _FIN_LOTE
+
+    def _escribir_zip(salida) -> None:
+        errores = []
+        agregados = 0
+        with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as zf:
+            while True:
+                item = _siguiente()
+                if item is _FIN_LOTE:
+                    break
+                nombre, valor = item
+                if nombre is None:
+                    errores.append(valor)
+                    continue
+                try:
+                    # El KMZ ya es un zip: no se vuelve a comprimir
+                    compresion = zipfile.ZIP_STORED if nombre.endswith(".kmz") else zipfile.ZIP_DEFLATED
+                    zf.write(valor, nombre, compress_type=compresion)
+                    agregados += 1
+                except OSError as e:
+                    errores.append(f"{nombre}: {e}")
+                finally:
+                    export_cache.liberar(valor)
+            if errores:
+                zf.writestr("errores.txt", "\n".join(errores) + "\n")
+        logger.info(f"Exportación masiva: {agregados} archivos, {len(errores)} errores")
+
+    coordinador = asyncio.ensure_future(_coordinar())
+    bloques = stream_desde_hilo(_escribir_zip)
+    try:
+        async for bloque in bloques:
+            yield bloque
+    finally:
+        # Detener al escritor del ZIP aunque siga esperando artefactos
+        detenido.set()
+        coordinador.cancel()
+        await asyncio.gather(coordinador, return_exceptions=True)
+        await bloques.aclose()
+        # Artefactos que no alcanzaron a agregarse al ZIP (cliente desconectado)
+        while not listos.empty():
+            item = listos.get_nowait()
+            if item is not _FIN_LOTE and item[0] is not None:
+                export_cache.liberar(item[1])
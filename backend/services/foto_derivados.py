@@ -0,0 +1,136 @@
+"""
+Derivados redimensionados de las fotos de evidencias.
+
+Las fotos se almacenan hasta 1920x1080, pero el reporte PDF las dibuja en
+tarjetas de ~200px. Generar (una vez) una versión reducida evita que xhtml2pdf
+decodifique e incruste cada JPEG completo.
+
+Los derivados bajo demanda (/fotos/...?w=320&fmt=webp) se guardan en una cache
+en disco aparte, direccionada por la foto original (ruta, mtime, tamaño) y el
+tamaño/formato pedido, con expulsión LRU por tamaño total.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+from config import (
+    REPORT_PHOTO_MAX_PX, REPORT_PHOTO_QUALITY, FOTO_DERIVADOS_ANCHOS, FOTO_DERIVADOS_QUALITY,
+    FOTO_DERIVADOS_DIR, FOTO_DERIVADOS_MAX_BYTES
+)
+from services.artifact_cache import ArtifactCache
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+CARPETA_REPORTE = "_reporte"
+
+# fmt -> (formato Pillow, extensión, media type)
+FORMATOS_DERIVADO = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+}
+
+derivados_cache = ArtifactCache(FOTO_DERIVADOS_DIR, FOTO_DERIVADOS_MAX_BYTES)
+
+
+def generar_derivado(origen: Path, destino: Path, max_px: int, formato: str = "JPEG", quality: int = 80) -> None:
+    """
+    Escribe en `destino` una copia de `origen` con su lado mayor <= max_px.
+    La escritura es atómica (archivo temporal + rename) para tolerar workers concurrentes.
+    """
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(origen) as imagen:
+        if imagen.format == "JPEG":
+            # Decodificar directamente a escala reducida (1/2, 1/4, 1/8)
+            imagen.draft("RGB", (max_px, max_px))
+        imagen = imagen.convert("RGB")
+        imagen.thumbnail((max_px, max_px), Image.Resampling.LANCZOS)
+
+        fd, tmp_path = tempfile.mkstemp(dir=destino.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                imagen.save(tmp, formato, quality=quality)
+            os.replace(tmp_path, destino)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+def derivado_reporte(ruta_original: Optional[Union[str, Path]]) -> Optional[str]:
+    """
+    Retorna la ruta del derivado para reportes de una foto local, generándolo si
+    no existe o si el original es más reciente. Si algo falla retorna el original.
+    """
+    if not ruta_original:
+        return ruta_original
+    if not PILLOW_AVAILABLE:
+        return str(ruta_original)
+
+    origen = Path(ruta_original)
+    destino = origen.parent / CARPETA_REPORTE / f"{origen.stem}_{REPORT_PHOTO_MAX_PX}.jpg"
+    try:
+        origen_mtime = origen.stat().st_mtime_ns
+        try:
+            if destino.stat().st_mtime_ns >= origen_mtime:
+                return str(destino)
+        except FileNotFoundError:
+            pass
+        generar_derivado(origen, destino, REPORT_PHOTO_MAX_PX, quality=REPORT_PHOTO_QUALITY)
+        logger.debug(f"Derivado de reporte generado: {destino}")
+        return str(destino)
+    except Exception as e:
+        logger.warning(f"No se pudo generar derivado de {origen}: {e}")
+        return str(ruta_original)
+
+
+def ancho_permitido(ancho: int) -> int:
+    """Redondea el ancho pedido al menor tamaño permitido que lo cubre (acota las variantes en cache)."""
+    anchos = sorted(FOTO_DERIVADOS_ANCHOS)
+    for permitido in anchos:
+        if ancho <= permitido:
+            return permitido
+    return anchos[-1]
+
+
+def derivado_bajo_demanda(origen: Path, ancho: int, fmt: str = "jpeg") -> Path:
+    """
+    Retorna la ruta en cache del derivado de `origen` con lado mayor `ancho`
+    (ya normalizado con ancho_permitido) en el formato `fmt`, generándolo si falta.
+    La ruta es un enlace retenido: liberarla con derivados_cache.liberar al terminar.
+
+    Raises:
+        FileNotFoundError: si el original no existe
+        KeyError: si el formato no está soportado
+    """
+    formato, extension, _ = FORMATOS_DERIVADO[fmt]
+    st = origen.stat()
+    clave = hashlib.sha256(
+        f"{origen.resolve()}|{st.st_mtime_ns}|{st.st_size}|{ancho}|{fmt}".encode("utf-8")
+    ).hexdigest()
+
+    path = derivados_cache.retener(clave, extension)
+    if path is not None:
+        return path
+
+    tmp_path = derivados_cache.temporal()
+    try:
+        generar_derivado(origen, tmp_path, ancho, formato=formato, quality=FOTO_DERIVADOS_QUALITY)
+        path = derivados_cache.put_file(clave, extension, tmp_path, retener=True)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    logger.debug(f"Derivado {ancho}px/{fmt} generado para {origen}")
+    return path
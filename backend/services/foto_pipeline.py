@@ -0,0 +1,201 @@
+"""
+Procesamiento de fotos subidas en un pool de procesos.
+
+Cada foto se decodifica una sola vez: los JPEG con Image.draft a la escala
+reducida más cercana (1/2, 1/4, 1/8) que aún cubre el tamaño final, y la
+orientación y el timestamp se leen del mismo bloque EXIF que ya cargó Pillow
+(sin releer el archivo con exifread).
+
+Los workers reciben solo rutas (la subida ya volcada a disco) y parámetros
+planos, así el costo de IPC no depende del tamaño de las fotos.
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple
+from config import FOTO_POOL_WORKERS
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+# Etiquetas EXIF
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+# Orientación EXIF -> transposición que deja la imagen derecha
+TRANSPOSICIONES = {
+    2: "FLIP_LEFT_RIGHT",
+    3: "ROTATE_180",
+    4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE",
+    6: "ROTATE_270",
+    7: "TRANSVERSE",
+    8: "ROTATE_90",
+}
+
+
+@dataclass
+class TareaFoto:
+    """Una foto a procesar: subida cruda en `origen`, resultado en `destino`."""
+    origen: str
+    destino: str
+    es_jpeg: bool
+    max_size: Tuple[int, int]
+    quality: int
+
+
+def leer_metadatos(imagen: "Image.Image") -> Tuple[Optional[int], Optional[datetime]]:
+    """
+    Orientación y timestamp (DateTimeOriginal, o DateTime) desde el EXIF de la imagen abierta.
+    """
+    try:
+        exif = imagen.getexif()
+    except Exception:
+        return None, None
+
+    orientacion = exif.get(TAG_ORIENTATION)
+    fecha_str = None
+    try:
+        fecha_str = exif.get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL)
+    except Exception:
+        pass
+    fecha_str = fecha_str or exif.get(TAG_DATETIME)
+
+    timestamp = None
+    if isinstance(fecha_str, bytes):
+        fecha_str = fecha_str.decode("ascii", "ignore")
+    if fecha_str:
+        try:
+            # Formato EXIF: YYYY:MM:DD HH:MM:SS
+            timestamp = datetime.strptime(fecha_str.strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            pass
+    return orientacion, timestamp
+
+
+def procesar_foto(tarea: TareaFoto) -> Optional[datetime]:
+    """
+    Reduce, endereza y guarda la foto de `tarea.origen` en `tarea.destino`.
+
+    Returns:
+        datetime: timestamp EXIF de la foto, o None si no tiene
+    """
+    with Image.open(tarea.origen) as imagen:
+        orientacion, timestamp = leer_metadatos(imagen)
+
+        # Con rotación de 90° el lado largo de la foto queda vertical
+        ancho, alto = tarea.max_size
+        if orientacion in (5, 6, 7, 8):
+            ancho, alto = alto, ancho
+        if imagen.format == "JPEG":
+            imagen.draft("RGB", (ancho, alto))
+
+        if imagen.mode not in ("RGB", "L"):
+            imagen = imagen.convert("RGB")
+        else:
+            imagen.load()
+        if imagen.size[0] > ancho or imagen.size[1] > alto:
+            imagen.thumbnail((ancho, alto), Image.Resampling.LANCZOS)
+        if orientacion in TRANSPOSICIONES:
+            imagen = imagen.transpose(getattr(Image.Transpose, TRANSPOSICIONES[orientacion]))
+
+        # Escritura atómica: un worker caído no deja una foto a medias
+        carpeta = os.path.dirname(tarea.destino) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=carpeta, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                if tarea.es_jpeg:
+                    imagen.save(tmp, "JPEG", quality=tarea.quality, optimize=True)
+                else:
+                    imagen.save(tmp, "PNG", optimize=True)
+            os.replace(tmp_path, tarea.destino)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    return timestamp
+
+
+class FotoPool:
+    """
+    Procesa lotes de fotos en un ProcessPoolExecutor (un worker por núcleo por defecto).
+
+    Con workers=0 se procesa en el proceso actual.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                logger.info(f"Pool de fotos iniciado con {self.workers} workers")
+            return self._executor
+
+    def _descartar_executor(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def procesar_lote(self, tareas: List[TareaFoto]) -> List[Tuple[Optional[datetime], Optional[Exception]]]:
+        """
+        Procesa las tareas en paralelo.
+
+        Returns:
+            Una tupla (timestamp, error) por tarea, en el mismo orden; un error en
+            una foto no detiene las demás.
+        """
+        if self.workers <= 0 or len(tareas) <= 1:
+            resultados = []
+            for tarea in tareas:
+                try:
+                    resultados.append((procesar_foto(tarea), None))
+                except Exception as e:
+                    resultados.append((None, e))
+            return resultados
+
+        try:
+            futuros = [self._get_executor().submit(procesar_foto, tarea) for tarea in tareas]
+        except BrokenProcessPool:
+            self._descartar_executor()
+            futuros = [self._get_executor().submit(procesar_foto, tarea) for tarea in tareas]
+
+        resultados = []
+        for futuro in futuros:
+            try:
+                resultados.append((futuro.result(), None))
+            except BrokenProcessPool as e:
+                logger.error("El pool de fotos se rompió (worker terminado); se recreará")
+                self._descartar_executor()
+                resultados.append((None, e))
+            except Exception as e:
+                resultados.append((None, e))
+        return resultados
+
+    def shutdown(self) -> None:
+        self._descartar_executor()
+
+
+foto_pool = FotoPool(FOTO_POOL_WORKERS)
@@ -1,14 +1,27 @@
+import bisect
+import json
+import math
 import os
+import threading
 import shutil
+import tempfile
 from datetime import datetime, timedelta
 from typing import List, Optional, Tuple
-from fastapi import UploadFile, HTTPException
+from fastapi import HTTPException
+from sqlalchemy import update
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from PIL import Image, ExifTags
-import exifread
 from models.evidencias import Evidencia
 from models.denuncias import Denuncia
+from services.geoprocessing.codec import puntos_lonlat
+from services.foto_pipeline import TareaFoto, foto_pool
+from services.staging import ArchivoEnStaging
+from config import FOTOS_INDICE_DIR
+
+# Índice por denuncia: huella (sha256 del archivo subido) -> foto, y evidencia -> huella.
+# Vive fuera de la carpeta de fotos (servida sin autenticación en /fotos) para
+# no exponer la lista de huellas; ARCHIVO_INDICE es la ubicación anterior.
+ARCHIVO_INDICE = "indice.json"
+_indice_lock = threading.Lock()
 
 class FotoService:
     def __init__(self):
@@ -23,13 +36,13 @@ class FotoService:
         os.makedirs(carpeta, exist_ok=True)
         return carpeta
     
-    def validar_archivo(self, archivo: UploadFile) -> bool:
+    def validar_archivo(self, archivo: ArchivoEnStaging) -> bool:
         """Valida que el archivo sea una imagen válida"""
-        if not archivo.filename:
+        if not archivo.nombre or archivo.path is None:
             return False
             
         # Verificar extensión
-        nombre, extension = os.path.splitext(archivo.filename.lower())
+        nombre, extension = os.path.splitext(archivo.nombre.lower())
         if extension not in self.allowed_extensions:
             return False
             
@@ -37,134 +50,119 @@ class FotoService:
         if not archivo.content_type or not archivo.content_type.startswith('image/'):
             return False
             
-        return True
+        # Firma JPEG/PNG verificada al recibir el stream
+        return archivo.firma_valida
     
-    def corregir_orientacion_exif(self, imagen: Image.Image) -> Image.Image:
-        """
-        Corrige la orientación de la imagen según la etiqueta EXIF Orientation, si existe.
+    def preparar_tarea(self, archivo: ArchivoEnStaging, carpeta_destino: str, id_denuncia: int) -> Tuple[TareaFoto, str, str]:
         """
-        try:
-            exif = imagen._getexif()
-            if exif is not None:
-                for tag, value in exif.items():
-                    tag_name = ExifTags.TAGS.get(tag, tag)
-                    if tag_name == 'Orientation':
-                        orientacion = value
-                        if orientacion == 3:
-                            imagen = imagen.rotate(180, expand=True)
-                        elif orientacion == 6:
-                            imagen = imagen.rotate(270, expand=True)
-                        elif orientacion == 8:
-                            imagen = imagen.rotate(90, expand=True)
-                        break
-        except Exception:
-            pass  # Si no hay EXIF o no se puede leer, no hacer nada
-        return imagen
-    
-    def procesar_imagen(self, archivo: UploadFile, carpeta_destino: str, id_denuncia: int) -> Tuple[str, datetime]:
+        Arma la tarea para el pool de fotos a partir de la subida en staging.
+        El nombre final es el sha256 del contenido subido (calculado durante el
+        stream): la misma foto siempre queda en el mismo archivo.
+        Retorna: (tarea, ruta_relativa, huella)
         """
-        Procesa una imagen: la comprime, guarda y extrae timestamp EXIF
-        Retorna: (ruta_relativa, timestamp_foto)
-        """
-        # Generar nombre único
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        nombre_original = os.path.splitext(archivo.filename)[0]
-        extension = os.path.splitext(archivo.filename)[1].lower()
+        extension = os.path.splitext(archivo.nombre)[1].lower()
         
         # Si es JPEG, mantener extensión .jpg
         if extension in ['.jpeg', '.jpg']:
             extension = '.jpg'
         
-        nombre_final = f"{nombre_original}_{timestamp}{extension}"
+        huella = archivo.sha256
+        nombre_final = f"{huella}{extension}"
         ruta_completa = os.path.join(carpeta_destino, nombre_final)
         ruta_relativa = f"/fotos/denuncia_{id_denuncia}/{nombre_final}"
         
-        # Leer y procesar imagen
-        imagen = Image.open(archivo.file)
-        
-        # Corregir orientación según EXIF antes de cualquier procesamiento
-        imagen = self.corregir_orientacion_exif(imagen)
-        
-        # Convertir a RGB si es necesario
-        if imagen.mode in ('RGBA', 'LA', 'P'):
-            imagen = imagen.convert('RGB')
-        
-        # Redimensionar si es necesario
-        if imagen.size[0] > self.max_size[0] or imagen.size[1] > self.max_size[1]:
-            imagen.thumbnail(self.max_size, Image.Resampling.LANCZOS)
-        
-        # Guardar imagen procesada
-        if extension == '.jpg':
-            imagen.save(ruta_completa, 'JPEG', quality=self.quality, optimize=True)
-        else:
-            imagen.save(ruta_completa, 'PNG', optimize=True)
-        
-        # Extraer timestamp EXIF
-        archivo.file.seek(0)  # Resetear posición del archivo
-        timestamp_foto = self.extraer_timestamp_exif(archivo)
-        
-        return ruta_relativa, timestamp_foto
+        # El worker lee directamente el archivo en staging
+        tarea = TareaFoto(
+            origen=str(archivo.path),
+            destino=ruta_completa,
+            es_jpeg=extension == '.jpg',
+            max_size=self.max_size,
+            quality=self.quality,
+        )
+        return tarea, ruta_relativa, huella
     
-    def extraer_timestamp_exif(self, archivo: UploadFile) -> datetime:
+    def ruta_indice_fotos(self, id_denuncia: int) -> str:
+        return os.path.join(FOTOS_INDICE_DIR, f"denuncia_{id_denuncia}.json")
+    
+    def leer_indice_fotos(self, id_denuncia: int, carpeta: str) -> dict:
         """
-        Extrae el timestamp de los metadatos EXIF de la foto
-        Si no encuentra EXIF, retorna timestamp actual
+        Índice de fotos de la denuncia (FOTOS_INDICE_DIR/denuncia_<id>.json, o el
+        indice.json heredado en la carpeta de fotos si aún no se migró):
+        {"fotos": {huella: {"archivo", "timestamp"}}, "evidencias": {id_evidencia: huella}}
         """
+        indice = {}
+        for ruta in (self.ruta_indice_fotos(id_denuncia), os.path.join(carpeta, ARCHIVO_INDICE)):
+            try:
+                with open(ruta, encoding="utf-8") as f:
+                    indice = json.load(f)
+                break
+            except (OSError, ValueError):
+                continue
+        indice.setdefault("fotos", {})
+        indice.setdefault("evidencias", {})
+        return indice
+    
+    def guardar_indice_fotos(self, id_denuncia: int, carpeta: str, indice: dict) -> None:
+        """Escribe el índice de forma atómica y elimina el indice.json heredado de la carpeta pública."""
+        os.makedirs(FOTOS_INDICE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=FOTOS_INDICE_DIR, suffix=".tmp")
         try:
-            archivo.file.seek(0)
-            tags = exifread.process_file(archivo.file, details=False)
-            
-            # Buscar DateTimeOriginal primero, luego DateTime
-            if 'EXIF DateTimeOriginal' in tags:
-                fecha_str = str(tags['EXIF DateTimeOriginal'])
-            elif 'Image DateTime' in tags:
-                fecha_str = str(tags['Image DateTime'])
-            else:
-                return datetime.now()
-            
-            # Parsear fecha EXIF (formato: YYYY:MM:DD HH:MM:SS)
+            with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+                json.dump(indice, tmp, ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.ruta_indice_fotos(id_denuncia))
+        except Exception:
             try:
-                return datetime.strptime(fecha_str, '%Y:%m:%d %H:%M:%S')
-            except ValueError:
-                return datetime.now()
-                
-        except Exception as e:
-            print(f"Error al extraer EXIF: {e}")
-            return datetime.now()
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        try:
+            os.unlink(os.path.join(carpeta, ARCHIVO_INDICE))
+        except OSError:
+            pass
     
-    def asociar_foto_a_evidencia(self, db: Session, id_denuncia: int, ruta_foto: str, timestamp_foto: datetime, descripcion: str) -> Optional[int]:
+    def cargar_indice_evidencias(self, db: Session, id_denuncia: int) -> Tuple[List[datetime], List[int]]:
         """
-        Asocia una foto a la evidencia más cercana en tiempo y guarda la descripción proporcionada por el usuario.
+        Carga una sola vez las evidencias de la denuncia como (timestamps, ids)
+        ordenados por timestamp, para asociar un lote de fotos con búsqueda binaria.
         """
-        evidencias = db.query(Evidencia).filter(
-            Evidencia.id_denuncia == id_denuncia
+        filas = db.query(Evidencia.id_evidencia, Evidencia.fecha, Evidencia.hora).filter(
+            Evidencia.id_denuncia == id_denuncia,
+            Evidencia.fecha.isnot(None),
+            Evidencia.hora.isnot(None)
         ).all()
-        if not evidencias:
-            return None
-        evidencia_cercana = None
-        diferencia_minima = timedelta(hours=24)
-        for evidencia in evidencias:
-            timestamp_evidencia = datetime.combine(evidencia.fecha, evidencia.hora)
-            diferencia = abs(timestamp_foto - timestamp_evidencia)
-            if diferencia < diferencia_minima:
-                diferencia_minima = diferencia
-                evidencia_cercana = evidencia
-        if evidencia_cercana:
-            evidencia_cercana.foto_url = ruta_foto
-            evidencia_cercana.descripcion = descripcion
-            db.commit()
-            return evidencia_cercana.id_evidencia
-        return None
-
-    def subir_fotos_denuncia(self, db: Session, id_denuncia: int, archivos: List[UploadFile], descripciones: List[str]) -> dict:
+        ordenadas = sorted((datetime.combine(fecha, hora), id_evidencia) for id_evidencia, fecha, hora in filas)
+        return [t for t, _ in ordenadas], [i for _, i in ordenadas]
+    
+    def evidencia_mas_cercana(self, indice: Tuple[List[datetime], List[int]], timestamp_foto: datetime,
+                              diferencia_maxima: timedelta = timedelta(hours=24)) -> Optional[int]:
         """
-        Sube múltiples fotos para una denuncia y las asocia a evidencias por timestamp y descripción del usuario
+        Retorna el id de la evidencia más cercana en tiempo a la foto (a menos de
+        `diferencia_maxima`), o None. En empate gana la evidencia anterior.
+        """
+        tiempos, ids = indice
+        pos = bisect.bisect_left(tiempos, timestamp_foto)
+        mejor = None
+        diferencia_minima = diferencia_maxima
+        for candidato in (pos - 1, pos):
+            if 0 <= candidato < len(tiempos):
+                diferencia = abs(timestamp_foto - tiempos[candidato])
+                if diferencia < diferencia_minima:
+                    diferencia_minima = diferencia
+                    mejor = ids[candidato]
+        return mejor
+    
+    def subir_fotos_denuncia(self, db: Session, id_denuncia: int, archivos: List[ArchivoEnStaging], descripciones: List[str]) -> dict:
+        """
+        Procesa múltiples fotos subidas (en staging) para una denuncia y las asocia a
+        evidencias por timestamp y descripción del usuario. Los archivos de staging
+        los elimina quien los recibió.
         """
         denuncia = db.query(Denuncia).filter(Denuncia.id_denuncia == id_denuncia).first()
         if not denuncia:
             raise HTTPException(status_code=404, detail="Denuncia no encontrada")
-        evidencias = db.query(Evidencia).filter(Evidencia.id_denuncia == id_denuncia).count()
-        if evidencias == 0:
+        indice = self.cargar_indice_evidencias(db, id_denuncia)
+        if not indice[0]:
             raise HTTPException(
                 status_code=400, 
                 detail="No hay evidencias GPS para esta denuncia. Debe subir el archivo GPX primero."
@@ -178,18 +176,60 @@ class FotoService:
             "errores": [],
             "detalles": []
         }
+        with _indice_lock:
+            indice_fotos = self.leer_indice_fotos(id_denuncia, carpeta_denuncia)
+        
+        # Validar y volcar las subidas; las fotos ya almacenadas (mismo hash) no se
+        # decodifican de nuevo y el resto va en lote al pool
+        pendientes = []
+        tareas = {}
+        conocidas = {}
         for archivo, descripcion in zip(archivos, descripciones):
             try:
                 if not self.validar_archivo(archivo):
-                    resultados["errores"].append(f"Archivo inválido: {archivo.filename}")
+                    resultados["errores"].append(f"Archivo inválido: {archivo.nombre}")
                     continue
-                ruta_foto, timestamp_foto = self.procesar_imagen(archivo, carpeta_denuncia, id_denuncia)
+                tarea, ruta_foto, huella = self.preparar_tarea(archivo, carpeta_denuncia, id_denuncia)
+                registrada = indice_fotos["fotos"].get(huella)
+                if huella in tareas or huella in conocidas:
+                    pass  # repetida dentro del mismo lote
+                elif registrada and os.path.exists(tarea.destino):
+                    timestamp = registrada.get("timestamp")
+                    conocidas[huella] = (datetime.fromisoformat(timestamp) if timestamp else None, None)
+                else:
+                    tareas[huella] = tarea
+                pendientes.append((archivo, descripcion, huella, ruta_foto))
+            except Exception as e:
+                resultados["errores"].append(f"Error procesando {archivo.nombre}: {str(e)}")
+        
+        procesadas = dict(zip(tareas, foto_pool.procesar_lote(list(tareas.values()))))
+        procesadas.update(conocidas)
+        
+        asociaciones = {}
+        for archivo, descripcion, huella, ruta_foto in pendientes:
+            try:
+                timestamp_foto, error = procesadas[huella]
+                if error is not None:
+                    raise error
+                indice_fotos["fotos"][huella] = {
+                    "archivo": os.path.basename(ruta_foto),
+                    "timestamp": timestamp_foto.isoformat() if timestamp_foto else None
+                }
+                # Sin EXIF se usa la hora actual
+                timestamp_foto = timestamp_foto or datetime.now()
                 resultados["fotos_procesadas"] += 1
-                id_evidencia = self.asociar_foto_a_evidencia(db, id_denuncia, ruta_foto, timestamp_foto, descripcion)
+                id_evidencia = self.evidencia_mas_cercana(indice, timestamp_foto)
                 if id_evidencia:
+                    # Si dos fotos caen en la misma evidencia queda la última (como antes)
+                    asociaciones[id_evidencia] = {
+                        "id_evidencia": id_evidencia,
+                        "foto_url": ruta_foto,
+                        "descripcion": descripcion
+                    }
+                    indice_fotos["evidencias"][str(id_evidencia)] = huella
                     resultados["fotos_asociadas"] += 1
                     resultados["detalles"].append({
-                        "archivo": archivo.filename,
+                        "archivo": archivo.nombre,
                         "evidencia_id": id_evidencia,
                         "timestamp_foto": timestamp_foto.isoformat(),
                         "ruta": ruta_foto,
@@ -197,10 +237,21 @@ class FotoService:
                     })
                 else:
                     resultados["errores"].append(
-                        f"No se pudo asociar {archivo.filename} a ninguna evidencia GPS"
+                        f"No se pudo asociar {archivo.nombre} a ninguna evidencia GPS"
                     )
             except Exception as e:
-                resultados["errores"].append(f"Error procesando {archivo.filename}: {str(e)}")
+                resultados["errores"].append(f"Error procesando {archivo.nombre}: {str(e)}")
+        
+        # Todas las asociaciones en un solo UPDATE por lotes y una sola transacción
+        if asociaciones:
+            db.execute(update(Evidencia), list(asociaciones.values()))
+            db.commit()
+        with _indice_lock:
+            # Releer para no pisar lo que otra subida haya registrado mientras tanto
+            actual = self.leer_indice_fotos(id_denuncia, carpeta_denuncia)
+            actual["fotos"].update(indice_fotos["fotos"])
+            actual["evidencias"].update(indice_fotos["evidencias"])
+            self.guardar_indice_fotos(id_denuncia, carpeta_denuncia, actual)
         return resultados
     
     def listar_fotos_denuncia(self, db: Session, id_denuncia: int) -> List[dict]:
@@ -212,8 +263,12 @@ class FotoService:
             Evidencia.foto_url.isnot(None)
         ).all()
         
+        lon, lat = puntos_lonlat(e.coordenadas for e in evidencias_con_fotos)
         fotos = []
-        for evidencia in evidencias_con_fotos:
+        for evidencia, x, y in zip(evidencias_con_fotos, lon.tolist(), lat.tolist()):
+            # Geometría nula o vacía: NaN no es JSON válido
+            if math.isnan(x) or math.isnan(y):
+                x = y = None
             fotos.append({
                 "id_evidencia": evidencia.id_evidencia,
                 "foto_url": evidencia.foto_url,
@@ -221,14 +276,8 @@ class FotoService:
                 "fecha": evidencia.fecha,
                 "hora": evidencia.hora,
                 "coordenadas": {
-                    "lat": db.execute(
-                        text("SELECT ST_Y(coordenadas::geometry) FROM evidencias WHERE id_evidencia = :id"),
-                        {"id": evidencia.id_evidencia}
-                    ).scalar(),
-                    "lon": db.execute(
-                        text("SELECT ST_X(coordenadas::geometry) FROM evidencias WHERE id_evidencia = :id"),
-                        {"id": evidencia.id_evidencia}
-                    ).scalar()
+                    "lat": y,
+                    "lon": x
                 }
             })
         
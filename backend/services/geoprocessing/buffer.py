@@ -1,18 +1,39 @@
 from sqlalchemy import text
 from sqlalchemy.orm import Session
+from config import GPX_TRACK_TOLERANCIA_M
 
 def generar_buffer_union(db: Session, id_denuncia: int, distancia: float):
     """
     Genera un buffer unificado a partir de todas las evidencias de una denuncia,
     y lo recorta con la capa `los_lagos` para excluir tierra firme si está presente.
+
+    Los tracks GPX se bufferean como su línea simplificada (tracks_denuncia); solo
+    las evidencias que no están sobre una de esas líneas se bufferean como puntos.
     """
-    # Crear buffer para todas las evidencias de la denuncia
+    # Crear buffer para las líneas de track y las evidencias fuera de ellas
     sql_buffer = text("""
-        SELECT ST_Union(ST_Buffer(coordenadas::geography, :distancia)::geometry)
-        FROM evidencias
-        WHERE id_denuncia = :id
+        SELECT ST_Union(ST_Buffer(geom::geography, :distancia)::geometry)
+        FROM (
+            SELECT t.geom
+            FROM tracks_denuncia t
+            WHERE t.id_denuncia = :id
+            UNION ALL
+            SELECT e.coordenadas
+            FROM evidencias e
+            WHERE e.id_denuncia = :id
+              AND NOT EXISTS (
+                  SELECT 1 FROM tracks_denuncia t
+                  WHERE t.id_denuncia = :id
+                    AND ST_DWithin(e.coordenadas::geography, t.geom::geography, :tolerancia)
+              )
+        ) AS geometrias
     """)
-    buffer_geom = db.execute(sql_buffer, {"id": id_denuncia, "distancia": distancia}).scalar()
+    buffer_geom = db.execute(sql_buffer, {
+        "id": id_denuncia,
+        "distancia": distancia,
+        # Los puntos del track quedan a lo más a la tolerancia Douglas-Peucker de la línea
+        "tolerancia": GPX_TRACK_TOLERANCIA_M + 1.0,
+    }).scalar()
 
     if not buffer_geom:
         raise ValueError("No se encontraron evidencias para la denuncia")
@@ -0,0 +1,68 @@
+"""
+Decodificación de geometrías PostGIS en Python.
+
+GeoAlchemy2 entrega las columnas geométricas como `WKBElement` (EWKB) y las
+consultas `text()` como strings hexadecimales. En lugar de pedir a PostGIS un
+`ST_X`/`ST_Y`/`ST_AsGeoJSON` por fila, estas funciones decodifican los valores
+ya cargados con Shapely (vectorizado para listas).
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+
+
+def _wkb(valor: Any):
+    """Normaliza un WKBElement / bytes / memoryview / hex a algo que acepte shapely.from_wkb."""
+    if valor is None:
+        return None
+    data = getattr(valor, "data", valor)
+    if isinstance(data, (bytes, str)):
+        return data
+    return bytes(data)  # memoryview / bytearray
+
+
+def decodificar(valores: Iterable[Any]) -> np.ndarray:
+    """Decodifica una secuencia de geometrías a un array de objetos Shapely (None se mantiene)."""
+    datos = np.array([_wkb(v) for v in valores], dtype=object)
+    if datos.size == 0:
+        return datos
+    return shapely.from_wkb(datos)
+
+
+def a_shape(valor: Any):
+    """Decodifica una geometría individual a Shapely, o None."""
+    if valor is None:
+        return None
+    return shapely.from_wkb(_wkb(valor))
+
+
+def a_geojson(valor: Any) -> Optional[Dict[str, Any]]:
+    """Convierte una geometría (WKBElement, WKB o hex) a un diccionario GeoJSON."""
+    geom = a_shape(valor)
+    if geom is None or geom.is_empty:
+        return None
+    return mapping(geom)
+
+
+def puntos_lonlat(valores: Iterable[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodifica una lista de puntos en una sola pasada.
+
+    Returns:
+        (lon, lat) como arrays float64; NaN para valores nulos o vacíos.
+    """
+    geoms = decodificar(valores)
+    if geoms.size == 0:
+        vacio = np.empty(0, dtype=np.float64)
+        return vacio, vacio
+    return shapely.get_x(geoms), shapely.get_y(geoms)
+
+
+def puntos_geojson(valores: Iterable[Any]) -> List[Optional[Dict[str, Any]]]:
+    """Decodifica una lista de puntos a GeoJSON `Point` (None si el valor es nulo)."""
+    lon, lat = puntos_lonlat(valores)
+    return [
+        None if np.isnan(x) or np.isnan(y) else {"type": "Point", "coordinates": [float(x), float(y)]}
+        for x, y in zip(lon.tolist(), lat.tolist())
+    ]
@@ -1,116 +1,244 @@
-from fastapi import UploadFile
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+from xml.etree.ElementTree import iterparse
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from models.evidencias import Evidencia
-from geoalchemy2.shape import from_shape
-from shapely.geometry import Point
-import gpxpy
+from models.tracks import TrackDenuncia
+from config import GPX_TRACK_TOLERANCIA_M, GPX_TRACK_DISTANCIA_M, GPX_TRACK_INTERVALO_S
+from services.geoprocessing.gpx.track import decimar, douglas_peucker, proyectar_local
+import numpy as np
 import datetime
 import logging
 import time
 import json as _json
 from logging_utils import log_event
 
-def procesar_gpx_waypoints(gpx_file: UploadFile, id_denuncia: int, db: Session, utc_offset: int):
+# Filas por INSERT (executemany) al guardar evidencias
+LOTE_INSERT = 5000
+
+# Región objetivo y SRID esperado (para evidencia de control CR3)
+LAT_MIN, LAT_MAX = -45.0, -40.0
+LON_MIN, LON_MAX = -75.0, -71.0
+EPSG = "EPSG:4326"
+
+
+def _nombre_local(tag: str) -> str:
+    """Nombre sin namespace ('{http://www.topografix.com/GPX/1/1}wpt' -> 'wpt')."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parsear_tiempo(texto: Optional[str]) -> Optional[datetime.datetime]:
+    """Timestamp ISO 8601 de GPX ('2024-03-01T14:05:33Z', con o sin fracción/offset)."""
+    if not texto:
+        return None
+    texto = texto.strip()
+    if texto.endswith("Z"):
+        texto = texto[:-1] + "+00:00"
+    try:
+        return datetime.datetime.fromisoformat(texto)
+    except ValueError:
+        return None
+
+
+def iterar_gpx(gpx_path: Union[str, Path]) -> Iterator[Tuple[str, tuple]]:
     """
-    Parsea un archivo GPX (solo waypoints) y los guarda como evidencias georreferenciadas en la BD.
-    Ajusta la hora de cada waypoint según el utc_offset proporcionado.
+    Lee un GPX en streaming (iterparse), sin construir el árbol completo.
+
+    Yields:
+        ('wpt', (lat, lon, tiempo, nombre)) por cada <wpt>
+        ('trkseg', (lats, lons, tiempos)) por cada <trkseg> con sus <trkpt>
     """
-    start = time.perf_counter()
-    logger = logging.getLogger("wizard")
+    contexto = iterparse(str(gpx_path), events=("start", "end"))
+    _, raiz = next(contexto)
+    segmento = None
+    lats, lons, tiempos = [], [], []
+    for evento, elem in contexto:
+        local = _nombre_local(elem.tag)
+        if evento == "start":
+            if local == "trkseg":
+                segmento = elem
+                lats, lons, tiempos = [], [], []
+            continue
+
+        if local in ("wpt", "trkpt"):
+            try:
+                lat = float(elem.get("lat"))
+                lon = float(elem.get("lon"))
+            except (TypeError, ValueError):
+                lat = lon = None
+            tiempo = None
+            nombre = None
+            for hijo in elem:
+                hijo_local = _nombre_local(hijo.tag)
+                if hijo_local == "time":
+                    tiempo = _parsear_tiempo(hijo.text)
+                elif hijo_local == "name":
+                    nombre = hijo.text
+
+            if local == "wpt":
+                if lat is not None:
+                    yield "wpt", (lat, lon, tiempo, nombre)
+                # Descartar los elementos ya procesados: la memoria no crece con el archivo
+                raiz.clear()
+            else:
+                if lat is not None:
+                    lats.append(lat)
+                    lons.append(lon)
+                    tiempos.append(tiempo)
+                if segmento is not None:
+                    segmento.clear()
+        elif local == "trkseg":
+            if lats:
+                yield "trkseg", (lats, lons, tiempos)
+            segmento = None
+            lats, lons, tiempos = [], [], []
+        elif local == "trk":
+            raiz.clear()
+
 
-    # Región objetivo y SRID esperado (para evidencia de control CR3)
-    LAT_MIN, LAT_MAX = -45.0, -40.0
-    LON_MIN, LON_MAX = -75.0, -71.0
-    EPSG = "EPSG:4326"
+def _fila_evidencia(id_denuncia: int, lat: float, lon: float, tiempo: Optional[datetime.datetime],
+                    utc_offset: int) -> dict:
+    # Extraer fecha y hora del waypoint y ajustar por utc_offset
+    if tiempo:
+        tiempo_ajustado = tiempo + datetime.timedelta(hours=utc_offset)
+        fecha = tiempo_ajustado.date()
+        hora = tiempo_ajustado.time()
+    else:
+        fecha = datetime.date.today()
+        hora = datetime.time(0, 0, 0)
+    return {
+        "id_denuncia": id_denuncia,
+        "coordenadas": f"SRID=4326;POINT({lon!r} {lat!r})",  # EWKT; GeoAlchemy2 aplica ST_GeomFromEWKT
+        "fecha": fecha,
+        "hora": hora,
+        "descripcion": None,
+        "foto_url": None,  # se asignará después si corresponde
+    }
 
-    contenido = gpx_file.file.read().decode("utf-8")
-    gpx = gpxpy.parse(contenido)
 
+def _procesar_segmento(db: Session, id_denuncia: int, lats: list, lons: list, tiempos: list,
+                       utc_offset: int) -> Tuple[List[int], int]:
+    """
+    Simplifica un segmento de track: guarda la línea (Douglas-Peucker) en
+    tracks_denuncia y elige los puntos que quedan como evidencias (diezmado).
+
+    Returns:
+        (índices de los puntos que serán evidencias, vértices de la línea simplificada)
+    """
+    lat = np.asarray(lats, dtype=np.float64)
+    lon = np.asarray(lons, dtype=np.float64)
+    segundos = np.array([t.timestamp() if t else np.nan for t in tiempos], dtype=np.float64)
+    xy = proyectar_local(lat, lon)
+
+    linea = douglas_peucker(xy, GPX_TRACK_TOLERANCIA_M)
+    vertices = int(linea.sum())
+    if vertices >= 2:
+        coords = ", ".join(f"{x!r} {y!r}" for x, y in zip(lon[linea].tolist(), lat[linea].tolist()))
+        con_tiempo = [t for t in tiempos if t]
+        ajustar = lambda t: (t + datetime.timedelta(hours=utc_offset)).replace(tzinfo=None)
+        db.execute(insert(TrackDenuncia), [{
+            "id_denuncia": id_denuncia,
+            "geom": f"SRID=4326;LINESTRING({coords})",
+            "fecha_inicio": ajustar(con_tiempo[0]) if con_tiempo else None,
+            "fecha_fin": ajustar(con_tiempo[-1]) if con_tiempo else None,
+            "puntos_originales": len(lats),
+            "puntos_simplificados": vertices,
+        }])
+
+    evidencias = decimar(xy, segundos, GPX_TRACK_DISTANCIA_M, GPX_TRACK_INTERVALO_S)
+    return np.flatnonzero(evidencias).tolist(), vertices
+
+
+def procesar_gpx_waypoints(gpx_path: Union[str, Path], id_denuncia: int, db: Session, utc_offset: int):
+    """
+    Parsea un archivo GPX y guarda sus waypoints como evidencias georreferenciadas en la BD.
+    Los tracks (<trk>) se simplifican al ingresarlos: la línea de cada segmento se
+    guarda simplificada en tracks_denuncia y sus evidencias se diezman por distancia/tiempo.
+    Ajusta la hora de cada punto según el utc_offset proporcionado.
+    El archivo se lee desde disco (subida en staging) en streaming, y las
+    evidencias se insertan por lotes (executemany) en una sola transacción.
+    """
+    start = time.perf_counter()
+    logger = logging.getLogger("wizard")
+
+    lats = []
+    lons = []
+    nombres = []
+    lote = []
     contador = 0
-    dentro_region = 0
-    fuera_region = 0
-    min_lat = None
-    max_lat = None
-    min_lon = None
-    max_lon = None
-    muestras_fuera = []  # type: ignore[var-annotated]
-    for wpt in gpx.waypoints:
-        lat, lon = wpt.latitude, wpt.longitude
-        tiempo = wpt.time  # datetime.datetime
-        nombre = wpt.name if wpt.name else "Waypoint"
-        descripcion = None
-
-        # Estadísticos y verificación de región objetivo
-        try:
-            min_lat = lat if min_lat is None else min(min_lat, lat)
-            max_lat = lat if max_lat is None else max(max_lat, lat)
-            min_lon = lon if min_lon is None else min(min_lon, lon)
-            max_lon = lon if max_lon is None else max(max_lon, lon)
-
-            inside = (LAT_MIN <= lat <= LAT_MAX) and (LON_MIN <= lon <= LON_MAX)
-            if inside:
-                dentro_region += 1
-            else:
-                fuera_region += 1
-                if len(muestras_fuera) < 5:
-                    muestras_fuera.append({"lat": lat, "lon": lon, "nombre": nombre})
-
-            # Log granular (DEBUG) por waypoint; no altera el flujo si el logger está en INFO
-            log_event(
-                logger,
-                "DEBUG",
-                "gpx_waypoint_bounds_check",
-                denuncia_id=id_denuncia,
-                lat=lat,
-                lon=lon,
-                inside_region=inside,
-                epsg=EPSG,
-                waypoint_name=nombre,
-            )
-        except Exception:
-            # Nunca afectar el procesamiento por errores de logging/estadísticos
-            pass
-
-        punto = from_shape(Point(lon, lat), srid=4326)
-
-        # Extraer fecha y hora del waypoint y ajustar por utc_offset
-        if tiempo:
-            tiempo_ajustado = tiempo + datetime.timedelta(hours=utc_offset)
-            fecha = tiempo_ajustado.date()
-            hora = tiempo_ajustado.time()
+    segmentos = 0
+    puntos_track = 0
+    vertices_track = 0
+    evidencias_track = 0
+    for tipo, datos in iterar_gpx(gpx_path):
+        if tipo == "wpt":
+            lat, lon, tiempo, nombre = datos
+            puntos = [(lat, lon, tiempo)]
+            nombres.append(nombre if nombre else "Waypoint")
+            contador += 1
         else:
-            fecha = datetime.date.today()
-            hora = datetime.time(0, 0, 0)
-
-        evidencia = Evidencia(
-            id_denuncia=id_denuncia,
-            coordenadas=punto,
-            fecha=fecha,
-            hora=hora,
-            descripcion=descripcion,
-            foto_url=None  # se asignará después si corresponde
-        )
-        db.add(evidencia)
-        contador += 1
-
+            seg_lats, seg_lons, seg_tiempos = datos
+            indices, vertices = _procesar_segmento(db, id_denuncia, seg_lats, seg_lons, seg_tiempos, utc_offset)
+            puntos = [(seg_lats[i], seg_lons[i], seg_tiempos[i]) for i in indices]
+            nombres.extend(["Track"] * len(puntos))
+            segmentos += 1
+            puntos_track += len(seg_lats)
+            vertices_track += vertices
+            evidencias_track += len(puntos)
+        for lat, lon, tiempo in puntos:
+            lats.append(lat)
+            lons.append(lon)
+            lote.append(_fila_evidencia(id_denuncia, lat, lon, tiempo, utc_offset))
+        if len(lote) >= LOTE_INSERT:
+            db.execute(insert(Evidencia), lote)
+            lote = []
+    if lote:
+        db.execute(insert(Evidencia), lote)
     db.commit()
+    total = len(lats)
+
     # Log de resumen del procesamiento para evidenciar control CR3
     try:
+        lat_arr = np.asarray(lats, dtype=np.float64)
+        lon_arr = np.asarray(lons, dtype=np.float64)
+        inside = (lat_arr >= LAT_MIN) & (lat_arr <= LAT_MAX) & (lon_arr >= LON_MIN) & (lon_arr <= LON_MAX)
+        dentro_region = int(inside.sum())
+        fuera = np.flatnonzero(~inside)
+        muestras_fuera = [
+            {"lat": lats[i], "lon": lons[i], "nombre": nombres[i]} for i in fuera[:5].tolist()
+        ]
+
+        # Log granular (DEBUG) por waypoint, solo si el logger está en DEBUG
+        if logger.isEnabledFor(logging.DEBUG):
+            for lat, lon, dentro, nombre in zip(lats, lons, inside.tolist(), nombres):
+                log_event(logger, "DEBUG", "gpx_waypoint_bounds_check", denuncia_id=id_denuncia,
+                          lat=lat, lon=lon, inside_region=dentro, epsg=EPSG, waypoint_name=nombre)
+
         log_event(
             logger,
             "INFO",
             "gpx_processing_summary",
             denuncia_id=id_denuncia,
             total_waypoints=contador,
+            track_segments=segmentos or None,
+            track_points=puntos_track or None,
+            track_vertices=vertices_track or None,
+            track_evidencias=evidencias_track or None,
             inside_region=dentro_region,
-            outside_region=fuera_region,
-            lat_range=(f"{min_lat},{max_lat}" if min_lat is not None else None),
-            lon_range=(f"{min_lon},{max_lon}" if min_lon is not None else None),
+            outside_region=total - dentro_region,
+            lat_range=(f"{lat_arr.min()},{lat_arr.max()}" if total else None),
+            lon_range=(f"{lon_arr.min()},{lon_arr.max()}" if total else None),
             epsg=EPSG,
             duration_ms=int((time.perf_counter() - start) * 1000),
             samples_outside=_json.dumps(muestras_fuera) if muestras_fuera else None,
         )
     except Exception:
+        # Nunca afectar el procesamiento por errores de logging/estadísticos
         pass
 
-    return {"detalle": f"{contador} waypoints procesados desde el archivo GPX."}
\ No newline at end of file
+    detalle = f"{contador} waypoints procesados desde el archivo GPX."
+    if segmentos:
+        detalle += (f" Tracks: {puntos_track} puntos en {segmentos} segmentos, "
+                    f"{evidencias_track} evidencias y {vertices_track} vértices tras simplificar.")
+    return {"detalle": detalle}
@@ -0,0 +1,82 @@
+"""
+Simplificación de tracks GPS al ingresarlos.
+
+- La línea del recorrido se simplifica con Douglas-Peucker en metros (proyección
+  local equirectangular, suficiente para tracks de una inspección).
+- Las evidencias se toman del track diezmado por distancia/tiempo: un punto
+  cada GPX_TRACK_DISTANCIA_M metros o cada GPX_TRACK_INTERVALO_S segundos
+  (detenciones largas), así la densidad de evidencias queda acotada.
+"""
+import numpy as np
+
+METROS_POR_GRADO_LAT = 110540.0
+METROS_POR_GRADO_LON = 111320.0
+
+
+def proyectar_local(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Coordenadas (x, y) en metros relativas al centro del track."""
+    lat0 = float(np.mean(lat))
+    lon0 = float(np.mean(lon))
+    x = (lon - lon0) * METROS_POR_GRADO_LON * np.cos(np.radians(lat0))
+    y = (lat - lat0) * METROS_POR_GRADO_LAT
+    return np.column_stack([x, y])
+
+
+def douglas_peucker(xy: np.ndarray, tolerancia: float) -> np.ndarray:
+    """
+    Máscara de los vértices que conserva Douglas-Peucker con `tolerancia` (mismas
+    unidades que xy). Iterativo (pila explícita) para tracks de cualquier largo.
+    """
+    n = len(xy)
+    mantener = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mantener
+    mantener[0] = mantener[-1] = True
+    pila = [(0, n - 1)]
+    while pila:
+        i, j = pila.pop()
+        if j <= i + 1:
+            continue
+        a = xy[i]
+        ab = xy[j] - a
+        intermedios = xy[i + 1:j] - a
+        largo2 = float(ab @ ab)
+        if largo2 == 0.0:
+            distancias = np.hypot(intermedios[:, 0], intermedios[:, 1])
+        else:
+            t = np.clip((intermedios @ ab) / largo2, 0.0, 1.0)
+            resto = intermedios - t[:, None] * ab
+            distancias = np.hypot(resto[:, 0], resto[:, 1])
+        k = int(np.argmax(distancias))
+        if distancias[k] > tolerancia:
+            k += i + 1
+            mantener[k] = True
+            pila.append((i, k))
+            pila.append((k, j))
+    return mantener
+
+
+def decimar(xy: np.ndarray, segundos: np.ndarray, distancia: float, intervalo: float) -> np.ndarray:
+    """
+    Máscara de puntos separados al menos `distancia` metros o `intervalo` segundos
+    del último conservado (segundos NaN = sin tiempo). Conserva primero y último.
+    """
+    n = len(xy)
+    mantener = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mantener
+    xs = xy[:, 0].tolist()
+    ys = xy[:, 1].tolist()
+    ts = segundos.tolist()
+    distancia2 = distancia * distancia
+    ultimo = 0
+    mantener[0] = True
+    for k in range(1, n):
+        dx = xs[k] - xs[ultimo]
+        dy = ys[k] - ys[ultimo]
+        # Con NaN la comparación de tiempo es falsa y decide solo la distancia
+        if dx * dx + dy * dy >= distancia2 or ts[k] - ts[ultimo] >= intervalo:
+            mantener[k] = True
+            ultimo = k
+    mantener[-1] = True
+    return mantener
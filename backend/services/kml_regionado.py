@@ -0,0 +1,424 @@
+"""
+Exportación KML regionada (super-overlay) de la capa de concesiones y del
+historial de denuncias, para abrir en Google Earth capas que en un KML plano
+no cargan.
+
+Los datos se dividen con un quadtree sobre su extensión. Cada tile contiene a
+lo más KML_REGION_MAX_FEATURES elementos propios (los más importantes: mayor
+área en concesiones, más evidencias en denuncias) y el resto baja a los tiles
+hijos. Cada tile es un KML con su `Region`/`Lod` y un `NetworkLink` por hijo,
+de modo que Google Earth solo carga los tiles en vista.
+
+En los niveles gruesos la geometría se simplifica según el tamaño del tile. Un
+elemento que pierde detalle al simplificarse se traspasa además al hijo que
+contiene su centro: la copia gruesa va en un `Folder` con la `Region` de ese
+hijo y maxLodPixels = KML_REGION_MIN_LOD_PIXELS, así se oculta justo cuando el
+hijo se activa y muestra la copia más fina. En las hojas la geometría va
+completa, por lo que todo elemento se ve con su detalle total al acercarse.
+
+La pirámide se empaqueta en un KMZ (doc.kml + tiles/...) o en un directorio:
+
+    python -m services.kml_regionado salida.kmz
+    python -m services.kml_regionado carpeta_salida/
+"""
+import hashlib
+import io
+import logging
+import zipfile
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+import shapely
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from config import KML_REGION_MAX_FEATURES, KML_REGION_MAX_NIVEL, KML_REGION_MIN_LOD_PIXELS
+from services.geoprocessing.codec import decodificar
+from services.kmz_generator import KMLWriter, coordenadas_kml
+
+logger = logging.getLogger(__name__)
+
+KML_NAMESPACE = "http://www.opengis.net/kml/2.2"
+
+# Pixeles aproximados que ocupa un tile en pantalla al activarse su nivel más fino;
+# la tolerancia de simplificación es el tamaño del tile dividido por este valor
+PIXELES_TILE = 1024
+
+# Subir al cambiar la estructura de los tiles (invalida el KMZ cacheado)
+KML_REGIONADO_VERSION = 2
+
+
+@dataclass(slots=True)
+class Capa:
+    """Elementos de una capa: geometrías Shapely, importancia y datos del placemark."""
+    nombre: str
+    estilo: str
+    geometrias: np.ndarray
+    importancia: np.ndarray
+    atributos: List[Dict[str, Any]]
+    simplificar: bool = True
+
+
+@dataclass(slots=True)
+class Tile:
+    z: int
+    x: int
+    y: int
+    bbox: Tuple[float, float, float, float]  # west, south, east, north (de su subárbol)
+    indices: np.ndarray
+    hijos: List["Tile"] = field(default_factory=list)
+    # Por elemento de `indices`: posición en `hijos` del tile que tiene su copia más fina (-1: ninguno)
+    hijo_de: Optional[np.ndarray] = None
+
+    @property
+    def ruta(self) -> str:
+        return f"{self.z}/{self.x}_{self.y}.kml"
+
+
+def cargar_concesiones(db: Session) -> Capa:
+    filas = db.execute(text("""
+        SELECT id_concesion, codigo_centro, nombre, titular, tipo, region, geom
+        FROM concesiones
+        WHERE geom IS NOT NULL
+        ORDER BY id_concesion
+    """)).fetchall()
+    geometrias = decodificar(f.geom for f in filas)
+    return Capa(
+        nombre="Concesiones",
+        estilo="concesion_style",
+        geometrias=geometrias,
+        importancia=shapely.area(geometrias) if len(filas) else np.empty(0),
+        atributos=[{
+            "titulo": str(f.codigo_centro or f"Concesión #{f.id_concesion}"),
+            "Nombre": f.nombre or 'N/A',
+            "Titular": f.titular or 'N/A',
+            "Tipo": f.tipo or 'N/A',
+            "Región": f.region or 'N/A',
+        } for f in filas],
+    )
+
+
+def cargar_denuncias(db: Session) -> Capa:
+    """Una entrada por denuncia, ubicada en el centroide de sus evidencias."""
+    filas = db.execute(text("""
+        SELECT
+            d.id_denuncia,
+            d.lugar,
+            d.fecha_inspeccion,
+            e.estado,
+            COUNT(ev.id_evidencia) AS total_evidencias,
+            ST_Centroid(ST_Collect(ev.coordenadas)) AS punto
+        FROM denuncias d
+        JOIN evidencias ev ON ev.id_denuncia = d.id_denuncia
+        LEFT JOIN estados_denuncia e ON e.id_estado = d.id_estado
+        WHERE ev.coordenadas IS NOT NULL
+        GROUP BY d.id_denuncia, d.lugar, d.fecha_inspeccion, e.estado
+        ORDER BY d.id_denuncia
+    """)).fetchall()
+    return Capa(
+        nombre="Denuncias",
+        estilo="denuncia_style",
+        geometrias=decodificar(f.punto for f in filas),
+        importancia=np.array([f.total_evidencias for f in filas], dtype=np.float64),
+        atributos=[{
+            "titulo": f"Denuncia #{f.id_denuncia}",
+            "Lugar": f.lugar or 'N/A',
+            "Fecha de inspección": f.fecha_inspeccion.strftime('%d/%m/%Y') if f.fecha_inspeccion else 'N/A',
+            "Estado": f.estado or 'N/A',
+            "Evidencias": f.total_evidencias,
+        } for f in filas],
+        simplificar=False,
+    )
+
+
+def huella_capas(db: Session) -> str:
+    """
+    Huella de los datos exportados (para la cache de artefactos).
+
+    Cubre las mismas filas y columnas que emiten cargar_concesiones y
+    cargar_denuncias, incluido el centroide de las evidencias de cada denuncia.
+    """
+    fila = db.execute(text("""
+        SELECT
+            (SELECT md5(string_agg(concat_ws(':', id_concesion, md5(ST_AsEWKB(geom)),
+                                             coalesce(codigo_centro::text, ''), coalesce(nombre, ''),
+                                             coalesce(titular, ''), coalesce(tipo, ''), coalesce(region, '')),
+                                   ',' ORDER BY id_concesion))
+             FROM concesiones
+             WHERE geom IS NOT NULL) AS concesiones,
+            (SELECT md5(string_agg(concat_ws(':', id_denuncia, coalesce(lugar, ''),
+                                             coalesce(fecha_inspeccion::text, ''), coalesce(estado, ''),
+                                             total_evidencias, centroide),
+                                   ',' ORDER BY id_denuncia))
+             FROM (
+                 SELECT
+                     d.id_denuncia,
+                     d.lugar,
+                     d.fecha_inspeccion,
+                     e.estado,
+                     COUNT(ev.id_evidencia) AS total_evidencias,
+                     md5(ST_AsEWKB(ST_Centroid(ST_Collect(ev.coordenadas)))) AS centroide
+                 FROM denuncias d
+                 JOIN evidencias ev ON ev.id_denuncia = d.id_denuncia
+                 LEFT JOIN estados_denuncia e ON e.id_estado = d.id_estado
+                 WHERE ev.coordenadas IS NOT NULL
+                 GROUP BY d.id_denuncia, d.lugar, d.fecha_inspeccion, e.estado
+             ) AS f) AS denuncias,
+            (SELECT max(id_evidencia) FROM evidencias) AS ultima_evidencia
+    """)).fetchone()
+    partes = [KML_REGIONADO_VERSION, KML_REGION_MAX_FEATURES, KML_REGION_MAX_NIVEL, KML_REGION_MIN_LOD_PIXELS,
+              fila.concesiones, fila.denuncias, fila.ultima_evidencia]
+    return hashlib.sha256(repr(partes).encode("utf-8")).hexdigest()
+
+
+def _tolerancia(bbox: Tuple[float, float, float, float]) -> float:
+    """Tolerancia de simplificación (grados) de un tile no hoja."""
+    w, s, e, n = bbox
+    return max(e - w, n - s) / PIXELES_TILE
+
+
+def construir_quadtree(capa: Capa, max_features: int = KML_REGION_MAX_FEATURES,
+                       max_nivel: int = KML_REGION_MAX_NIVEL) -> Optional[Tile]:
+    """
+    Divide la capa en tiles. Cada tile se queda con sus `max_features` elementos
+    más importantes y reparte el resto entre sus cuadrantes según el centro de
+    cada elemento.
+    """
+    validos = np.flatnonzero(~shapely.is_missing(capa.geometrias) & ~shapely.is_empty(capa.geometrias)) \
+        if capa.geometrias.size else np.empty(0, dtype=np.intp)
+    if validos.size == 0:
+        return None
+
+    limites = shapely.bounds(capa.geometrias[validos])
+    limites_por_indice = np.full((len(capa.geometrias), 4), np.nan)
+    limites_por_indice[validos] = limites
+    centros = np.column_stack((
+        (limites_por_indice[:, 0] + limites_por_indice[:, 2]) / 2,
+        (limites_por_indice[:, 1] + limites_por_indice[:, 3]) / 2,
+    ))
+    # Orden global por importancia: cada tile toma los primeros de su subconjunto
+    orden = validos[np.argsort(-capa.importancia[validos], kind="stable")]
+
+    w, s = limites[:, 0].min(), limites[:, 1].min()
+    e, n = limites[:, 2].max(), limites[:, 3].max()
+    lado = max(e - w, n - s) or 1e-6
+
+    def _construir(propios: np.ndarray, heredados: np.ndarray, x0: float, y0: float, lado: float,
+                   z: int, x: int, y: int) -> Tile:
+        indices = np.concatenate((propios, heredados))
+        caja = limites_por_indice[indices]
+        tile = Tile(z, x, y, (caja[:, 0].min(), caja[:, 1].min(), caja[:, 2].max(), caja[:, 3].max()), indices)
+        if len(propios) <= max_features or z >= max_nivel:
+            return tile
+
+        propios, resto = propios[:max_features], propios[max_features:]
+        tile.indices = np.concatenate((propios, heredados))
+        tile.hijo_de = np.full(len(tile.indices), -1)
+        # Los elementos que pierden vértices al simplificar a la escala del tile bajan también a los hijos
+        if capa.simplificar:
+            geometrias = capa.geometrias[tile.indices]
+            simplificadas = shapely.simplify(geometrias, _tolerancia(tile.bbox), preserve_topology=True)
+            traspasar = shapely.get_num_coordinates(simplificadas) < shapely.get_num_coordinates(geometrias)
+        else:
+            traspasar = np.zeros(len(tile.indices), dtype=bool)
+
+        mitad = lado / 2
+        derecha_resto = centros[resto, 0] >= x0 + mitad
+        arriba_resto = centros[resto, 1] >= y0 + mitad
+        derecha_tile = centros[tile.indices, 0] >= x0 + mitad
+        arriba_tile = centros[tile.indices, 1] >= y0 + mitad
+        for dx in (0, 1):
+            for dy in (0, 1):
+                en_cuadrante = resto[(derecha_resto == bool(dx)) & (arriba_resto == bool(dy))]
+                traspasados = np.flatnonzero(traspasar & (derecha_tile == bool(dx)) & (arriba_tile == bool(dy)))
+                if en_cuadrante.size or traspasados.size:
+                    tile.hijo_de[traspasados] = len(tile.hijos)
+                    tile.hijos.append(_construir(en_cuadrante, tile.indices[traspasados],
+                                                 x0 + dx * mitad, y0 + dy * mitad,
+                                                 mitad, z + 1, 2 * x + dx, 2 * y + (1 - dy)))
+        return tile
+
+    return _construir(orden, np.empty(0, dtype=orden.dtype), w, s, lado, 0, 0, 0)
+
+
+def _escribir_region(kml: KMLWriter, bbox: Tuple[float, float, float, float],
+                     min_lod: int = KML_REGION_MIN_LOD_PIXELS, max_lod: int = -1) -> None:
+    w, s, e, n = bbox
+    with kml.bloque('Region'):
+        with kml.bloque('LatLonAltBox'):
+            kml.elemento('north', f"{n:.7f}")
+            kml.elemento('south', f"{s:.7f}")
+            kml.elemento('east', f"{e:.7f}")
+            kml.elemento('west', f"{w:.7f}")
+        with kml.bloque('Lod'):
+            kml.elemento('minLodPixels', min_lod)
+            kml.elemento('maxLodPixels', max_lod)
+
+
+def _escribir_estilos(kml: KMLWriter) -> None:
+    with kml.bloque('Style', id='concesion_style'):
+        with kml.bloque('LineStyle'):
+            kml.elemento('color', 'ff0000ff')  # Rojo (ABGR)
+            kml.elemento('width', '1.5')
+        with kml.bloque('PolyStyle'):
+            kml.elemento('color', '400000ff')
+    with kml.bloque('Style', id='denuncia_style'):
+        with kml.bloque('IconStyle'):
+            kml.elemento('color', 'ff00ffff')  # Amarillo (ABGR)
+            with kml.bloque('Icon'):
+                kml.elemento('href', 'http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png')
+
+
+def _escribir_geometria(kml: KMLWriter, geom) -> None:
+    tipo = shapely.get_type_id(geom)
+    if tipo == 0:  # Point
+        with kml.bloque('Point'):
+            kml.elemento('coordinates', f"{geom.x:.7f},{geom.y:.7f},0")
+    elif tipo == 3:  # Polygon
+        with kml.bloque('Polygon'):
+            with kml.bloque('outerBoundaryIs'), kml.bloque('LinearRing'):
+                kml.elemento('coordinates', coordenadas_kml(shapely.get_coordinates(geom.exterior)))
+            for hueco in geom.interiors:
+                with kml.bloque('innerBoundaryIs'), kml.bloque('LinearRing'):
+                    kml.elemento('coordinates', coordenadas_kml(shapely.get_coordinates(hueco)))
+    elif tipo in (4, 6, 7):  # Multi* / GeometryCollection
+        with kml.bloque('MultiGeometry'):
+            for parte in geom.geoms:
+                _escribir_geometria(kml, parte)
+
+
+def _descripcion(atributos: Dict[str, Any]) -> str:
+    filas = "".join(f"<tr><td><b>{k}:</b></td><td>{v}</td></tr>" for k, v in atributos.items() if k != "titulo")
+    return f"<h4>{atributos['titulo']}</h4><table>{filas}</table>"
+
+
+def _escribir_tile(out, capa: Capa, tile: Tile) -> None:
+    kml = KMLWriter(out)
+    kml.declaracion()
+    with kml.bloque('kml', xmlns=KML_NAMESPACE), kml.bloque('Document'):
+        kml.elemento('name', f"{capa.nombre} {tile.z}/{tile.x}_{tile.y}")
+        _escribir_region(kml, tile.bbox)
+        _escribir_estilos(kml)
+
+        geometrias = capa.geometrias[tile.indices]
+        hijo_de = tile.hijo_de if tile.hijo_de is not None else np.full(len(tile.indices), -1)
+        if capa.simplificar and tile.hijos:
+            geometrias = shapely.simplify(geometrias, _tolerancia(tile.bbox), preserve_topology=True)
+
+        def _placemarks(posiciones):
+            for pos in posiciones:
+                geom = geometrias[pos]
+                if geom is None or geom.is_empty:
+                    continue
+                atributos = capa.atributos[tile.indices[pos]]
+                with kml.bloque('Placemark'):
+                    kml.elemento('name', atributos['titulo'])
+                    kml.elemento('description', _descripcion(atributos))
+                    kml.elemento('styleUrl', f"#{capa.estilo}")
+                    _escribir_geometria(kml, geom)
+
+        _placemarks(np.flatnonzero(hijo_de < 0).tolist())
+        # Copias gruesas: visibles hasta que se activa el hijo con la copia más fina
+        for posicion_hijo, hijo in enumerate(tile.hijos):
+            posiciones = np.flatnonzero(hijo_de == posicion_hijo).tolist()
+            if not posiciones:
+                continue
+            with kml.bloque('Folder'):
+                _escribir_region(kml, hijo.bbox, min_lod=0, max_lod=KML_REGION_MIN_LOD_PIXELS)
+                _placemarks(posiciones)
+
+        for hijo in tile.hijos:
+            with kml.bloque('NetworkLink'):
+                kml.elemento('name', f"{hijo.z}/{hijo.x}_{hijo.y}")
+                _escribir_region(kml, hijo.bbox)
+                with kml.bloque('Link'):
+                    # Ruta relativa al tile actual (tiles/<capa>/<z>/<x>_<y>.kml)
+                    kml.elemento('href', f"../{hijo.ruta}")
+                    kml.elemento('viewRefreshMode', 'onRegion')
+
+
+def _recorrer(tile: Tile):
+    yield tile
+    for hijo in tile.hijos:
+        yield from _recorrer(hijo)
+
+
+def escribir_piramide(abrir: Callable[[str], Any], capas: List[Capa]) -> Dict[str, int]:
+    """
+    Escribe doc.kml y los tiles de cada capa usando `abrir(nombre)`, un context
+    manager que entrega un stream de texto para el archivo `nombre`.
+
+    Returns:
+        dict: tiles escritos por capa
+    """
+    raices = []
+    resumen = {}
+    for capa in capas:
+        raiz = construir_quadtree(capa)
+        if raiz is None:
+            continue
+        prefijo = f"tiles/{capa.nombre.lower()}"
+        tiles = 0
+        for tile in _recorrer(raiz):
+            with abrir(f"{prefijo}/{tile.ruta}") as out:
+                _escribir_tile(out, capa, tile)
+            tiles += 1
+        raices.append((capa, raiz, prefijo))
+        resumen[capa.nombre] = tiles
+
+    with abrir("doc.kml") as out:
+        kml = KMLWriter(out)
+        kml.declaracion()
+        with kml.bloque('kml', xmlns=KML_NAMESPACE), kml.bloque('Document'):
+            kml.elemento('name', 'Playas Limpias - Concesiones y denuncias')
+            for capa, raiz, prefijo in raices:
+                with kml.bloque('NetworkLink'):
+                    kml.elemento('name', f"{capa.nombre} ({len(capa.atributos)})")
+                    with kml.bloque('Link'):
+                        kml.elemento('href', f"{prefijo}/{raiz.ruta}")
+    return resumen
+
+
+def escribir_kmz(destino, capas: List[Capa]) -> Dict[str, int]:
+    """Empaqueta la pirámide en un KMZ escrito en el stream binario `destino`."""
+    with zipfile.ZipFile(destino, 'w', zipfile.ZIP_DEFLATED) as kmz:
+        @contextmanager
+        def abrir(nombre):
+            with kmz.open(nombre, 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8') as out:
+                yield out
+        return escribir_piramide(abrir, capas)
+
+
+def escribir_directorio(destino: Path, capas: List[Capa]) -> Dict[str, int]:
+    """Escribe la pirámide como archivos sueltos bajo `destino` (p.ej. para servir por HTTP)."""
+    @contextmanager
+    def abrir(nombre):
+        ruta = destino / nombre
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        with open(ruta, 'w', encoding='utf-8') as out:
+            yield out
+    return escribir_piramide(abrir, capas)
+
+
+if __name__ == "__main__":
+    import argparse
+    from db import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Exporta concesiones y denuncias como KML regionado")
+    parser.add_argument("salida", help="archivo .kmz o directorio de salida")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        capas = [cargar_concesiones(db), cargar_denuncias(db)]
+    finally:
+        db.close()
+
+    salida = Path(args.salida)
+    if salida.suffix.lower() == ".kmz":
+        with open(salida, "wb") as f:
+            resumen = escribir_kmz(f, capas)
+    else:
+        resumen = escribir_directorio(salida, capas)
+    print(f"KML regionado escrito en {salida}: {resumen}")
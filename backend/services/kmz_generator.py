@@ -1,16 +1,78 @@
 import zipfile
-from io import BytesIO
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import io
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
 import json
 import os
+import numpy as np
+from config import KMZ_PHOTO_READ_WORKERS
+from services.artifact_cache import ruta_foto
+from services.streaming import stream_desde_hilo
 
 logger = logging.getLogger(__name__)
 
+# Formatos que no ganan nada con deflate
+FORMATOS_COMPRIMIDOS = {'.jpg', '.jpeg', '.png'}
+
+
+def coordenadas_kml(anillo) -> str:
+    """
+    Formatea un anillo GeoJSON como texto de <coordinates> ("lon,lat,0 lon,lat,0 ...").
+    
+    El formateo es una sola operación '%' sobre el array aplanado, en vez de
+    concatenar un string por vértice.
+    """
+    xy = np.asarray(anillo, dtype=np.float64)
+    if xy.ndim != 2 or xy.shape[0] == 0 or xy.shape[1] < 2:
+        return ""
+    xy = xy[:, :2]
+    return " ".join(["%.7f,%.7f,0"] * xy.shape[0]) % tuple(xy.ravel().tolist())
+
+
+class KMLWriter:
+    """
+    Escritor incremental de KML sobre un stream de texto (p.ej. una entrada del zip).
+    
+    Emite cada elemento apenas se agrega, con sangría de 2 espacios, en lugar de
+    construir un árbol completo y re-serializarlo.
+    """
+    
+    def __init__(self, out, indent: str = "  "):
+        self.out = out
+        self.indent = indent
+        self._pila: List[str] = []
+    
+    def _atributos(self, attrs: Dict[str, Any]) -> str:
+        return "".join(f" {k}={quoteattr(str(v))}" for k, v in attrs.items())
+    
+    def declaracion(self):
+        self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    
+    def abrir(self, tag: str, **attrs):
+        self.out.write(f"{self.indent * len(self._pila)}<{tag}{self._atributos(attrs)}>\n")
+        self._pila.append(tag)
+    
+    def cerrar(self):
+        tag = self._pila.pop()
+        self.out.write(f"{self.indent * len(self._pila)}</{tag}>\n")
+    
+    @contextmanager
+    def bloque(self, tag: str, **attrs):
+        self.abrir(tag, **attrs)
+        yield self
+        self.cerrar()
+    
+    def elemento(self, tag: str, texto: Any, **attrs):
+        self.out.write(f"{self.indent * len(self._pila)}<{tag}{self._atributos(attrs)}>{escape(str(texto))}</{tag}>\n")
+
+
 class KMZGenerator:
     """
     Generador de archivos KMZ para Google Earth.
@@ -28,59 +90,64 @@ class KMZGenerator:
         self.kml_namespace = "http://www.opengis.net/kml/2.2"
         logger.info("KMZGenerator inicializado")
     
-    async def generate_analysis_kmz(self, analisis, evidencias, concesiones, buffer_geom):
+    def escribir_kmz(self, destino, analisis, evidencias, concesiones, buffer_geom):
         """
-        Generar archivo KMZ completo para un análisis de inspección
+        Escribir el KMZ completo en el stream binario `destino` (síncrono).
+        
+        `destino` puede no ser seekable (p.ej. la respuesta en streaming): zipfile
+        usa entonces data descriptors y cada entrada se emite a medida que se escribe.
         
         Args:
+            destino: stream binario de escritura
             analisis: Objeto AnalisisDenuncia
             evidencias: Lista de objetos Evidencia
             concesiones: Lista de objetos Concesion
             buffer_geom: GeoJSON del buffer
+        """
+        with zipfile.ZipFile(destino, 'w', zipfile.ZIP_DEFLATED) as kmz:
+            # KML principal escrito directamente en la entrada del zip
+            with kmz.open('doc.kml', 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8') as out:
+                self._create_kml(out, analisis, evidencias, concesiones, buffer_geom)
             
-        Returns:
-            bytes: Contenido del archivo KMZ
+            # Agregar fotografías si existen
+            self._add_photos_to_kmz(kmz, evidencias)
+    
+    async def stream_analysis_kmz(self, analisis, evidencias, concesiones, buffer_geom):
         """
+        Generar el KMZ como un stream de bloques de bytes.
+        
+        El zip se arma en un hilo y cada bloque se entrega apenas se produce
+        (services.streaming); si el consumidor deja de iterar, la generación se detiene.
+        
+        Yields:
+            bytes: bloques del archivo KMZ
+        """
+        logger.info(f"Iniciando generación de KMZ (stream) para análisis {analisis.id_analisis}")
+        total = 0
         try:
-            logger.info(f"Iniciando generación de KMZ para análisis {analisis.id_analisis}")
-            
-            # 1. Crear contenido KML
-            kml_content = self._create_kml(analisis, evidencias, concesiones, buffer_geom)
-            
-            # 2. Crear archivo ZIP (KMZ)
-            kmz_buffer = BytesIO()
-            
-            with zipfile.ZipFile(kmz_buffer, 'w', zipfile.ZIP_DEFLATED) as kmz:
-                # Agregar KML principal
-                kmz.writestr('doc.kml', kml_content, compress_type=zipfile.ZIP_DEFLATED)
-                
-                # Agregar fotografías si existen
-                await self._add_photos_to_kmz(kmz, evidencias)
-            
-            kmz_buffer.seek(0)
-            kmz_bytes = kmz_buffer.getvalue()
-            
-            logger.info(f"KMZ generado exitosamente para análisis {analisis.id_analisis} ({len(kmz_bytes)} bytes)")
-            return kmz_bytes
-            
+            async for bloque in stream_desde_hilo(
+                lambda salida: self.escribir_kmz(salida, analisis, evidencias, concesiones, buffer_geom)
+            ):
+                total += len(bloque)
+                yield bloque
         except Exception as e:
             logger.error(f"Error generando KMZ para análisis {analisis.id_analisis}: {str(e)}")
             raise
+        logger.info(f"KMZ generado exitosamente para análisis {analisis.id_analisis} ({total} bytes)")
     
-    def _create_kml(self, analisis, evidencias, concesiones, buffer_geom):
+    def _create_kml(self, out, analisis, evidencias, concesiones, buffer_geom):
         """
-        Crear contenido KML completo
+        Escribir el KML completo en el stream de texto `out`.
         
-        Returns:
-            str: Contenido XML del KML
+        Cada elemento se emite apenas se procesa (no se arma un árbol en memoria).
         """
-        # Crear documento KML
-        kml = ET.Element('kml', xmlns=self.kml_namespace)
-        document = ET.SubElement(kml, 'Document')
+        kml = KMLWriter(out)
+        kml.declaracion()
         
-        # Metadata del documento
-        ET.SubElement(document, 'name').text = str(f"Inspección - Análisis #{analisis.id_analisis}")
-        ET.SubElement(document, 'description').text = str(f"""
+        with kml.bloque('kml', xmlns=self.kml_namespace), kml.bloque('Document'):
+            # Metadata del documento
+            kml.elemento('name', f"Inspección - Análisis #{analisis.id_analisis}")
+            kml.elemento('description', f"""
             <![CDATA[
             <h3>Análisis de Inspección</h3>
             <p><b>ID de Análisis:</b> {analisis.id_analisis}</p>
@@ -92,121 +159,87 @@ class KMZGenerator:
             ]]>
         """)
         
-        # Agregar estilos personalizados
-        self._add_styles(document)
-        
-        # Agregar ListStyle para mejor navegación
-        list_style = ET.SubElement(document, 'ListStyle')
-        ET.SubElement(list_style, 'listItemType').text = 'check'
-        ET.SubElement(list_style, 'bgColor').text = 'ffffffff'
-        
-        # Carpeta de evidencias GPS
-        if evidencias:
-            evidencias_folder = ET.SubElement(document, 'Folder')
-            ET.SubElement(evidencias_folder, 'name').text = 'Evidencias GPS'
-            ET.SubElement(evidencias_folder, 'description').text = str(f'Puntos GPS recolectados durante la inspección ({len(evidencias)} puntos)')
-            
-            for evidencia in evidencias:
-                if hasattr(evidencia, 'coordenadas') and evidencia.coordenadas:
-                    self._add_evidencia_placemark(evidencias_folder, evidencia)
-        
-        # Buffer
-        if buffer_geom:
-            buffer_folder = ET.SubElement(document, 'Folder')
-            ET.SubElement(buffer_folder, 'name').text = 'Área de Buffer'
-            ET.SubElement(buffer_folder, 'description').text = str(f'Área de análisis con buffer de {analisis.distancia_buffer}m')
-            
-            self._add_buffer_placemark(buffer_folder, analisis, buffer_geom)
-        
-        # Concesiones
-        if concesiones:
-            concesiones_folder = ET.SubElement(document, 'Folder')
-            ET.SubElement(concesiones_folder, 'name').text = 'Concesiones Intersectadas'
-            ET.SubElement(concesiones_folder, 'description').text = str(f'Concesiones que intersectan con el área de buffer ({len(concesiones)} concesiones)')
+            # Agregar estilos personalizados
+            self._add_styles(kml)
+            
+            # Agregar ListStyle para mejor navegación
+            with kml.bloque('ListStyle'):
+                kml.elemento('listItemType', 'check')
+                kml.elemento('bgColor', 'ffffffff')
+            
+            # Carpeta de evidencias GPS
+            if evidencias:
+                with kml.bloque('Folder'):
+                    kml.elemento('name', 'Evidencias GPS')
+                    kml.elemento('description', f'Puntos GPS recolectados durante la inspección ({len(evidencias)} puntos)')
+                    
+                    for evidencia in evidencias:
+                        if hasattr(evidencia, 'coordenadas') and evidencia.coordenadas:
+                            self._add_evidencia_placemark(kml, evidencia)
+            
+            # Buffer
+            if buffer_geom:
+                with kml.bloque('Folder'):
+                    kml.elemento('name', 'Área de Buffer')
+                    kml.elemento('description', f'Área de análisis con buffer de {analisis.distancia_buffer}m')
+                    
+                    self._add_buffer_placemark(kml, analisis, buffer_geom)
             
-            for concesion in concesiones:
-                if hasattr(concesion, 'geom') and concesion.geom:
-                    self._add_concesion_placemark(concesiones_folder, concesion)
-        
-        # Convertir a string XML formateado
-        try:
-            rough_string = ET.tostring(kml, 'unicode')
-            reparsed = minidom.parseString(rough_string)
-            return reparsed.toprettyxml(indent="  ")
-        except Exception as e:
-            logger.error(f"Error serializando KML: {e}")
-            # Fallback: retornar XML simple sin formatear
-            return ET.tostring(kml, 'unicode')
+            # Concesiones
+            if concesiones:
+                with kml.bloque('Folder'):
+                    kml.elemento('name', 'Concesiones Intersectadas')
+                    kml.elemento('description', f'Concesiones que intersectan con el área de buffer ({len(concesiones)} concesiones)')
+                    
+                    for concesion in concesiones:
+                        if hasattr(concesion, 'geom') and concesion.geom:
+                            self._add_concesion_placemark(kml, concesion)
     
-    def _add_styles(self, document):
+    def _add_style(self, kml, style_id, icon=None, line=None, poly=None):
+        """Escribir un Style con BalloonStyle común (fondo blanco, texto negro)"""
+        with kml.bloque('Style', id=style_id):
+            if icon:
+                color, scale, href = icon
+                with kml.bloque('IconStyle'):
+                    kml.elemento('color', color)
+                    kml.elemento('scale', scale)
+                    with kml.bloque('Icon'):
+                        kml.elemento('href', href)
+            if line:
+                color, width = line
+                with kml.bloque('LineStyle'):
+                    kml.elemento('color', color)
+                    kml.elemento('width', width)
+            if poly:
+                with kml.bloque('PolyStyle'):
+                    kml.elemento('color', poly)
+                    kml.elemento('fill', '1')  # Con relleno para interactividad
+                    kml.elemento('outline', '1')  # Con contorno
+            # BalloonStyle para mejor interactividad
+            with kml.bloque('BalloonStyle'):
+                kml.elemento('text', '$[description]')
+                kml.elemento('bgColor', 'ffffffff')  # Fondo blanco
+                kml.elemento('textColor', 'ff000000')  # Texto negro
+    
+    def _add_styles(self, kml):
         """Agregar estilos personalizados para diferentes elementos"""
         
-        # Estilo para evidencias GPS (círculos amarillos pequeños)
-        evidencia_style = ET.SubElement(document, 'Style', id='evidencia_style')
-        icon_style = ET.SubElement(evidencia_style, 'IconStyle')
-        ET.SubElement(icon_style, 'color').text = str('ff00ffff')  # Amarillo (ABGR)
-        ET.SubElement(icon_style, 'scale').text = str('1.2')  # Escala más pequeña
+        # Estilo para evidencias GPS (círculos amarillos pequeños, colores en ABGR)
         # Usar ícono de círculo correcto según documentación oficial
-        icon_element = ET.SubElement(icon_style, 'Icon')
-        ET.SubElement(icon_element, 'href').text = str('http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png')
-        # BalloonStyle para mejor interactividad
-        balloon_style = ET.SubElement(evidencia_style, 'BalloonStyle')
-        ET.SubElement(balloon_style, 'text').text = str('$[description]')
-        ET.SubElement(balloon_style, 'bgColor').text = str('ffffffff')  # Fondo blanco
-        ET.SubElement(balloon_style, 'textColor').text = str('ff000000')  # Texto negro
+        self._add_style(kml, 'evidencia_style',
+                        icon=('ff00ffff', '1.2', 'http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png'))
         
         # Estilo para buffer (línea verde, con relleno muy transparente para interactividad)
-        buffer_style = ET.SubElement(document, 'Style', id='buffer_style')
-        line_style = ET.SubElement(buffer_style, 'LineStyle')
-        ET.SubElement(line_style, 'color').text = str('ff00ff00')  # Verde (ABGR)
-        ET.SubElement(line_style, 'width').text = str('3')
-        poly_style = ET.SubElement(buffer_style, 'PolyStyle')
-        ET.SubElement(poly_style, 'color').text = str('0a00ff00')  # Verde muy transparente (10% opacidad)
-        ET.SubElement(poly_style, 'fill').text = str('1')  # Con relleno para interactividad
-        ET.SubElement(poly_style, 'outline').text = str('1')  # Con contorno
-        # BalloonStyle para mejor interactividad
-        balloon_style = ET.SubElement(buffer_style, 'BalloonStyle')
-        ET.SubElement(balloon_style, 'text').text = str('$[description]')
-        ET.SubElement(balloon_style, 'bgColor').text = str('ffffffff')  # Fondo blanco
-        ET.SubElement(balloon_style, 'textColor').text = str('ff000000')  # Texto negro
-        
-        # Estilo para concesiones válidas (rojo, con relleno muy transparente para interactividad)
-        concesion_valida_style = ET.SubElement(document, 'Style', id='concesion_valida_style')
-        line_style = ET.SubElement(concesion_valida_style, 'LineStyle')
-        ET.SubElement(line_style, 'color').text = str('ff0000ff')  # Rojo (ABGR)
-        ET.SubElement(line_style, 'width').text = str('2')
-        poly_style = ET.SubElement(concesion_valida_style, 'PolyStyle')
-        ET.SubElement(poly_style, 'color').text = str('0a0000ff')  # Rojo muy transparente (10% opacidad)
-        ET.SubElement(poly_style, 'fill').text = str('1')  # Con relleno para interactividad
-        ET.SubElement(poly_style, 'outline').text = str('1')  # Con contorno
-        # BalloonStyle para mejor interactividad
-        balloon_style = ET.SubElement(concesion_valida_style, 'BalloonStyle')
-        ET.SubElement(balloon_style, 'text').text = str('$[description]')
-        ET.SubElement(balloon_style, 'bgColor').text = str('ffffffff')  # Fondo blanco
-        ET.SubElement(balloon_style, 'textColor').text = str('ff000000')  # Texto negro
+        self._add_style(kml, 'buffer_style', line=('ff00ff00', '3'), poly='0a00ff00')
         
-        # Estilo para concesiones no válidas (rojo, con relleno muy transparente para interactividad)
-        concesion_invalida_style = ET.SubElement(document, 'Style', id='concesion_invalida_style')
-        line_style = ET.SubElement(concesion_invalida_style, 'LineStyle')
-        ET.SubElement(line_style, 'color').text = str('ff0000ff')  # Rojo (ABGR)
-        ET.SubElement(line_style, 'width').text = str('2')
-        poly_style = ET.SubElement(concesion_invalida_style, 'PolyStyle')
-        ET.SubElement(poly_style, 'color').text = str('0a0000ff')  # Rojo muy transparente (10% opacidad)
-        ET.SubElement(poly_style, 'fill').text = str('1')  # Con relleno para interactividad
-        ET.SubElement(poly_style, 'outline').text = str('1')  # Con contorno
-        # BalloonStyle para mejor interactividad
-        balloon_style = ET.SubElement(concesion_invalida_style, 'BalloonStyle')
-        ET.SubElement(balloon_style, 'text').text = str('$[description]')
-        ET.SubElement(balloon_style, 'bgColor').text = str('ffffffff')  # Fondo blanco
-        ET.SubElement(balloon_style, 'textColor').text = str('ff000000')  # Texto negro
+        # Estilos para concesiones (rojo, con relleno muy transparente para interactividad)
+        self._add_style(kml, 'concesion_valida_style', line=('ff0000ff', '2'), poly='0a0000ff')
+        self._add_style(kml, 'concesion_invalida_style', line=('ff0000ff', '2'), poly='0a0000ff')
     
-    def _add_evidencia_placemark(self, folder, evidencia):
+    def _add_evidencia_placemark(self, kml, evidencia):
         """Agregar placemark para una evidencia GPS"""
         try:
-            placemark = ET.SubElement(folder, 'Placemark')
-            ET.SubElement(placemark, 'name').text = str(f"Evidencia #{evidencia.id_evidencia}")
-            
-            # Descripción enriquecida
+            # Preparar todos los valores antes de escribir (un error no deja el XML a medias)
             fecha_str = evidencia.fecha.strftime('%d/%m/%Y') if hasattr(evidencia.fecha, 'strftime') else str(evidencia.fecha)
             hora_str = evidencia.hora.strftime('%H:%M:%S') if hasattr(evidencia.hora, 'strftime') else str(evidencia.hora)
             lat = float(evidencia.coordenadas['coordinates'][1])
@@ -226,36 +259,34 @@ class KMZGenerator:
             if hasattr(evidencia, 'foto_url') and evidencia.foto_url:
                 # Incluir la foto en la descripción del KML
                 # La ruta debe ser relativa al KMZ, no al sistema de archivos
-                foto_url = evidencia.foto_url
-                
-                # Remover slash inicial si existe
-                if foto_url.startswith('/'):
-                    foto_url = foto_url[1:]
-                
-                # Extraer solo el nombre del archivo de la ruta
-                nombre_archivo = Path(foto_url).name
-                foto_filename = f"fotos/evidencia_{evidencia.id_evidencia}_{nombre_archivo}"
+                foto_filename = self._foto_en_kmz(evidencia)
                 descripcion += f"<p>📷 <b>Fotografía:</b></p>"
                 descripcion += f"<img src='{foto_filename}' width='300' style='max-width:100%; height:auto;' />"
             descripcion += "]]>"
             
-            ET.SubElement(placemark, 'description').text = str(descripcion)
-            ET.SubElement(placemark, 'styleUrl').text = '#evidencia_style'
-            
-            # Punto simple
-            point = ET.SubElement(placemark, 'Point')
-            coords = f"{lon},{lat},0"
-            ET.SubElement(point, 'coordinates').text = str(coords)
-            
+            with kml.bloque('Placemark'):
+                kml.elemento('name', f"Evidencia #{evidencia.id_evidencia}")
+                kml.elemento('description', descripcion)
+                kml.elemento('styleUrl', '#evidencia_style')
+                
+                # Punto simple
+                with kml.bloque('Point'):
+                    kml.elemento('coordinates', f"{lon},{lat},0")
+        
         except Exception as e:
             logger.error(f"Error agregando evidencia {evidencia.id_evidencia}: {e}")
     
-    def _add_buffer_placemark(self, folder, analisis, buffer_geom):
+    def _foto_en_kmz(self, evidencia):
+        """Ruta de la foto de una evidencia dentro del KMZ: fotos/evidencia_X_nombre.jpg"""
+        return f"fotos/evidencia_{evidencia.id_evidencia}_{Path(evidencia.foto_url.lstrip('/')).name}"
+    
+    def _add_buffer_placemark(self, kml, analisis, buffer_geom):
         """Agregar placemark para el buffer"""
         try:
-            placemark = ET.SubElement(folder, 'Placemark')
-            ET.SubElement(placemark, 'name').text = str(f"Buffer {analisis.distancia_buffer}m")
-            ET.SubElement(placemark, 'description').text = str(f"""
+            geometria = self._geojson_a_kml(buffer_geom)
+            with kml.bloque('Placemark'):
+                kml.elemento('name', f"Buffer {analisis.distancia_buffer}m")
+                kml.elemento('description', f"""
             <![CDATA[
             <h4>Área de Buffer</h4>
             <p><b>Distancia:</b> {analisis.distancia_buffer}m</p>
@@ -263,20 +294,15 @@ class KMZGenerator:
             <p>Esta área representa la zona de análisis alrededor de los puntos GPS recolectados.</p>
             ]]>
             """)
-            ET.SubElement(placemark, 'styleUrl').text = '#buffer_style'
-            
-            # Convertir GeoJSON a KML geometry
-            self._add_geojson_to_kml(placemark, buffer_geom)
-            
+                kml.elemento('styleUrl', '#buffer_style')
+                self._write_geometria(kml, geometria)
+        
         except Exception as e:
             logger.error(f"Error agregando buffer: {e}")
     
-    def _add_concesion_placemark(self, folder, concesion):
+    def _add_concesion_placemark(self, kml, concesion):
         """Agregar placemark para una concesión"""
         try:
-            placemark = ET.SubElement(folder, 'Placemark')
-            ET.SubElement(placemark, 'name').text = str(concesion.codigo_centro or f"Concesión #{concesion.id_concesion}")
-            
             # Determinar estilo basado en intersección válida
             # Por ahora usamos válida, pero esto debería venir de los resultados
             style_id = '#concesion_valida_style'
@@ -294,25 +320,32 @@ class KMZGenerator:
             ]]>
             """
             
-            ET.SubElement(placemark, 'description').text = str(descripcion)
-            ET.SubElement(placemark, 'styleUrl').text = style_id
-            
             # Convertir GeoJSON a KML geometry
+            geometria = None
             if hasattr(concesion, 'geom') and concesion.geom:
-                self._add_geojson_to_kml(placemark, concesion.geom)
+                geometria = self._geojson_a_kml(concesion.geom)
             else:
                 logger.warning(f"Concesión {concesion.id_concesion} sin geometría válida")
             
+            with kml.bloque('Placemark'):
+                kml.elemento('name', concesion.codigo_centro or f"Concesión #{concesion.id_concesion}")
+                kml.elemento('description', descripcion)
+                kml.elemento('styleUrl', style_id)
+                self._write_geometria(kml, geometria)
+        
         except Exception as e:
             logger.error(f"Error agregando concesión {concesion.id_concesion}: {e}")
     
-    def _add_geojson_to_kml(self, placemark, geojson):
+    def _geojson_a_kml(self, geojson):
         """
-        Convertir geometría GeoJSON a elementos KML
+        Convertir geometría GeoJSON a coordenadas KML ya formateadas
         
         Args:
-            placemark: Elemento Placemark donde agregar la geometría
-            geojson: Diccionario GeoJSON
+            geojson: Diccionario GeoJSON (o string JSON)
+        
+        Returns:
+            tuple: ('Point', coords), ('Polygon', [anillos]) o ('MultiPolygon', [[anillos], ...]);
+                   None si la geometría no es soportada o está vacía
         """
         try:
             if isinstance(geojson, str):
@@ -320,145 +353,121 @@ class KMZGenerator:
             
             if not geojson or not isinstance(geojson, dict):
                 logger.warning("Geometría GeoJSON inválida o vacía")
-                return
+                return None
             
             geom_type = geojson.get('type')
             coordinates = geojson.get('coordinates', [])
             
             if not coordinates:
                 logger.warning(f"Geometría sin coordenadas: {geom_type}")
-                return
+                return None
             
             if geom_type == 'Polygon':
-                self._add_polygon_to_kml(placemark, coordinates)
+                return geom_type, [coordenadas_kml(anillo) for anillo in coordinates]
             elif geom_type == 'MultiPolygon':
-                self._add_multipolygon_to_kml(placemark, coordinates)
+                return geom_type, [[coordenadas_kml(anillo) for anillo in poligono]
+                                   for poligono in coordinates if poligono]
             elif geom_type == 'Point':
-                self._add_point_to_kml(placemark, coordinates)
+                if len(coordinates) < 2:
+                    logger.warning("Punto sin coordenadas válidas")
+                    return None
+                return geom_type, f"{float(coordinates[0])},{float(coordinates[1])},0"
             else:
                 logger.warning(f"Tipo de geometría no soportado: {geom_type}")
-                
+                return None
+        
         except Exception as e:
             logger.error(f"Error convirtiendo geometría GeoJSON a KML: {e}")
             logger.debug(f"Geometría problemática: {geojson}")
+            return None
     
-    def _add_polygon_to_kml(self, placemark, coordinates):
-        """Agregar polígono simple a KML"""
-        try:
-            if not coordinates or len(coordinates) == 0:
-                logger.warning("Polígono sin coordenadas")
-                return
-            
-            polygon = ET.SubElement(placemark, 'Polygon')
-            # Remover extrude y altitudeMode para mejor compatibilidad
-            # ET.SubElement(polygon, 'extrude').text = '1'
-            # ET.SubElement(polygon, 'altitudeMode').text = 'relativeToGround'
-            
+    def _write_geometria(self, kml, geometria):
+        """Escribir una geometría preparada por _geojson_a_kml"""
+        if geometria is None:
+            return
+        geom_type, datos = geometria
+        if geom_type == 'Point':
+            with kml.bloque('Point'):
+                kml.elemento('coordinates', datos)
+        elif geom_type == 'Polygon':
+            self._add_polygon_to_kml(kml, datos)
+        elif geom_type == 'MultiPolygon':
+            # Todos los polígonos dentro de un MultiGeometry
+            with kml.bloque('MultiGeometry'):
+                for anillos in datos:
+                    self._add_polygon_to_kml(kml, anillos)
+    
+    def _add_polygon_to_kml(self, kml, anillos):
+        """Agregar polígono (anillo exterior y huecos) a KML"""
+        if not anillos:
+            logger.warning("Polígono sin coordenadas")
+            return
+        
+        with kml.bloque('Polygon'):
             # Anillo exterior
-            outer_boundary = ET.SubElement(polygon, 'outerBoundaryIs')
-            linear_ring = ET.SubElement(outer_boundary, 'LinearRing')
-            
-            # Convertir coordenadas
-            coord_string = ""
-            for coord in coordinates[0]:  # Primer anillo (exterior)
-                if len(coord) >= 2:
-                    coord_string += f"{float(coord[0])},{float(coord[1])},0 "
-            
-            ET.SubElement(linear_ring, 'coordinates').text = str(coord_string.strip())
+            with kml.bloque('outerBoundaryIs'), kml.bloque('LinearRing'):
+                kml.elemento('coordinates', anillos[0])
             
             # Anillos interiores (huecos)
-            for i in range(1, len(coordinates)):
-                inner_boundary = ET.SubElement(polygon, 'innerBoundaryIs')
-                linear_ring = ET.SubElement(inner_boundary, 'LinearRing')
-                
-                coord_string = ""
-                for coord in coordinates[i]:
-                    if len(coord) >= 2:
-                        coord_string += f"{float(coord[0])},{float(coord[1])},0 "
-                
-                ET.SubElement(linear_ring, 'coordinates').text = str(coord_string.strip())
-                
-        except Exception as e:
-            logger.error(f"Error agregando polígono: {e}")
-            logger.debug(f"Coordenadas problemáticas: {coordinates}")
+            for anillo in anillos[1:]:
+                with kml.bloque('innerBoundaryIs'), kml.bloque('LinearRing'):
+                    kml.elemento('coordinates', anillo)
     
-    def _add_multipolygon_to_kml(self, placemark, coordinates):
-        """Agregar multipolígono a KML"""
+    def _leer_foto(self, evidencia) -> Optional[bytes]:
+        """Leer los bytes de la foto de una evidencia (None si no existe o falla)"""
+        foto_path = ruta_foto(evidencia.foto_url)
         try:
-            # Para MultiPolygon, crear múltiples Placemarks
-            for i, polygon_coords in enumerate(coordinates):
-                if i == 0:
-                    # Usar el placemark existente para el primer polígono
-                    self._add_polygon_to_kml(placemark, polygon_coords)
-                else:
-                    # Crear placemarks adicionales para polígonos adicionales
-                    # Por simplicidad, solo agregamos el primer polígono
-                    # En una implementación más completa, se crearían placemarks separados
-                    break
-                    
-        except Exception as e:
-            logger.error(f"Error agregando multipolígono: {e}")
+            return foto_path.read_bytes()
+        except FileNotFoundError:
+            logger.warning(f"Archivo de foto no encontrado: {foto_path}")
+        except OSError as e:
+            logger.warning(f"No se pudo agregar foto para evidencia {evidencia.id_evidencia}: {e}")
+        return None
     
-    def _add_point_to_kml(self, placemark, coordinates):
-        """Agregar punto a KML"""
-        try:
-            if not coordinates or len(coordinates) < 2:
-                logger.warning("Punto sin coordenadas válidas")
-                return
-            
-            point = ET.SubElement(placemark, 'Point')
-            coords = f"{float(coordinates[0])},{float(coordinates[1])},0"
-            ET.SubElement(point, 'coordinates').text = coords
-            
-        except Exception as e:
-            logger.error(f"Error agregando punto: {e}")
-            logger.debug(f"Coordenadas problemáticas: {coordinates}")
+    def _leer_fotos(self, evidencias):
+        """
+        Leer las fotos en paralelo en un pool de hilos, entregándolas en orden.
+        
+        Solo hay a lo más 2 * KMZ_PHOTO_READ_WORKERS lecturas adelantadas, para no
+        cargar todas las fotos en memoria si el zip se escribe más lento.
+        
+        Yields:
+            (evidencia, bytes o None)
+        """
+        con_foto = iter([e for e in evidencias if getattr(e, 'foto_url', None)])
+        workers = max(1, KMZ_PHOTO_READ_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kmz-fotos") as pool:
+            pendientes = deque(
+                (e, pool.submit(self._leer_foto, e)) for e in islice(con_foto, 2 * workers)
+            )
+            while pendientes:
+                evidencia, futuro = pendientes.popleft()
+                siguiente = next(con_foto, None)
+                if siguiente is not None:
+                    pendientes.append((siguiente, pool.submit(self._leer_foto, siguiente)))
+                yield evidencia, futuro.result()
     
-    async def _add_photos_to_kmz(self, kmz, evidencias):
+    def _add_photos_to_kmz(self, kmz, evidencias):
         """
         Agregar fotos de evidencias al archivo KMZ
         
+        JPEG/PNG ya están comprimidos: se guardan con ZIP_STORED en vez de
+        volver a comprimirlos.
+        
         Args:
             kmz: Archivo ZIP del KMZ
             evidencias: Lista de objetos Evidencia
         """
-        try:
-            import os
-            from pathlib import Path
-            
-            for evidencia in evidencias:
-                if hasattr(evidencia, 'foto_url') and evidencia.foto_url:
-                    # Obtener la ruta de la foto desde la base de datos
-                    foto_url = evidencia.foto_url
-                    
-                    # Remover slash inicial si existe
-                    if foto_url.startswith('/'):
-                        foto_url = foto_url[1:]
-                    
-                    # Construir ruta completa del archivo en el sistema
-                    foto_path = Path(foto_url)
-                    
-                    # Verificar que el archivo existe
-                    if foto_path.exists():
-                        try:
-                            # Leer el archivo de foto
-                            with open(foto_path, 'rb') as foto_file:
-                                foto_content = foto_file.read()
-                            
-                            # Crear nombre de archivo para el KMZ (sin duplicar 'fotos/')
-                            # La ruta en el KMZ debe ser: fotos/evidencia_X_nombre.jpg
-                            nombre_archivo = foto_path.name
-                            foto_filename = f"fotos/evidencia_{evidencia.id_evidencia}_{nombre_archivo}"
-                            
-                            # Agregar al KMZ
-                            kmz.writestr(foto_filename, foto_content, compress_type=zipfile.ZIP_DEFLATED)
-                            
-                            logger.info(f"Foto agregada al KMZ: {foto_filename}")
-                            
-                        except Exception as e:
-                            logger.warning(f"No se pudo agregar foto para evidencia {evidencia.id_evidencia}: {e}")
-                    else:
-                        logger.warning(f"Archivo de foto no encontrado: {foto_path}")
-                        
-        except Exception as e:
-            logger.error(f"Error agregando fotos al KMZ: {e}") 
\ No newline at end of file
+        agregadas = 0
+        for evidencia, foto_content in self._leer_fotos(evidencias):
+            if foto_content is None:
+                continue
+            # La ruta en el KMZ debe ser: fotos/evidencia_X_nombre.jpg
+            foto_filename = self._foto_en_kmz(evidencia)
+            compresion = zipfile.ZIP_STORED if Path(foto_filename).suffix.lower() in FORMATOS_COMPRIMIDOS else zipfile.ZIP_DEFLATED
+            kmz.writestr(foto_filename, foto_content, compress_type=compresion)
+            agregadas += 1
+            logger.debug(f"Foto agregada al KMZ: {foto_filename}")
+        
+        if agregadas:
+            logger.info(f"{agregadas} fotos agregadas al KMZ")
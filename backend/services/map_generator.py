@@ -1,12 +1,15 @@
+import hashlib
+import io
+import math
 import os
 import logging
-import tempfile
-import shutil
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, List, Dict, Any
 from sqlalchemy.orm import Session
-from sqlalchemy import text
 import json
+import shapely
+from shapely.geometry import shape
 
 # Configuración de logging
 logger = logging.getLogger(__name__)
@@ -25,7 +28,168 @@ except ImportError:
     PILLOW_AVAILABLE = False
     logger.warning("Pillow no está disponible para generar marcadores personalizados.")
 
-from config import FOTOS_DIR
+from config import (
+    FOTOS_DIR, MAP_TILE_OFFLINE, MAP_MARKER_CACHE_MAX, MAP_OUTPUT_FORMAT, MAP_JPEG_QUALITY, MAP_THUMBNAIL_WIDTHS
+)
+from services.analisis_datos import cargar_datos_analisis, DatosAnalisis, ConcesionDTO, EvidenciaDTO
+from services.tile_cache import tile_downloader, tile_provider
+
+# Subir al cambiar colores/estilos del dibujo (invalida los mapas ya generados)
+MAPA_ESTILO_VERSION = 2
+
+EXTENSION_MAPA = ".jpg" if MAP_OUTPUT_FORMAT == "jpeg" else ".png"
+
+
+def ruta_mapa_analisis(id_denuncia: int, id_analisis: int) -> Path:
+    """Ruta del mapa estático de un análisis: fotos/denuncia_{id}/mapa_analisis_{id}.png|.jpg"""
+    return Path(FOTOS_DIR) / f"denuncia_{id_denuncia}" / f"mapa_analisis_{id_analisis}{EXTENSION_MAPA}"
+
+
+def ruta_miniatura(mapa_path: Path, ancho: int) -> Path:
+    """Miniatura del mapa (para el dashboard): mapa_analisis_{id}_{ancho}.png|.jpg"""
+    return mapa_path.with_name(f"{mapa_path.stem}_{ancho}{mapa_path.suffix}")
+
+
+# Margen (px) que py-staticmaps deja alrededor de los datos al encuadrar (marcadores)
+MARGEN_PIXELES = 40
+
+
+def zoom_para_extension(bbox, ancho: int, alto: int, max_zoom: int = 19) -> int:
+    """Mayor zoom Web Mercator en que el bbox (west, south, east, north) cabe en ancho x alto px."""
+    w, s, e, n = bbox
+    
+    def _y(lat: float) -> float:
+        lat_rad = math.radians(max(min(lat, 85.0511), -85.0511))
+        return (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0
+    
+    for zoom in range(max_zoom, -1, -1):
+        escala = 256 * 2 ** zoom
+        if (e - w) / 360.0 * escala <= ancho and (_y(s) - _y(n)) * escala <= alto:
+            return zoom
+    return 0
+
+
+# Dimensiones del marcador con el código de centro (un poco más grande para mejor legibilidad)
+MARCADOR_ANCHO, MARCADOR_ALTO = 70, 28
+
+
+@lru_cache(maxsize=1)
+def _fuente_marcador():
+    """Fuente de los marcadores, cargada una vez por proceso."""
+    # Intentar fuente Arial/DejaVu en tamaño 12 para mejor visibilidad
+    for ruta in ("arial.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"):
+        try:
+            return ImageFont.truetype(ruta, 12)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default()
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=MAP_MARKER_CACHE_MAX)
+def _sprite_codigo_centro(codigo_centro: str, interseccion_valida: bool) -> Optional[bytes]:
+    """
+    PNG del marcador con el código de centro, cacheado en memoria (LRU) por
+    (codigo_centro, interseccion_valida). Retorna None si no se pudo crear.
+    """
+    try:
+        # Configurar colores según validez
+        if interseccion_valida:
+            bg_color = "#FF0000"  # Rojo para válidas
+            text_color = "#FFFFFF"  # Texto blanco
+        else:
+            bg_color = "#FFA500"  # Naranja para no válidas
+            text_color = "#000000"  # Texto negro
+        
+        width, height = MARCADOR_ANCHO, MARCADOR_ALTO
+        
+        # Crear imagen con transparencia
+        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        
+        # Dibujar rectángulo redondeado como fondo
+        draw.rounded_rectangle(
+            [(0, 0), (width-1, height-1)], 
+            radius=4, 
+            fill=bg_color, 
+            outline="#000000", 
+            width=1
+        )
+        
+        # Truncar código si es muy largo
+        codigo_display = codigo_centro[:8]
+        
+        # Calcular posición del texto para centrarlo
+        font = _fuente_marcador()
+        if font:
+            bbox = draw.textbbox((0, 0), codigo_display, font=font)
+            text_width = bbox[2] - bbox[0]
+            text_height = bbox[3] - bbox[1]
+        else:
+            # Estimación si no hay fuente disponible
+            text_width = len(codigo_display) * 6
+            text_height = 10
+        
+        draw.text(((width - text_width) // 2, (height - text_height) // 2), codigo_display, fill=text_color, font=font)
+        
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG')
+        return buffer.getvalue()
+        
+    except Exception as e:
+        logger.error(f"Error creando marcador personalizado para {codigo_centro}: {e}")
+        return None
+
+
+if STATICMAPS_AVAILABLE:
+    class MarcadorImagenMemoria(staticmaps.ImageMarker):
+        """
+        ImageMarker que recibe el PNG ya en memoria. staticmaps.ImageMarker solo
+        acepta una ruta y lee el archivo en load_image_data(); aquí los bytes y
+        el tamaño se asignan directamente.
+        """
+        
+        def __init__(self, latlng, png_data: bytes, size, origin_x: int, origin_y: int):
+            super().__init__(latlng, "<memoria>", origin_x, origin_y)
+            self._image_data = png_data
+            self._width, self._height = size
+        
+        def load_image_data(self) -> None:
+            pass
+    
+    class AreaConHuecos(staticmaps.Area):
+        """
+        staticmaps.Area con anillos interiores: el relleno se dibuja en una capa
+        RGBA donde los huecos se vuelven a dejar transparentes antes de componerla.
+        """
+        
+        def __init__(self, latlngs, huecos, fill_color, color, width):
+            super().__init__(latlngs, fill_color=fill_color, color=color, width=width)
+            self._huecos = huecos
+        
+        def render_pillow(self, renderer) -> None:
+            def _pixeles(latlngs):
+                return [
+                    (x + renderer.offset_x(), y)
+                    for (x, y) in [renderer.transformer().ll2pixel(latlng) for latlng in latlngs]
+                ]
+            
+            exterior = _pixeles(self.interpolate())
+            huecos = [_pixeles(hueco) for hueco in self._huecos if len(hueco) > 2]
+            
+            overlay = Image.new("RGBA", renderer.image().size, (255, 255, 255, 0))
+            draw = ImageDraw.Draw(overlay)
+            draw.polygon(exterior, fill=self.fill_color().int_rgba())
+            for hueco in huecos:
+                draw.polygon(hueco, fill=(255, 255, 255, 0))
+            renderer.alpha_compose(overlay)
+            
+            if self.width() > 0:
+                for anillo in [exterior] + huecos:
+                    renderer.draw().line(anillo, fill=self.color().int_rgba(), width=self.width())
+
 
 class MapGenerator:
     """
@@ -37,121 +201,17 @@ class MapGenerator:
         self.fotos_dir = Path(FOTOS_DIR)
         self.map_width = 1024
         self.map_height = 900
-        self.temp_markers = []  # Lista para mantener track de marcadores temporales
 
         logger.info(f"MapGenerator inicializado. FOTOS_DIR: {self.fotos_dir}")
         logger.info(f"STATICMAPS_AVAILABLE: {STATICMAPS_AVAILABLE}")
         logger.info(f"PILLOW_AVAILABLE: {PILLOW_AVAILABLE}")
+        if MAP_TILE_OFFLINE:
+            logger.info("Mapas en modo offline: solo se usan tiles de la cache local")
         if STATICMAPS_AVAILABLE:
             logger.info("✅ py-staticmaps está disponible")
         else:
             logger.error("❌ py-staticmaps NO está disponible")
     
-    def _crear_marcador_codigo_centro(self, codigo_centro: str, interseccion_valida: bool) -> Optional[str]:
-        """
-        Crea una imagen PNG personalizada con el código de centro para usar como marcador.
-        
-        Args:
-            codigo_centro: El código del centro de cultivo
-            interseccion_valida: Si la intersección es válida (para definir colores)
-            
-        Returns:
-            Path absoluto al archivo de imagen temporal o None si falla
-        """
-        if not PILLOW_AVAILABLE:
-            logger.warning("Pillow no disponible, no se puede crear marcador personalizado")
-            return None
-            
-        try:
-            # Configurar colores según validez
-            if interseccion_valida:
-                bg_color = "#FF0000"  # Rojo para válidas
-                text_color = "#FFFFFF"  # Texto blanco
-            else:
-                bg_color = "#FFA500"  # Naranja para no válidas
-                text_color = "#000000"  # Texto negro
-            
-            # Configurar dimensiones del marcador (un poco más grande para mejor legibilidad)
-            width, height = 70, 28
-            border_radius = 4
-            
-            # Crear imagen con transparencia
-            img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(img)
-            
-            # Dibujar rectángulo redondeado como fondo
-            draw.rounded_rectangle(
-                [(0, 0), (width-1, height-1)], 
-                radius=border_radius, 
-                fill=bg_color, 
-                outline="#000000", 
-                width=1
-            )
-            
-            # Truncar código si es muy largo
-            codigo_display = codigo_centro[:8] if len(codigo_centro) > 8 else codigo_centro
-            
-            # Intentar usar una fuente del sistema con tamaño más grande
-            try:
-                # Intentar fuente Arial/DejaVu en tamaño 12 para mejor visibilidad
-                font = ImageFont.truetype("arial.ttf", 12)
-            except:
-                try:
-                    font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 12)
-                except:
-                    try:
-                        # Fuente por defecto con tamaño aumentado si es posible
-                        font = ImageFont.load_default()
-                    except:
-                        font = None
-            
-            # Calcular posición del texto para centrarlo
-            if font:
-                bbox = draw.textbbox((0, 0), codigo_display, font=font)
-                text_width = bbox[2] - bbox[0]
-                text_height = bbox[3] - bbox[1]
-            else:
-                # Estimación si no hay fuente disponible
-                text_width = len(codigo_display) * 6
-                text_height = 10
-            
-            text_x = (width - text_width) // 2
-            text_y = (height - text_height) // 2
-            
-            # Dibujar texto
-            draw.text((text_x, text_y), codigo_display, fill=text_color, font=font)
-            
-            # Crear archivo temporal
-            temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-            temp_path = temp_file.name
-            temp_file.close()
-            
-            # Guardar imagen
-            img.save(temp_path, 'PNG')
-            
-            # Agregar a lista para limpieza posterior
-            self.temp_markers.append(temp_path)
-            
-            logger.debug(f"Marcador personalizado creado: {temp_path} para código {codigo_centro}")
-            return temp_path
-            
-        except Exception as e:
-            logger.error(f"Error creando marcador personalizado para {codigo_centro}: {e}")
-            return None
-    
-    def _limpiar_marcadores_temporales(self):
-        """
-        Limpia los archivos temporales de marcadores personalizados.
-        """
-        for temp_path in self.temp_markers:
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-                    logger.debug(f"Archivo temporal eliminado: {temp_path}")
-            except Exception as e:
-                logger.warning(f"No se pudo eliminar archivo temporal {temp_path}: {e}")
-        self.temp_markers.clear()
-        
     def generar_mapa_analisis(self, id_analisis: int, db: Session) -> Optional[str]:
         """
         Genera un mapa estático para un análisis específico.
@@ -175,196 +235,164 @@ class MapGenerator:
                 logger.error(f"❌ No se encontraron datos para análisis {id_analisis}")
                 return None
             
-            logger.info(f"📊 Datos obtenidos - Evidencias: {len(datos_analisis.get('evidencias', []))}, "
-                       f"Concesiones: {len(datos_analisis.get('concesiones', []))}, "
-                       f"Buffer: {'✅' if datos_analisis.get('buffer_geom') else '❌'}")
+            logger.info(f"📊 Datos obtenidos - Evidencias: {len(datos_analisis.evidencias)}, "
+                       f"Concesiones: {len(datos_analisis.concesiones)}, "
+                       f"Buffer: {'✅' if datos_analisis.buffer_geom else '❌'}")
+            
+            # Si nada de lo que se dibuja cambió, reutilizar el mapa existente
+            mapa_path = ruta_mapa_analisis(datos_analisis.id_denuncia, id_analisis)
+            huella_path = mapa_path.with_name(mapa_path.name + ".sha256")
+            huella = self._huella_mapa(datos_analisis)
+            try:
+                if huella_path.read_text().strip() == huella and mapa_path.exists():
+                    logger.info(f"♻️ Mapa sin cambios para análisis {id_analisis}, se reutiliza {mapa_path}")
+                    return str(mapa_path)
+            except OSError:
+                pass
                 
             # Crear contexto del mapa
+            # Tiles desde la cache local compartida (en modo offline no se descargan)
             context = staticmaps.Context()
-            context.set_tile_provider(staticmaps.tile_provider_OSM)
+            context.set_tile_provider(tile_provider())
+            context.set_tile_downloader(tile_downloader)
+            
+            # Simplificar geometrías a la resolución del render (vértices sub-pixel)
+            tolerancia = self._tolerancia_pixel(datos_analisis)
             
             # Agregar buffer (polígono azul)
-            if datos_analisis['buffer_geom']:
-                self._agregar_buffer(context, datos_analisis['buffer_geom'])
+            if datos_analisis.buffer_geom:
+                self._agregar_buffer(context, datos_analisis.buffer_geom, tolerancia)
             
             # Agregar concesiones (polígonos rojos/naranjas)
-            if datos_analisis['concesiones']:
-                self._agregar_concesiones(context, datos_analisis['concesiones'])
+            if datos_analisis.concesiones:
+                self._agregar_concesiones(context, datos_analisis.concesiones, tolerancia)
             
             # Agregar evidencias GPS (marcadores azules)
-            if datos_analisis['evidencias']:
-                self._agregar_evidencias(context, datos_analisis['evidencias'])
+            if datos_analisis.evidencias:
+                self._agregar_evidencias(context, datos_analisis.evidencias)
             
             # Crear directorio en la carpeta de denuncia (mantener organización)
-            denuncia_dir = self.fotos_dir / f"denuncia_{datos_analisis['id_denuncia']}"
-            denuncia_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Renderizar mapa
-            mapa_path = denuncia_dir / f"mapa_analisis_{id_analisis}.png"
+            mapa_path.parent.mkdir(parents=True, exist_ok=True)
             
+            # Renderizar y codificar el mapa y sus miniaturas en la misma pasada
             image = context.render_pillow(self.map_width, self.map_height)
-            image.save(str(mapa_path))
+            self._guardar_imagen(image, mapa_path)
+            for ancho in MAP_THUMBNAIL_WIDTHS:
+                miniatura = image.copy()
+                miniatura.thumbnail((ancho, ancho * self.map_height // self.map_width), Image.Resampling.LANCZOS)
+                self._guardar_imagen(miniatura, ruta_miniatura(mapa_path, ancho))
             
-            # Verificar que se guardó correctamente
-            if mapa_path.exists():
-                size_mb = mapa_path.stat().st_size / (1024 * 1024)
-                logger.info(f"✅ Mapa generado exitosamente: {mapa_path} ({size_mb:.2f} MB)")
-                resultado = str(mapa_path)
-            else:
-                logger.error(f"❌ Error: El archivo no se guardó correctamente")
-                resultado = None
+            # La huella se escribe al final: solo queda si el mapa se guardó completo
+            huella_path.write_text(huella)
             
-            # Limpiar marcadores temporales
-            self._limpiar_marcadores_temporales()
-            return resultado
+            size_kb = mapa_path.stat().st_size / 1024
+            logger.info(f"✅ Mapa generado exitosamente: {mapa_path} ({size_kb:.0f} KB, "
+                        f"{len(MAP_THUMBNAIL_WIDTHS)} miniaturas)")
+            return str(mapa_path)
             
         except Exception as e:
             logger.error(f"Error generando mapa para análisis {id_analisis}: {e}")
-            # Limpiar marcadores temporales en caso de error
-            self._limpiar_marcadores_temporales()
             return None
     
-    def _obtener_datos_analisis(self, db: Session, id_analisis: int) -> Optional[Dict[str, Any]]:
+    def _huella_mapa(self, datos: DatosAnalisis) -> str:
+        """Huella de todo lo que se dibuja en el mapa (para no regenerarlo si no cambió)."""
+        partes = {
+            "version": MAPA_ESTILO_VERSION,
+            "tamano": [self.map_width, self.map_height, MAP_OUTPUT_FORMAT, MAP_JPEG_QUALITY, list(MAP_THUMBNAIL_WIDTHS)],
+            # Un mapa renderizado offline puede tener tiles faltantes: se regenera al volver a estar online
+            "tiles": [tile_provider().name(), MAP_TILE_OFFLINE],
+            "buffer": datos.buffer_geom,
+            "concesiones": [[c.id_concesion, c.codigo_centro, c.interseccion_valida, c.geom] for c in datos.concesiones],
+            "evidencias": [[e.lon, e.lat] for e in datos.evidencias],
+        }
+        payload = json.dumps(partes, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _guardar_imagen(self, image: 'Image.Image', destino: Path) -> None:
         """
-        Obtiene todos los datos necesarios para generar el mapa.
+        Guarda el mapa como PNG con paleta (256 colores) o JPEG de alta calidad,
+        según MAP_OUTPUT_FORMAT. La escritura es atómica.
         """
+        tmp_path = destino.with_name(destino.name + ".tmp")
         try:
-            # Obtener datos del análisis y buffer
-            analisis_query = text("""
-                SELECT 
-                    a.id_denuncia,
-                    a.distancia_buffer,
-                    ST_AsGeoJSON(a.buffer_geom) as buffer_geom_json
-                FROM analisis_denuncia a
-                WHERE a.id_analisis = :id_analisis
-            """)
-            analisis_result = db.execute(analisis_query, {"id_analisis": id_analisis}).fetchone()
-            
-            if not analisis_result:
-                return None
-            
-            # Obtener evidencias GPS
-            evidencias_query = text("""
-                SELECT 
-                    id_evidencia,
-                    ST_X(coordenadas) as lon,
-                    ST_Y(coordenadas) as lat,
-                    descripcion
-                FROM evidencias 
-                WHERE id_denuncia = :id_denuncia
-                ORDER BY id_evidencia
-            """)
-            evidencias_result = db.execute(evidencias_query, {"id_denuncia": analisis_result.id_denuncia}).fetchall()
-            
-            # Obtener concesiones intersectadas
-            concesiones_query = text("""
-                SELECT 
-                    c.id_concesion,
-                    c.nombre,
-                    c.codigo_centro,
-                    c.titular,
-                    r.interseccion_valida,
-                    ST_AsGeoJSON(c.geom) as geom_json
-                FROM resultado_analisis r
-                JOIN concesiones c ON r.id_concesion = c.id_concesion
-                WHERE r.id_analisis = :id_analisis
-            """)
-            concesiones_result = db.execute(concesiones_query, {"id_analisis": id_analisis}).fetchall()
-            
-            return {
-                'id_denuncia': analisis_result.id_denuncia,  # 🆕 Agregar ID de denuncia
-                'buffer_geom': json.loads(analisis_result.buffer_geom_json) if analisis_result.buffer_geom_json else None,
-                'evidencias': [
-                    {
-                        'id_evidencia': ev.id_evidencia,
-                        'lon': float(ev.lon),
-                        'lat': float(ev.lat),
-                        'descripcion': ev.descripcion or f"Evidencia #{ev.id_evidencia}"
-                    }
-                    for ev in evidencias_result
-                ],
-                'concesiones': [
-                    {
-                        'id_concesion': c.id_concesion,
-                        'nombre': c.nombre,
-                        'codigo_centro': c.codigo_centro,
-                        'titular': c.titular,
-                        'interseccion_valida': c.interseccion_valida,
-                        'geom': json.loads(c.geom_json) if c.geom_json else None
-                    }
-                    for c in concesiones_result
-                ]
-            }
-            
+            if MAP_OUTPUT_FORMAT == "jpeg":
+                image.convert("RGB").save(tmp_path, "JPEG", quality=MAP_JPEG_QUALITY, optimize=True, subsampling=0)
+            else:
+                # Los tiles y los polígonos usan pocos colores: la paleta reduce el
+                # archivo varias veces sin diferencia visible
+                paleta = image.convert("RGB").quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+                paleta.save(tmp_path, "PNG", optimize=True)
+            os.replace(tmp_path, destino)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def _obtener_datos_analisis(self, db: Session, id_analisis: int) -> Optional[DatosAnalisis]:
+        """
+        Obtiene todos los datos necesarios para generar el mapa (loader compartido con PDF/KMZ).
+        """
+        try:
+            return cargar_datos_analisis(db, id_analisis)
         except Exception as e:
             logger.error(f"Error obteniendo datos del análisis {id_analisis}: {e}")
             return None
     
-    def _agregar_buffer(self, context: 'staticmaps.Context', buffer_geom: Dict[str, Any]):
+    def _agregar_buffer(self, context: 'staticmaps.Context', buffer_geom: Dict[str, Any], tolerancia: float = 0.0):
         """
         Agrega el buffer como polígono azul semi-transparente.
         """
         try:
-            if buffer_geom['type'] == 'MultiPolygon':
-                for polygon_coords in buffer_geom['coordinates']:
-                    self._agregar_poligono_simple(context, polygon_coords, 
-                                                color=staticmaps.BLUE, 
-                                                fill_color=staticmaps.parse_color("#0000FF40"))
-            elif buffer_geom['type'] == 'Polygon':
-                self._agregar_poligono_simple(context, buffer_geom['coordinates'], 
-                                            color=staticmaps.BLUE, 
-                                            fill_color=staticmaps.parse_color("#0000FF40"))
+            self._agregar_poligonos(context, buffer_geom, tolerancia,
+                                    color=staticmaps.BLUE,
+                                    fill_color=staticmaps.parse_color("#0000FF40"))
         except Exception as e:
             logger.error(f"Error agregando buffer al mapa: {e}")
     
-    def _agregar_concesiones(self, context: 'staticmaps.Context', concesiones: List[Dict[str, Any]]):
+    def _agregar_concesiones(self, context: 'staticmaps.Context', concesiones: List[ConcesionDTO], tolerancia: float = 0.0):
         """
         Agrega concesiones como polígonos rojos (válidas) o naranjas (no válidas).
         """
         for concesion in concesiones:
             try:
-                geom = concesion.get('geom')
+                geom = concesion.geom
                 if not geom:
                     continue
                     
                 # Color según validez de intersección
-                if concesion['interseccion_valida']:
+                if concesion.interseccion_valida:
                     color = staticmaps.RED
                     fill_color = staticmaps.parse_color("#FF000060")
                 else:
                     color = staticmaps.parse_color("#FFA500")  # Orange
                     fill_color = staticmaps.parse_color("#FFA50060")
                 
-                if geom['type'] == 'MultiPolygon':
-                    for polygon_coords in geom['coordinates']:
-                        self._agregar_poligono_simple(context, polygon_coords, color, fill_color)
-                elif geom['type'] == 'Polygon':
-                    self._agregar_poligono_simple(context, geom['coordinates'], color, fill_color)
+                self._agregar_poligonos(context, geom, tolerancia, color, fill_color)
                     
                 # Agregar marcador personalizado con código de centro
                 centroide = self._calcular_centroide(geom)
-                if centroide and concesion.get('codigo_centro'):
-                    codigo_centro = str(concesion['codigo_centro'])
+                if centroide and concesion.codigo_centro:
+                    codigo_centro = str(concesion.codigo_centro)
                     
-                    # Crear marcador personalizado con el código de centro
-                    marker_path = self._crear_marcador_codigo_centro(
-                        codigo_centro, 
-                        concesion['interseccion_valida']
-                    )
+                    # Marcador personalizado con el código de centro (sprite cacheado en memoria)
+                    sprite = _sprite_codigo_centro(codigo_centro, bool(concesion.interseccion_valida)) \
+                        if PILLOW_AVAILABLE else None
                     
-                    if marker_path:
-                        # Usar ImageMarker con la imagen personalizada
-                        marker = staticmaps.ImageMarker(
+                    if sprite:
+                        marker = MarcadorImagenMemoria(
                             staticmaps.create_latlng(centroide[1], centroide[0]),
-                            marker_path,
-                            origin_x=35,  # Centro horizontal de la imagen (70px / 2)
-                            origin_y=14   # Centro vertical de la imagen (28px / 2)
+                            sprite,
+                            (MARCADOR_ANCHO, MARCADOR_ALTO),
+                            origin_x=MARCADOR_ANCHO // 2,  # Centro horizontal de la imagen
+                            origin_y=MARCADOR_ALTO // 2    # Centro vertical de la imagen
                         )
                         context.add_object(marker)
                         logger.debug(f"Marcador personalizado agregado para concesión {codigo_centro}")
                     else:
                         # Fallback: usar marcador básico si falla la creación del personalizado
-                        marker_color = staticmaps.RED if concesion['interseccion_valida'] else staticmaps.parse_color("#FFA500")
+                        marker_color = staticmaps.RED if concesion.interseccion_valida else staticmaps.parse_color("#FFA500")
                         marker = staticmaps.Marker(
                             staticmaps.create_latlng(centroide[1], centroide[0]),
                             color=marker_color,
@@ -374,41 +402,54 @@ class MapGenerator:
                         logger.warning(f"Usando marcador básico para concesión {codigo_centro} (fallback)")
                     
             except Exception as e:
-                logger.error(f"Error agregando concesión {concesion.get('id_concesion', 'unknown')}: {e}")
+                logger.error(f"Error agregando concesión {concesion.id_concesion}: {e}")
     
-    def _agregar_evidencias(self, context: 'staticmaps.Context', evidencias: List[Dict[str, Any]]):
+    def _agregar_evidencias(self, context: 'staticmaps.Context', evidencias: List[EvidenciaDTO]):
         """
         Agrega evidencias GPS como marcadores azules numerados.
         """
         for evidencia in evidencias:
+            if evidencia.lat is None or evidencia.lon is None:
+                continue
             try:
                 marker = staticmaps.Marker(
-                    staticmaps.create_latlng(evidencia['lat'], evidencia['lon']),
+                    staticmaps.create_latlng(evidencia.lat, evidencia.lon),
                     color=staticmaps.BLUE,
                     size=12
                 )
                 context.add_object(marker)
             except Exception as e:
-                logger.error(f"Error agregando evidencia {evidencia.get('id_evidencia', 'unknown')}: {e}")
+                logger.error(f"Error agregando evidencia {evidencia.id_evidencia}: {e}")
+    
+    def _agregar_poligonos(self, context: 'staticmaps.Context', geojson: Dict[str, Any], tolerancia: float,
+                           color: str, fill_color: str):
+        """
+        Agrega un Polygon/MultiPolygon GeoJSON, simplificado a la tolerancia dada
+        (grados; ~medio pixel del render) y con sus huecos.
+        """
+        geom = shape(geojson)
+        if tolerancia > 0:
+            geom = shapely.simplify(geom, tolerancia, preserve_topology=True)
+        for poligono in getattr(geom, 'geoms', [geom]):
+            if poligono.geom_type == 'Polygon' and not poligono.is_empty:
+                self._agregar_poligono_simple(context, poligono, color, fill_color)
     
-    def _agregar_poligono_simple(self, context: 'staticmaps.Context', coordinates: List, 
+    def _agregar_poligono_simple(self, context: 'staticmaps.Context', poligono, 
                                 color: str, fill_color: str):
         """
-        Agrega un polígono simple al contexto del mapa.
+        Agrega un polígono (Shapely) al contexto del mapa, con sus anillos interiores como huecos.
         """
         try:
-            # Tomar el anillo exterior (primer elemento)
-            exterior_ring = coordinates[0]
-            
-            # Convertir coordenadas
-            latlngs = [
-                staticmaps.create_latlng(coord[1], coord[0])  # [lon, lat] -> lat, lon
-                for coord in exterior_ring
-            ]
+            def _latlngs(anillo):
+                return [
+                    staticmaps.create_latlng(lat, lon)  # [lon, lat] -> lat, lon
+                    for lon, lat in shapely.get_coordinates(anillo).tolist()
+                ]
             
             # Crear área
-            area = staticmaps.Area(
-                latlngs,
+            area = AreaConHuecos(
+                _latlngs(poligono.exterior),
+                [_latlngs(hueco) for hueco in poligono.interiors],
                 fill_color=fill_color,
                 color=color,
                 width=2
@@ -418,6 +459,29 @@ class MapGenerator:
         except Exception as e:
             logger.error(f"Error agregando polígono: {e}")
     
+    def _tolerancia_pixel(self, datos: DatosAnalisis) -> float:
+        """
+        Tolerancia de simplificación (en grados) equivalente a medio pixel del
+        render, estimando el zoom que py-staticmaps elegirá para encuadrar los datos.
+        Los vértices más cercanos que eso caen en el mismo pixel.
+        """
+        limites = []
+        if datos.buffer_geom:
+            limites.append(shape(datos.buffer_geom).bounds)
+        limites.extend(shape(c.geom).bounds for c in datos.concesiones if c.geom)
+        limites.extend((e.lon, e.lat, e.lon, e.lat) for e in datos.evidencias
+                       if e.lon is not None and e.lat is not None)
+        if not limites:
+            return 0.0
+        
+        w = min(b[0] for b in limites)
+        s = min(b[1] for b in limites)
+        e = max(b[2] for b in limites)
+        n = max(b[3] for b in limites)
+        zoom = zoom_para_extension((w, s, e, n), self.map_width - 2 * MARGEN_PIXELES, self.map_height - 2 * MARGEN_PIXELES)
+        grados_por_pixel = 360.0 / (256 * 2 ** zoom)
+        return 0.5 * grados_por_pixel * math.cos(math.radians((s + n) / 2))
+    
     def _calcular_centroide(self, geom: Dict[str, Any]) -> Optional[List[float]]:
         """
         Calcula el centroide aproximado de una geometría.
@@ -0,0 +1,78 @@
+"""
+Utilidades para paginación keyset (por cursor).
+
+El cursor es opaco para el cliente: base64url de un JSON con los valores de la
+clave de orden de la última fila entregada, p.ej. [fecha_ingreso, id_denuncia].
+El siguiente cursor se devuelve en la cabecera `X-Next-Cursor` (ausente en la
+última página), así el cuerpo de la respuesta sigue siendo una lista.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Sequence
+from fastapi import HTTPException, Response
+from config import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def _serializar(valor: Any) -> Any:
+    if isinstance(valor, datetime):
+        return {"dt": valor.isoformat()}
+    return valor
+
+
+def _deserializar(valor: Any) -> Any:
+    if isinstance(valor, dict) and "dt" in valor:
+        return datetime.fromisoformat(valor["dt"])
+    return valor
+
+
+def codificar_cursor(*valores: Any) -> str:
+    """Codifica los valores de la clave de orden como cursor opaco."""
+    data = json.dumps([_serializar(v) for v in valores], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor: Optional[str], campos: int) -> Optional[List[Any]]:
+    """
+    Decodifica un cursor generado por `codificar_cursor`.
+
+    Raises:
+        HTTPException 400 si el cursor está malformado.
+    """
+    if not cursor:
+        return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + padding).decode("utf-8"))
+        if not isinstance(valores, list) or len(valores) != campos:
+            raise ValueError("cantidad de campos incorrecta")
+        return [_deserializar(v) for v in valores]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+
+def limite_pagina(limit: Optional[int]) -> int:
+    """Normaliza el tamaño de página solicitado al rango permitido."""
+    if limit is None:
+        return PAGE_SIZE_DEFAULT
+    return max(1, min(int(limit), PAGE_SIZE_MAX))
+
+
+def paginar(filas: Sequence[Any], limit: int, response: Response, clave) -> List[Any]:
+    """
+    Recorta el resultado de una consulta hecha con LIMIT limit+1 y publica el cursor
+    de la página siguiente en la cabecera de respuesta.
+
+    Args:
+        filas: filas obtenidas (hasta limit + 1)
+        limit: tamaño de página efectivo
+        response: respuesta de FastAPI donde se escribe la cabecera
+        clave: función fila -> tupla con los valores de la clave de orden
+    """
+    filas = list(filas)
+    if len(filas) > limit:
+        filas = filas[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = codificar_cursor(*clave(filas[-1]))
+    return filas
@@ -1,36 +1,134 @@
 from xhtml2pdf import pisa
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from pypdf import PdfWriter
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
 from io import BytesIO
+import asyncio
 import logging
 from datetime import datetime
+from functools import lru_cache
 import os
+import shutil
+import subprocess
 from pathlib import Path
-from config import FOTOS_DIR
+from config import FOTOS_DIR, PDF_TEMPLATE_CACHE_DIR, PDF_CHUNK_EVIDENCIAS
+from services.foto_derivados import derivado_reporte
+from services.map_generator import ruta_mapa_analisis
 
 logger = logging.getLogger(__name__)
 
+TEMPLATE_DIR = Path(__file__).parent.parent / "templates" / "pdf"
+TEMPLATE_NAME = 'inspection_report_basic_only.html'
+
+
+@lru_cache(maxsize=1)
+def get_jinja_env() -> Environment:
+    """
+    Environment Jinja2 compartido por proceso, con bytecode cache en disco para que
+    los workers del pool no recompilen el template en cada arranque.
+    """
+    bytecode_cache = None
+    try:
+        Path(PDF_TEMPLATE_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(PDF_TEMPLATE_CACHE_DIR)
+    except OSError as e:
+        logger.warning(f"No se pudo crear cache de templates en {PDF_TEMPLATE_CACHE_DIR}: {e}")
+
+    env = Environment(
+        loader=FileSystemLoader(str(TEMPLATE_DIR)),
+        autoescape=select_autoescape(['html', 'xml']),
+        bytecode_cache=bytecode_cache
+    )
+    # Agregar función 'now' para usar en templates
+    env.globals['now'] = datetime.now
+    return env
+
+
+def _a_dict(obj, campos):
+    """Copia los campos usados por el template a un dict (serializable para el pool)."""
+    if obj is None:
+        return None
+    return {campo: getattr(obj, campo, None) for campo in campos}
+
+
+def concatenar_pdfs(partes, destino):
+    """
+    Concatena los PDFs `partes` (rutas, en orden) y escribe el resultado en `destino`.
+
+    Usa qpdf en un subproceso si está instalado: copia las páginas parte por parte
+    sin cargarlas en este proceso, así la memoria del worker no crece con el
+    tamaño del reporte. Sin qpdf se concatena con pypdf (todas las páginas en
+    memoria hasta escribir).
+    """
+    qpdf = shutil.which('qpdf')
+    if qpdf:
+        resultado = subprocess.run(
+            [qpdf, '--empty', '--pages', *(str(p) for p in partes), '--', str(destino)],
+            capture_output=True, text=True
+        )
+        # Código 3: terminó con advertencias, el archivo es válido
+        if resultado.returncode not in (0, 3):
+            raise RuntimeError(f"qpdf falló ({resultado.returncode}): {resultado.stderr.strip()}")
+        return
+
+    logger.warning("qpdf no está instalado; se concatena el reporte en memoria con pypdf")
+    writer = PdfWriter()
+    try:
+        for parte in partes:
+            writer.append(str(parte))
+        with open(destino, 'wb') as f:
+            writer.write(f)
+    finally:
+        writer.close()
+
+
+def dividir_contexto(context_data, tam_lote):
+    """
+    Divide el contexto de un reporte en partes renderizables por separado:
+    encabezado y concesiones ('inicio'), lotes de evidencias y cierre con el mapa.
+    
+    Args:
+        context_data: contexto completo (de _prepare_template_context)
+        tam_lote: evidencias por parte (se redondea a par por el layout de 2 columnas)
+        
+    Returns:
+        list: contextos en el orden en que deben concatenarse
+    """
+    tam_lote = max(2, tam_lote + tam_lote % 2)
+    evidencias = context_data['evidencias']
+    base = dict(context_data, evidencias=[], total_evidencias=len(evidencias))
+    partes = [dict(base, parte='inicio')]
+    for inicio in range(0, len(evidencias), tam_lote):
+        partes.append(dict(
+            base,
+            parte='evidencias',
+            evidencias=evidencias[inicio:inicio + tam_lote],
+            primer_lote=inicio == 0
+        ))
+    partes.append(dict(base, parte='cierre'))
+    return partes
+
+
 class PDFGenerator:
     def __init__(self):
         """
         Inicializar el generador de PDF con xhtml2pdf y Jinja2
         """
         # Configurar el directorio de templates
-        self.template_dir = Path(__file__).parent.parent / "templates" / "pdf"
-        
-        # Configurar Jinja2 environment
-        self.jinja_env = Environment(
-            loader=FileSystemLoader(str(self.template_dir)),
-            autoescape=select_autoescape(['html', 'xml'])
-        )
+        self.template_dir = TEMPLATE_DIR
         
-        # Agregar función 'now' para usar en templates
-        self.jinja_env.globals['now'] = datetime.now
+        # Environment Jinja2 compartido (el template se compila una vez por proceso)
+        self.jinja_env = get_jinja_env()
         
         logger.info("PDFGenerator inicializado con xhtml2pdf")
     
+    def precompilar_template(self):
+        """Compila el template del reporte (y lo deja en el bytecode cache)."""
+        return self.jinja_env.get_template(TEMPLATE_NAME)
+    
     async def generate_analysis_pdf(self, analisis, denuncia, evidencias, resultados, concesiones, usuario, estado):
         """
-        Generar PDF completo del análisis usando xhtml2pdf y templates HTML modernos
+        Generar PDF completo del análisis usando xhtml2pdf y templates HTML modernos.
+        El render se ejecuta en el pool de procesos (services.pdf_pool), fuera del event loop.
         
         Args:
             analisis: Objeto AnalisisDenuncia
@@ -44,6 +142,8 @@ class PDFGenerator:
         Returns:
             bytes: PDF generado
         """
+        from services.pdf_pool import pdf_render_pool
+        
         try:
             logger.info(f"Iniciando generación de PDF para análisis {analisis.id_analisis}")
             
@@ -52,12 +152,8 @@ class PDFGenerator:
                 analisis, denuncia, evidencias, resultados, concesiones, usuario, estado
             )
             
-            # Cargar y renderizar el template
-            template = self.jinja_env.get_template('inspection_report_basic_only.html')
-            html_content = template.render(**context_data)
-            
-            # Generar PDF con xhtml2pdf
-            pdf_bytes = self._generate_pdf_from_html(html_content)
+            # Renderizar template y PDF en el pool
+            pdf_bytes = await pdf_render_pool.render(context_data)
             
             logger.info(f"PDF generado exitosamente para análisis {analisis.id_analisis} ({len(pdf_bytes)} bytes)")
             return pdf_bytes
@@ -66,6 +162,55 @@ class PDFGenerator:
             logger.error(f"Error generando PDF para análisis {analisis.id_analisis}: {str(e)}")
             raise
     
+    async def generate_analysis_pdf_file(self, destino, analisis, denuncia, evidencias, resultados, concesiones, usuario, estado):
+        """
+        Generar el PDF del análisis directamente en un archivo.
+        Con más de PDF_CHUNK_EVIDENCIAS evidencias el reporte se renderiza por lotes
+        en el pool y las partes se concatenan en `destino`, para que la memoria no
+        crezca con el número de evidencias.
+        
+        Args:
+            destino: Path del archivo de salida
+            (resto igual que generate_analysis_pdf)
+        """
+        from services.pdf_pool import pdf_render_pool
+        
+        try:
+            context_data = self._prepare_template_context(
+                analisis, denuncia, evidencias, resultados, concesiones, usuario, estado
+            )
+            total = len(context_data['evidencias'])
+            
+            if PDF_CHUNK_EVIDENCIAS > 0 and total > PDF_CHUNK_EVIDENCIAS:
+                partes = dividir_contexto(context_data, PDF_CHUNK_EVIDENCIAS)
+                logger.info(f"Generando PDF de análisis {analisis.id_analisis} por lotes: {total} evidencias en {len(partes)} partes")
+                await pdf_render_pool.render_partes(partes, destino)
+            else:
+                pdf_bytes = await pdf_render_pool.render(context_data)
+                await asyncio.to_thread(destino.write_bytes, pdf_bytes)
+            
+            logger.info(f"PDF generado exitosamente para análisis {analisis.id_analisis} ({destino.stat().st_size} bytes)")
+            
+        except Exception as e:
+            logger.error(f"Error generando PDF para análisis {analisis.id_analisis}: {str(e)}")
+            raise
+    
+    def render_pdf(self, context_data):
+        """
+        Renderiza el template con el contexto dado y genera el PDF (síncrono, CPU-bound).
+        
+        Returns:
+            bytes: PDF generado
+        """
+        # Usar derivados de tamaño reporte en lugar de las fotos completas
+        for evidencia in context_data.get('evidencias') or []:
+            if evidencia.get('foto_url'):
+                evidencia['foto_url'] = derivado_reporte(evidencia['foto_url'])
+        
+        template = self.jinja_env.get_template(TEMPLATE_NAME)
+        html_content = template.render(**context_data)
+        return self._generate_pdf_from_html(html_content)
+    
     def _convertir_a_ruta_local(self, foto_url):
         """
         Convierte la foto_url a una ruta de archivo local absoluta para xhtml2pdf.
@@ -159,7 +304,7 @@ class PDFGenerator:
                         'hora': evidencia.hora.strftime('%H:%M:%S') if evidencia.hora else 'N/A',
                         'descripcion': evidencia.descripcion or '',
                         'foto_url': self._convertir_a_ruta_local(evidencia.foto_url),
-                        'coordenadas': evidencia.coordenadas if hasattr(evidencia, 'coordenadas') else None
+                        'coordenadas': getattr(evidencia, 'coordenadas', None)
                     }
                     evidencias_data.append(evidencia_dict)
             
@@ -191,8 +336,8 @@ class PDFGenerator:
             # Verificar si existe mapa generado para este análisis
             mapa_resultados_path = None
             if analisis and hasattr(analisis, 'id_analisis') and denuncia and hasattr(denuncia, 'id_denuncia'):
-                # Nuevo path: fotos/denuncia_{id_denuncia}/mapa_analisis_{id_analisis}.png
-                mapa_path = Path(FOTOS_DIR) / f"denuncia_{denuncia.id_denuncia}" / f"mapa_analisis_{analisis.id_analisis}.png"
+                # Nuevo path: fotos/denuncia_{id_denuncia}/mapa_analisis_{id_analisis}.png (o .jpg)
+                mapa_path = ruta_mapa_analisis(denuncia.id_denuncia, analisis.id_analisis)
                 if mapa_path.exists():
                     mapa_resultados_path = str(mapa_path.resolve())
                     logger.debug(f"✅ Mapa encontrado para análisis {analisis.id_analisis}: {mapa_resultados_path}")
@@ -204,15 +349,15 @@ class PDFGenerator:
                         mapa_resultados_path = str(mapa_path_old.resolve())
                         logger.info(f"⚠️ Usando mapa en ubicación antigua: {mapa_resultados_path}")
             
-            # Preparar contexto completo
+            # Preparar contexto completo (datos planos para poder enviarlo al pool)
             context = {
-                'analisis': analisis,
-                'denuncia': denuncia,
+                'analisis': _a_dict(analisis, ('id_analisis', 'id_denuncia', 'fecha_analisis', 'distancia_buffer', 'metodo', 'observaciones')),
+                'denuncia': _a_dict(denuncia, ('id_denuncia', 'lugar', 'fecha_inspeccion', 'fecha_ingreso', 'observaciones')),
                 'evidencias': evidencias_data,
                 'resultados': resultados_data,
                 'concesiones': concesiones_data,
-                'usuario': usuario,
-                'estado': estado,
+                'usuario': _a_dict(usuario, ('id_usuario', 'nombre', 'email')),
+                'estado': _a_dict(estado, ('id_estado', 'estado')),
                 'fecha_generacion': datetime.now(),
                 'mapa_resultados_path': mapa_resultados_path,
                 # Filtros personalizados para Jinja2
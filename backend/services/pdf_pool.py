@@ -0,0 +1,248 @@
+"""
+Pool de procesos para renderizar PDFs con xhtml2pdf fuera del event loop.
+
+pisa.pisaDocument es CPU-bound y bloquea varios segundos por reporte. Cada
+worker arranca con el template Jinja2 ya compilado (bytecode cache en disco) y
+con reportlab/fuentes inicializados, y recibe solo el contexto del template
+(datos planos, serializables con pickle).
+
+Los reportes con muchas evidencias se renderizan por partes (render_partes):
+cada worker arma solo un lote, así la memoria de pisa queda acotada por el
+tamaño del lote y no por el total de evidencias.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from config import PDF_POOL_WORKERS, PDF_POOL_MAX_PENDING, PDF_RENDER_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class PDFPoolOcupado(Exception):
+    """Se alcanzó el máximo de renders pendientes."""
+
+
+# Estado del proceso worker
+_worker_generator = None
+
+
+def _inicializar_worker(cola_pids=None):
+    """
+    Prepara el worker: template precompilado y fuentes cargadas.
+
+    Primero informa su PID por `cola_pids`, para que el padre pueda terminarlo
+    si un render se cuelga.
+    """
+    global _worker_generator
+    if cola_pids is not None:
+        cola_pids.put(os.getpid())
+    from services.pdf_generator import PDFGenerator
+
+    _worker_generator = PDFGenerator()
+    _worker_generator.precompilar_template()
+    try:
+        # Un render mínimo carga reportlab, métricas de fuentes y el parser CSS
+        _worker_generator.generate_simple_test_pdf()
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar el worker de PDF: {e}")
+
+
+def _renderizar_en_worker(context_data: Dict[str, Any]) -> bytes:
+    global _worker_generator
+    if _worker_generator is None:
+        _inicializar_worker()
+    return _worker_generator.render_pdf(context_data)
+
+
+class PDFRenderPool:
+    """
+    Ejecuta renders de PDF en un ProcessPoolExecutor con cola acotada y timeout.
+
+    - max_pending limita renders en curso + en espera; por sobre eso se rechaza
+      con PDFPoolOcupado en vez de encolar sin límite.
+    - Un render que supera el timeout se corta terminando los workers del pool
+      (que se recrea); los renders que compartían ese pool se reintentan una vez.
+    - Con workers=0 se renderiza en un hilo del proceso actual (sin pool); ahí
+      el timeout solo deja de esperar el resultado.
+    """
+
+    def __init__(self, workers: int, max_pending: int, timeout: float):
+        self.workers = workers
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        # Executors terminados a propósito por timeout (sus otros renders se reintentan)
+        self._terminados = weakref.WeakSet()
+        # Por executor: cola donde cada worker informa su PID al arrancar
+        self._colas_pids = weakref.WeakKeyDictionary()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                contexto = multiprocessing.get_context("spawn")
+                cola_pids = contexto.SimpleQueue()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=contexto,
+                    initializer=_inicializar_worker,
+                    initargs=(cola_pids,),
+                )
+                self._colas_pids[self._executor] = cola_pids
+                logger.info(f"Pool de PDF iniciado con {self.workers} workers")
+            return self._executor
+
+    def _descartar_executor(self, executor: Optional[ProcessPoolExecutor] = None,
+                            terminar: bool = False) -> None:
+        """
+        Descarta el executor actual, o `executor` si sigue siendo el actual.
+
+        Con terminar=True además mata sus workers: shutdown() no detiene un
+        render en curso, y un render colgado ocuparía el worker indefinidamente.
+        """
+        with self._lock:
+            if executor is None:
+                executor = self._executor
+            if executor is not None and executor is self._executor:
+                self._executor = None
+        if executor is None:
+            return
+        if terminar:
+            self._terminados.add(executor)
+            self._terminar_workers(executor)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _terminar_workers(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Envía SIGTERM a los workers de `executor`.
+
+        Los PIDs salen de la cola que llena _inicializar_worker; ProcessPoolExecutor
+        no expone sus procesos (terminate_workers() recién en 3.14), así que
+        `_processes` se usa solo como respaldo para un worker que aún no alcanzó
+        a informar su PID.
+        """
+        pids = set()
+        cola_pids = self._colas_pids.pop(executor, None)
+        if cola_pids is not None:
+            while not cola_pids.empty():
+                pids.add(cola_pids.get())
+            cola_pids.close()
+
+        procesos = getattr(executor, "_processes", None)
+        if procesos is None:
+            logger.warning("ProcessPoolExecutor sin atributo _processes; se terminan solo los PIDs informados")
+        else:
+            pids.update(proceso.pid for proceso in list(procesos.values()) if proceso.pid)
+
+        if not pids:
+            logger.warning("No hay PIDs conocidos de workers de PDF; un render colgado seguirá en ejecución")
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            except OSError as e:
+                logger.warning(f"No se pudo terminar el worker de PDF {pid}: {e}")
+
+    def _reservar(self) -> None:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PDFPoolOcupado(f"Hay {self._pending} PDFs en proceso, intente nuevamente")
+            self._pending += 1
+
+    def _liberar(self) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def _ejecutar(self, context_data: Dict[str, Any], reintento: bool = False) -> bytes:
+        if self.workers <= 0:
+            from services.pdf_generator import PDFGenerator
+            return await asyncio.wait_for(
+                asyncio.to_thread(PDFGenerator().render_pdf, context_data), timeout=self.timeout
+            )
+
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        future = loop.run_in_executor(executor, _renderizar_en_worker, context_data)
+        try:
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Render de PDF superó {self.timeout}s; se terminan los workers del pool")
+            self._descartar_executor(executor, terminar=True)
+            raise
+        except BrokenProcessPool:
+            if executor in self._terminados and not reintento:
+                # Worker terminado por el timeout de otro render: reintentar en el pool nuevo
+                return await self._ejecutar(context_data, reintento=True)
+            logger.error("El pool de PDF se rompió (worker terminado); se recreará")
+            self._descartar_executor(executor)
+            raise
+
+    async def render(self, context_data: Dict[str, Any]) -> bytes:
+        """
+        Renderiza el contexto del template a PDF sin bloquear el event loop.
+
+        Raises:
+            PDFPoolOcupado: si la cola está llena
+            asyncio.TimeoutError: si el render supera el timeout
+        """
+        self._reservar()
+        try:
+            return await self._ejecutar(context_data)
+        finally:
+            self._liberar()
+
+    async def render_partes(self, contextos: List[Dict[str, Any]], destino: Path) -> None:
+        """
+        Renderiza un reporte por partes y las concatena en `destino`.
+
+        Ocupa un solo cupo de la cola. Las partes se renderizan con a lo más
+        `workers` en paralelo y cada una se vuelca a disco apenas termina, de modo
+        que el proceso padre no retiene el documento completo en memoria.
+        El timeout se aplica a cada parte.
+
+        Raises:
+            PDFPoolOcupado: si la cola está llena
+            asyncio.TimeoutError: si el render de una parte supera el timeout
+        """
+        from services.pdf_generator import concatenar_pdfs
+
+        self._reservar()
+        try:
+            with tempfile.TemporaryDirectory(dir=destino.parent, suffix=".tmp") as tmp_dir:
+                semaforo = asyncio.Semaphore(max(1, self.workers))
+
+                async def _parte(indice: int, context_data: Dict[str, Any]) -> Path:
+                    async with semaforo:
+                        pdf_bytes = await self._ejecutar(context_data)
+                    ruta = Path(tmp_dir) / f"parte_{indice:05d}.pdf"
+                    await asyncio.to_thread(ruta.write_bytes, pdf_bytes)
+                    return ruta
+
+                tareas = [asyncio.create_task(_parte(i, c)) for i, c in enumerate(contextos)]
+                try:
+                    rutas = await asyncio.gather(*tareas)
+                except BaseException:
+                    for tarea in tareas:
+                        tarea.cancel()
+                    await asyncio.gather(*tareas, return_exceptions=True)
+                    raise
+                await asyncio.to_thread(concatenar_pdfs, rutas, destino)
+        finally:
+            self._liberar()
+
+    def shutdown(self) -> None:
+        self._descartar_executor()
+
+
+pdf_render_pool = PDFRenderPool(PDF_POOL_WORKERS, PDF_POOL_MAX_PENDING, PDF_RENDER_TIMEOUT)
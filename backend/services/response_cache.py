@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+from config import DENUNCIA_DETALLE_CACHE_TTL, DENUNCIA_DETALLE_CACHE_MAX
+
+
+class TTLCache:
+    """
+    Cache en memoria con expiración (TTL) y tope de entradas (LRU).
+
+    Es por proceso: con varios workers, una escritura solo invalida la copia del
+    worker que la atendió y las demás expiran por TTL, por eso el TTL debe ser corto.
+    Con ttl_seconds <= 0 la cache queda deshabilitada.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 256):
+        self.ttl = float(ttl_seconds)
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expira, valor = item
+            if expira < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return valor
+
+    def set(self, key: Hashable, valor: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, valor)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+# Respuestas de /denuncias/{id}/detalles, por id_denuncia
+detalle_denuncia_cache = TTLCache(DENUNCIA_DETALLE_CACHE_TTL, DENUNCIA_DETALLE_CACHE_MAX)
+
+
+def invalidar_denuncia(id_denuncia: int) -> None:
+    """Descarta las respuestas cacheadas de una denuncia tras una escritura."""
+    detalle_denuncia_cache.invalidate(id_denuncia)
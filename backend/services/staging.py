@@ -0,0 +1,301 @@
+"""
+Recepción de subidas multipart en streaming hacia un área de staging en disco.
+
+El cuerpo de la solicitud se lee por bloques (request.stream()) y pasa por el
+parser incremental de python-multipart: cada archivo se escribe directo a su
+archivo de staging mientras se calcula su sha256 y se valida su firma (magic
+bytes) con el primer bloque. Los límites de tamaño se aplican durante el
+stream, así una subida excesiva se corta sin terminar de recibirla y la
+memoria del worker no depende del tamaño de los archivos.
+
+El procesamiento posterior (fotos, GPX) lee desde los archivos en staging; la
+ruta que recibe la subida los elimina con FormularioEnStaging.limpiar().
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from fastapi import HTTPException, Request
+from config import UPLOAD_STAGING_DIR
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+# Bytes iniciales de cada archivo usados para validar su firma
+BYTES_FIRMA = 16
+
+# Tope de cada campo de texto del formulario
+MAX_CAMPO_BYTES = 256 * 1024
+
+FIRMAS_IMAGEN = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")
+
+
+def es_imagen(cabecera: bytes) -> bool:
+    """JPEG o PNG según los magic bytes."""
+    return cabecera.startswith(FIRMAS_IMAGEN)
+
+
+def es_xml(cabecera: bytes) -> bool:
+    """Documento XML (GPX): primer carácter no blanco '<', con o sin BOM UTF-8."""
+    return cabecera.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<")
+
+
+@dataclass
+class LimitesSubida:
+    """Límites de una ruta de subida (bytes)."""
+    max_archivo: int
+    max_total: int
+    max_archivos: int
+    validar_firma: Callable[[bytes], bool]
+
+
+@dataclass
+class ArchivoEnStaging:
+    """Archivo recibido: ya está completo en `path`, con su tamaño y sha256."""
+    campo: str
+    nombre: str
+    content_type: Optional[str]
+    path: Optional[Path] = None
+    tamano: int = 0
+    sha256: str = ""
+    firma_valida: bool = False
+
+
+@dataclass
+class FormularioEnStaging:
+    campos: Dict[str, List[str]] = field(default_factory=dict)
+    archivos: List[ArchivoEnStaging] = field(default_factory=list)
+
+    def archivos_de(self, campo: str) -> List[ArchivoEnStaging]:
+        return [a for a in self.archivos if a.campo == campo]
+
+    def campo(self, nombre: str) -> Optional[str]:
+        valores = self.campos.get(nombre)
+        return valores[0] if valores else None
+
+    def limpiar(self) -> None:
+        """Elimina los archivos de staging."""
+        for archivo in self.archivos:
+            if archivo.path is not None:
+                try:
+                    os.unlink(archivo.path)
+                except OSError:
+                    pass
+
+
+class _ReceptorMultipart:
+    """Callbacks de MultipartParser: escribe cada parte de archivo a staging."""
+
+    def __init__(self, limites: LimitesSubida, directorio: Path):
+        self.limites = limites
+        self.directorio = directorio
+        self.formulario = FormularioEnStaging()
+        self.total = 0
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+        self._archivo: Optional[ArchivoEnStaging] = None
+        self._salida = None
+        self._sha256 = None
+        self._cabecera = b""
+        self._nombre_campo = ""
+        self._texto: List[bytes] = []
+        self._texto_bytes = 0
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._archivo = None
+        self._texto = []
+        self._texto_bytes = 0
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, opciones = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._nombre_campo = opciones.get(b"name", b"").decode("utf-8", "replace")
+        nombre_archivo = opciones.get(b"filename")
+        if nombre_archivo is None:
+            return
+
+        if len(self.formulario.archivos) >= self.limites.max_archivos:
+            raise HTTPException(status_code=413, detail=f"Máximo {self.limites.max_archivos} archivos por solicitud")
+        content_type = self._headers.get(b"content-type")
+        self._archivo = ArchivoEnStaging(
+            campo=self._nombre_campo,
+            nombre=os.path.basename(nombre_archivo.decode("utf-8", "replace").replace("\\", "/")),
+            content_type=content_type.decode("latin-1") if content_type else None,
+        )
+        self.formulario.archivos.append(self._archivo)
+        self._sha256 = hashlib.sha256()
+        self._cabecera = b""
+        fd, path = tempfile.mkstemp(dir=self.directorio, suffix=".staging")
+        self._archivo.path = Path(path)
+        self._salida = os.fdopen(fd, "wb")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        n = end - start
+        self.total += n
+        if self.total > self.limites.max_total:
+            raise HTTPException(status_code=413, detail=f"La solicitud supera el máximo de {self.limites.max_total} bytes")
+
+        if self._archivo is None:
+            self._texto_bytes += n
+            if self._texto_bytes > MAX_CAMPO_BYTES:
+                raise HTTPException(status_code=413, detail=f"El campo '{self._nombre_campo}' es demasiado grande")
+            self._texto.append(data[start:end])
+            return
+
+        archivo = self._archivo
+        archivo.tamano += n
+        if archivo.tamano > self.limites.max_archivo:
+            raise HTTPException(
+                status_code=413,
+                detail=f"El archivo {archivo.nombre} supera el máximo de {self.limites.max_archivo} bytes"
+            )
+        if self._salida is None:
+            return  # firma inválida: el resto de la parte se descarta
+
+        bloque = data[start:end]
+        if len(self._cabecera) < BYTES_FIRMA:
+            self._cabecera += bloque[:BYTES_FIRMA - len(self._cabecera)]
+            if len(self._cabecera) >= BYTES_FIRMA and not self._validar_cabecera():
+                return
+        self._sha256.update(bloque)
+        # Escritura bloqueante pero a page cache, del tamaño de un bloque del stream
+        self._salida.write(bloque)
+
+    def _validar_cabecera(self) -> bool:
+        self._archivo.firma_valida = self.limites.validar_firma(self._cabecera)
+        if not self._archivo.firma_valida:
+            logger.info(f"Subida descartada por firma inválida: {self._archivo.nombre}")
+            self._descartar_archivo()
+        return self._archivo.firma_valida
+
+    def _descartar_archivo(self):
+        self._salida.close()
+        self._salida = None
+        try:
+            os.unlink(self._archivo.path)
+        except OSError:
+            pass
+        self._archivo.path = None
+
+    def on_part_end(self):
+        if self._archivo is None:
+            valor = b"".join(self._texto).decode("utf-8", "replace")
+            self.formulario.campos.setdefault(self._nombre_campo, []).append(valor)
+            return
+        if self._salida is not None:
+            # Archivos más cortos que BYTES_FIRMA
+            if len(self._cabecera) < BYTES_FIRMA and not self._validar_cabecera():
+                self._archivo = None
+                return
+            self._salida.close()
+            self._salida = None
+            self._archivo.sha256 = self._sha256.hexdigest()
+        self._archivo = None
+
+    def cerrar(self):
+        """Cierra un archivo que haya quedado abierto (stream cortado)."""
+        if self._salida is not None:
+            self._salida.close()
+            self._salida = None
+
+
+async def recibir_formulario(request: Request, limites: LimitesSubida,
+                             directorio: str = UPLOAD_STAGING_DIR) -> FormularioEnStaging:
+    """
+    Recibe un cuerpo multipart/form-data en streaming hacia el staging.
+
+    Raises:
+        HTTPException 413: si se supera un límite (los archivos ya recibidos se eliminan)
+        HTTPException 400: si el cuerpo no es multipart válido
+    """
+    content_type, opciones = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in opciones:
+        raise HTTPException(status_code=400, detail="Se esperaba un cuerpo multipart/form-data")
+    try:
+        declarado = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        declarado = 0
+    if declarado > limites.max_total:
+        raise HTTPException(status_code=413, detail=f"La solicitud supera el máximo de {limites.max_total} bytes")
+
+    staging = Path(directorio)
+    staging.mkdir(parents=True, exist_ok=True)
+    receptor = _ReceptorMultipart(limites, staging)
+    parser = MultipartParser(opciones[b"boundary"], receptor.callbacks())
+    try:
+        async for bloque in request.stream():
+            parser.write(bloque)
+        parser.finalize()
+    except HTTPException:
+        receptor.cerrar()
+        receptor.formulario.limpiar()
+        raise
+    except Exception as e:
+        receptor.cerrar()
+        receptor.formulario.limpiar()
+        logger.warning(f"Cuerpo multipart inválido o interrumpido: {e}")
+        raise HTTPException(status_code=400, detail="No se pudo leer el formulario multipart")
+    return receptor.formulario
+
+
+def parametros_multipart(campos_texto: Dict[str, str], campos_archivo: Dict[str, bool]) -> dict:
+    """
+    `openapi_extra` para documentar en Swagger un formulario leído con recibir_formulario.
+
+    Args:
+        campos_texto: nombre -> tipo JSON Schema ('string', 'integer', ...)
+        campos_archivo: nombre -> True si admite varios archivos
+    """
+    propiedades: Dict[str, dict] = {nombre: {"type": tipo} for nombre, tipo in campos_texto.items()}
+    for nombre, multiple in campos_archivo.items():
+        binario = {"type": "string", "format": "binary"}
+        propiedades[nombre] = {"type": "array", "items": binario} if multiple else binario
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"multipart/form-data": {"schema": {
+                "type": "object",
+                "properties": propiedades,
+                "required": list(propiedades),
+            }}},
+        }
+    }
+
+
+def leer_entero(formulario: FormularioEnStaging, nombre: str) -> int:
+    """Campo entero obligatorio del formulario (400 si falta o no es entero)."""
+    valor = formulario.campo(nombre)
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"El campo '{nombre}' debe ser un entero")
@@ -0,0 +1,99 @@
+"""
+Streaming de archivos que se escriben de forma síncrona (zipfile) hacia una
+respuesta async.
+
+El escritor corre en un hilo propio (no en el executor por defecto de asyncio,
+que comparten asyncio.to_thread y las consultas a la BD) y entrega sus bloques
+al consumidor async por una asyncio.Queue con loop.call_soon_threadsafe. Un
+semáforo limita los bloques en vuelo: si el cliente lee lento el escritor
+espera, y si el consumidor deja de iterar el escritor se detiene. Ningún hilo
+queda bloqueado esperando del lado del consumidor.
+"""
+import asyncio
+import io
+import logging
+import threading
+from typing import AsyncIterator, BinaryIO, Callable
+from config import KMZ_STREAM_CHUNK_BYTES, KMZ_STREAM_MAX_CHUNKS
+
+logger = logging.getLogger(__name__)
+
+_FIN_STREAM = object()
+
+
+class _ColaSalida(io.RawIOBase):
+    """Stream de solo escritura (no seekable) que entrega cada bloque con `entregar`."""
+
+    def __init__(self, entregar: Callable[[object], bool]):
+        self.entregar = entregar
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if not self.entregar(bytes(b)):
+            raise BrokenPipeError("El cliente dejó de leer el stream")
+        return len(b)
+
+
+def _marcar_terminado(futuro: asyncio.Future) -> None:
+    if not futuro.done():
+        futuro.set_result(None)
+
+
+async def stream_desde_hilo(
+    escribir: Callable[[BinaryIO], None],
+    chunk_bytes: int = KMZ_STREAM_CHUNK_BYTES,
+    max_chunks: int = KMZ_STREAM_MAX_CHUNKS,
+) -> AsyncIterator[bytes]:
+    """
+    Ejecuta `escribir(stream)` en un hilo dedicado y entrega lo escrito en bloques.
+
+    Yields:
+        bytes: bloques de ~chunk_bytes
+
+    Raises:
+        La excepción del escritor, si falla antes de terminar.
+    """
+    loop = asyncio.get_running_loop()
+    cola: asyncio.Queue = asyncio.Queue()
+    espacios = threading.Semaphore(max(1, max_chunks))
+    cancelado = threading.Event()
+    terminado = loop.create_future()
+
+    def entregar(item) -> bool:
+        """Encola esperando espacio, salvo que el consumidor haya cancelado."""
+        while not espacios.acquire(timeout=0.2):
+            if cancelado.is_set():
+                return False
+        if cancelado.is_set():
+            return False
+        loop.call_soon_threadsafe(cola.put_nowait, item)
+        return True
+
+    def producir():
+        try:
+            with io.BufferedWriter(_ColaSalida(entregar), buffer_size=chunk_bytes) as salida:
+                escribir(salida)
+            entregar(_FIN_STREAM)
+        except BaseException as e:
+            entregar(e)
+        finally:
+            try:
+                loop.call_soon_threadsafe(_marcar_terminado, terminado)
+            except RuntimeError:
+                pass  # event loop ya cerrado
+
+    threading.Thread(target=producir, name="stream-desde-hilo", daemon=True).start()
+    try:
+        while True:
+            bloque = await cola.get()
+            espacios.release()
+            if bloque is _FIN_STREAM:
+                break
+            if isinstance(bloque, BaseException):
+                raise bloque
+            yield bloque
+    finally:
+        cancelado.set()
+        await terminado
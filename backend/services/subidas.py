@@ -0,0 +1,253 @@
+"""
+Sesiones de subida reanudable (fotos y GPX) para conexiones inestables.
+
+Protocolo:
+    1. Crear sesión con nombre, tamaño total y metadatos -> id_subida
+    2. Enviar bytes con PUT y Content-Range: bytes <inicio>-<fin>/<total>;
+       el inicio debe coincidir con el offset recibido hasta ahora
+    3. Si la conexión se corta, consultar el offset y reanudar desde ahí
+    4. Finalizar: el archivo completo se procesa igual que una subida multipart
+
+El estado vive en disco dentro del área de staging (sesiones/<id>.json y
+<id>.part), así cualquier worker puede continuar una sesión. El offset es el
+tamaño del .part: lo que alcanzó a llegar antes de un corte queda recibido.
+
+Cada PUT toma un flock exclusivo (no bloqueante) sobre el .part: si el PUT
+anterior sigue recibiendo en el servidor cuando el cliente reanuda, el nuevo
+recibe 409 en vez de intercalar bytes con él. Los bytes se escriben con
+os.pwrite en su posición, nunca más allá del tamaño declarado.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+from fastapi import HTTPException
+from config import UPLOAD_STAGING_DIR, UPLOAD_SESION_TTL_HORAS
+from services.staging import ArchivoEnStaging, BYTES_FIRMA, LimitesSubida
+
+logger = logging.getLogger(__name__)
+
+DIRECTORIO_SESIONES = Path(UPLOAD_STAGING_DIR) / "sesiones"
+
+ID_SUBIDA = re.compile(r"^[0-9a-f]{32}$")
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+@dataclass
+class SesionSubida:
+    id_subida: str
+    tipo: str  # 'foto' o 'gpx'
+    id_denuncia: int
+    nombre: str
+    tamano: int
+    content_type: Optional[str] = None
+    descripcion: Optional[str] = None
+    utc_offset: Optional[int] = None
+    creada: float = 0.0
+
+    @property
+    def path_json(self) -> Path:
+        return DIRECTORIO_SESIONES / f"{self.id_subida}.json"
+
+    @property
+    def path_datos(self) -> Path:
+        return DIRECTORIO_SESIONES / f"{self.id_subida}.part"
+
+    def offset(self) -> int:
+        """Bytes recibidos hasta ahora."""
+        try:
+            return self.path_datos.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+
+def _guardar(sesion: SesionSubida) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=DIRECTORIO_SESIONES, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+        json.dump(asdict(sesion), tmp, ensure_ascii=False)
+    os.replace(tmp_path, sesion.path_json)
+
+
+def purgar_vencidas() -> int:
+    """Elimina sesiones más antiguas que UPLOAD_SESION_TTL_HORAS."""
+    limite = time.time() - UPLOAD_SESION_TTL_HORAS * 3600
+    eliminadas = 0
+    try:
+        entradas = list(os.scandir(DIRECTORIO_SESIONES))
+    except FileNotFoundError:
+        return 0
+    for entry in entradas:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < limite:
+                os.unlink(entry.path)
+                eliminadas += entry.name.endswith(".json")
+        except OSError:
+            pass
+    if eliminadas:
+        logger.info(f"Sesiones de subida vencidas eliminadas: {eliminadas}")
+    return eliminadas
+
+
+def crear_sesion(tipo: str, id_denuncia: int, nombre: str, tamano: int, limites: LimitesSubida,
+                 content_type: Optional[str] = None, descripcion: Optional[str] = None,
+                 utc_offset: Optional[int] = None) -> SesionSubida:
+    """
+    Crea una sesión vacía.
+
+    Raises:
+        HTTPException 413: si el tamaño declarado supera el límite del tipo
+    """
+    if tamano > limites.max_archivo:
+        raise HTTPException(status_code=413, detail=f"El archivo supera el máximo de {limites.max_archivo} bytes")
+    DIRECTORIO_SESIONES.mkdir(parents=True, exist_ok=True)
+    purgar_vencidas()
+
+    sesion = SesionSubida(
+        id_subida=secrets.token_hex(16),
+        tipo=tipo,
+        id_denuncia=id_denuncia,
+        nombre=os.path.basename(nombre.replace("\\", "/")),
+        tamano=tamano,
+        content_type=content_type,
+        descripcion=descripcion,
+        utc_offset=utc_offset,
+        creada=time.time(),
+    )
+    sesion.path_datos.touch()
+    _guardar(sesion)
+    return sesion
+
+
+def leer_sesion(id_subida: str) -> SesionSubida:
+    """Raises: HTTPException 404 si la sesión no existe o venció."""
+    if not ID_SUBIDA.match(id_subida):
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada")
+    try:
+        with open(DIRECTORIO_SESIONES / f"{id_subida}.json", encoding="utf-8") as f:
+            return SesionSubida(**json.load(f))
+    except (OSError, ValueError, TypeError):
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada")
+
+
+def eliminar_sesion(sesion: SesionSubida) -> None:
+    for path in (sesion.path_datos, sesion.path_json):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def parsear_content_range(valor: Optional[str], sesion: SesionSubida) -> Tuple[int, int]:
+    """
+    Retorna (inicio, fin inclusive) de un Content-Range 'bytes a-b/total'.
+
+    Raises:
+        HTTPException 400: si falta, está mal formado o el total no coincide con la sesión
+    """
+    m = CONTENT_RANGE.match((valor or "").strip())
+    if not m:
+        raise HTTPException(status_code=400, detail="Se requiere Content-Range: bytes <inicio>-<fin>/<total>")
+    inicio, fin, total = (int(g) for g in m.groups())
+    if total != sesion.tamano or fin < inicio or fin >= total:
+        raise HTTPException(status_code=400, detail=f"Content-Range inválido para un archivo de {sesion.tamano} bytes")
+    return inicio, fin
+
+
+async def escribir_rango(sesion: SesionSubida, inicio: int, fin: int, cuerpo: AsyncIterator[bytes],
+                         limites: LimitesSubida) -> int:
+    """
+    Escribe en el .part los bytes del cuerpo, que deben empezar en el offset actual.
+    Si la conexión se corta a mitad del rango, lo recibido queda guardado.
+
+    Returns:
+        int: nuevo offset
+
+    Raises:
+        HTTPException 404: si la sesión se eliminó
+        HTTPException 409: si otro PUT de la sesión sigue en curso, o si `inicio`
+            no coincide con el offset (el cliente debe consultarlo)
+        HTTPException 413: si el cuerpo excede el rango declarado
+        HTTPException 415: si los primeros bytes no tienen la firma esperada
+    """
+    try:
+        # Sin O_APPEND: con él, pwrite ignora la posición en Linux
+        fd = os.open(sesion.path_datos, os.O_WRONLY)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada")
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+            raise HTTPException(status_code=409, detail={
+                "mensaje": "Otra transferencia de esta subida sigue en curso", "offset": sesion.offset()
+            })
+
+        # Con el lock tomado, el offset no cambia hasta terminar este PUT
+        offset = sesion.offset()
+        if inicio != offset:
+            raise HTTPException(status_code=409, detail={"mensaje": "El rango no comienza en el offset recibido", "offset": offset})
+
+        esperado = fin - inicio + 1
+        posicion = inicio
+        cabecera = b""
+        async for bloque in cuerpo:
+            if not bloque:
+                continue
+            if posicion + len(bloque) > inicio + esperado or posicion + len(bloque) > sesion.tamano:
+                raise HTTPException(status_code=413, detail="El cuerpo excede el Content-Range declarado")
+            if inicio == 0 and len(cabecera) < BYTES_FIRMA:
+                cabecera += bloque[:BYTES_FIRMA - len(cabecera)]
+                if len(cabecera) >= min(BYTES_FIRMA, sesion.tamano) and not limites.validar_firma(cabecera):
+                    eliminar_sesion(sesion)
+                    raise HTTPException(status_code=415, detail="El contenido no corresponde al tipo de archivo esperado")
+            # Cada bloque queda en disco aunque la conexión se corte después
+            escrito = 0
+            while escrito < len(bloque):
+                escrito += os.pwrite(fd, bloque[escrito:], posicion + escrito)
+            posicion += len(bloque)
+    finally:
+        os.close(fd)
+    # Sesión activa: no expira mientras siga recibiendo rangos
+    try:
+        os.utime(sesion.path_json)
+    except FileNotFoundError:
+        pass
+    return posicion
+
+
+def archivo_completo(sesion: SesionSubida, campo: str, limites: LimitesSubida) -> ArchivoEnStaging:
+    """
+    ArchivoEnStaging de una sesión completa (sha256 y firma verificados leyendo el .part).
+
+    Raises:
+        HTTPException 409: si aún faltan bytes
+    """
+    offset = sesion.offset()
+    if offset != sesion.tamano:
+        raise HTTPException(status_code=409, detail={"mensaje": "La subida está incompleta", "offset": offset})
+    sha256 = hashlib.sha256()
+    with open(sesion.path_datos, "rb") as f:
+        firma_valida = limites.validar_firma(f.read(BYTES_FIRMA))
+        f.seek(0)
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(bloque)
+    return ArchivoEnStaging(
+        campo=campo,
+        nombre=sesion.nombre,
+        content_type=sesion.content_type,
+        path=sesion.path_datos,
+        tamano=offset,
+        sha256=sha256.hexdigest(),
+        firma_valida=firma_valida,
+    )
@@ -0,0 +1,212 @@
+"""
+Cache local de tiles de mapa para MapGenerator.
+
+Reemplaza el descargador de py-staticmaps por uno con cache en disco compartida
+entre workers (`<dir>/<proveedor>/<z>/<x>/<y>.png`), expulsión LRU por tamaño
+total y modo offline (solo tiles ya cacheados; los faltantes quedan en blanco
+en vez de bloquear el render esperando la red).
+
+Sembrado de la cache para la costa de Los Lagos:
+
+    python -m services.tile_cache --zooms 8-13
+    python -m services.tile_cache --zooms 14-15 --bbox=-73.3,-41.9,-72.6,-41.4
+
+Para sembrar zooms altos en áreas grandes use un servidor de tiles propio
+(MAP_TILE_URL): la política de uso de tile.openstreetmap.org no permite
+descargas masivas.
+"""
+import logging
+import math
+import os
+import tempfile
+import threading
+import urllib.request
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+from config import (
+    MAP_TILE_URL, MAP_TILE_CACHE_DIR, MAP_TILE_CACHE_MAX_BYTES, MAP_TILE_OFFLINE, MAP_TILE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    import staticmaps
+    STATICMAPS_AVAILABLE = True
+except ImportError:
+    STATICMAPS_AVAILABLE = False
+
+USER_AGENT = "PlayasLimpias/1.0"
+
+# Costa de la Región de Los Lagos (west, south, east, north)
+BBOX_LOS_LAGOS = (-75.0, -44.1, -71.5, -40.2)
+
+# Cada cuántas escrituras se recorre el directorio para aplicar el tope de tamaño
+EXPULSAR_CADA = 200
+
+
+def tile_provider():
+    """Proveedor de tiles configurado (MAP_TILE_URL con $z/$x/$y, u OSM por defecto)."""
+    if MAP_TILE_URL:
+        return staticmaps.TileProvider(
+            "local",
+            url_pattern=MAP_TILE_URL,
+            attribution="Maps & Data (C) OpenStreetMap.org contributors",
+            max_zoom=19,
+        )
+    return staticmaps.tile_provider_OSM
+
+
+class TileCacheDownloader:
+    """
+    Descargador de tiles compatible con `staticmaps.Context.set_tile_downloader`.
+
+    Un tile que no se puede obtener (offline, timeout, error HTTP) se retorna como
+    None: py-staticmaps lo omite y el mapa se renderiza igual.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, offline: bool = False, timeout: float = 10.0):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Una sola expulsión a la vez; el recorrido del directorio no bloquea a los lectores/escritores
+        self._expulsando = threading.Lock()
+        self._escrituras = 0
+
+    def _path(self, provider, zoom: int, x: int, y: int) -> Path:
+        nombre = "".join(c if c.isalnum() or c in "-_" else "_" for c in provider.name())
+        return self.directory / nombre / str(zoom) / str(x) / f"{y}.png"
+
+    def get(self, provider, cache_dir, zoom: int, x: int, y: int) -> Optional[bytes]:
+        """Firma de staticmaps.TileDownloader.get (cache_dir se ignora: se usa la cache propia)."""
+        if x < 0 or y < 0 or x >= 2 ** zoom or y >= 2 ** zoom:
+            return None
+        path = self._path(provider, zoom, x, y)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # marca de uso para la expulsión LRU
+            return data
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"No se pudo leer tile cacheado {path}: {e}")
+
+        if self.offline:
+            return None
+        url = provider.url(zoom, x, y)
+        if url is None:
+            return None
+        try:
+            request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+        except Exception as e:
+            logger.warning(f"No se pudo descargar tile {zoom}/{x}/{y}: {e}")
+            return None
+
+        self._guardar(path, data)
+        return data
+
+    def _guardar(self, path: Path, data: bytes) -> None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar tile en cache {path}: {e}")
+            return
+        with self._lock:
+            self._escrituras += 1
+            expulsar = self._escrituras % EXPULSAR_CADA == 0
+        if expulsar:
+            self.expulsar()
+
+    def expulsar(self) -> None:
+        """Elimina los tiles menos usados hasta quedar bajo max_bytes."""
+        if not self._expulsando.acquire(blocking=False):
+            return  # otra expulsión en curso
+        try:
+            entradas = []
+            total = 0
+            for raiz, _, archivos in os.walk(self.directory):
+                for archivo in archivos:
+                    if archivo.endswith(".tmp"):
+                        continue
+                    ruta = os.path.join(raiz, archivo)
+                    try:
+                        st = os.stat(ruta)
+                    except OSError:
+                        continue
+                    total += st.st_size
+                    entradas.append((st.st_mtime, st.st_size, ruta))
+
+            if total <= self.max_bytes:
+                return
+            entradas.sort()
+            eliminados = 0
+            for _, size, ruta in entradas:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(ruta)
+                    total -= size
+                    eliminados += 1
+                except OSError:
+                    pass
+            logger.info(f"Cache de tiles: {eliminados} tiles expulsados ({total} bytes en uso)")
+        finally:
+            self._expulsando.release()
+
+
+def tiles_en_bbox(bbox: Tuple[float, float, float, float], zoom: int) -> Iterator[Tuple[int, int]]:
+    """Tiles (x, y) en proyección Web Mercator que cubren el bbox (west, south, east, north)."""
+    def _xy(lon: float, lat: float) -> Tuple[int, int]:
+        n = 2 ** zoom
+        lat_rad = math.radians(max(min(lat, 85.0511), -85.0511))
+        x = int((lon + 180.0) / 360.0 * n)
+        y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    west, south, east, north = bbox
+    x0, y0 = _xy(west, north)
+    x1, y1 = _xy(east, south)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+tile_downloader = TileCacheDownloader(MAP_TILE_CACHE_DIR, MAP_TILE_CACHE_MAX_BYTES, MAP_TILE_OFFLINE, MAP_TILE_TIMEOUT)
+
+
+if __name__ == "__main__":
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+
+    parser = argparse.ArgumentParser(description="Siembra la cache local de tiles de mapa")
+    parser.add_argument("--zooms", default="8-13", help="rango de zooms, p.ej. 8-13")
+    parser.add_argument("--bbox", default=",".join(map(str, BBOX_LOS_LAGOS)),
+                        help="west,south,east,north (por defecto la costa de Los Lagos)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-tiles", type=int, default=50000, help="aborta si el sembrado supera este número de tiles")
+    args = parser.parse_args()
+
+    if not STATICMAPS_AVAILABLE:
+        raise SystemExit("py-staticmaps no está instalado")
+    logging.basicConfig(level=logging.INFO)
+
+    z0, _, z1 = args.zooms.partition("-")
+    zooms = range(int(z0), int(z1 or z0) + 1)
+    bbox = tuple(float(v) for v in args.bbox.split(","))
+    tiles = [(z, x, y) for z in zooms for x, y in tiles_en_bbox(bbox, z)]
+    if len(tiles) > args.max_tiles:
+        raise SystemExit(f"{len(tiles)} tiles superan --max-tiles={args.max_tiles}; acote el bbox o los zooms")
+
+    tile_downloader.offline = False
+    provider = tile_provider()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        obtenidos = sum(1 for data in pool.map(lambda t: tile_downloader.get(provider, None, *t), tiles) if data)
+    tile_downloader.expulsar()
+    print(f"Cache de tiles sembrada: {obtenidos}/{len(tiles)} tiles en {MAP_TILE_CACHE_DIR}")
@@ -0,0 +1,125 @@
+"""
+Pruebas de la cache de tiles (services.tile_cache) contra un servidor de tiles
+local levantado en un hilo (http.server), sin acceso a la red.
+
+    cd backend && python -m unittest tests.test_tile_cache
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from services.tile_cache import TileCacheDownloader
+
+TILE = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+
+class _ServidorTiles(BaseHTTPRequestHandler):
+    """Responde /<z>/<x>/<y>.png con un PNG fijo; /404/... con error."""
+
+    solicitudes = []
+
+    def do_GET(self):
+        _ServidorTiles.solicitudes.append(self.path)
+        if self.path.startswith("/404/"):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(TILE)))
+        self.end_headers()
+        self.wfile.write(TILE)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Proveedor:
+    """Lo que TileCacheDownloader usa de un staticmaps.TileProvider."""
+
+    def __init__(self, base_url: str, nombre: str = "local"):
+        self.base_url = base_url
+        self.nombre = nombre
+
+    def name(self):
+        return self.nombre
+
+    def url(self, zoom, x, y):
+        return f"{self.base_url}/{zoom}/{x}/{y}.png"
+
+
+class TileCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servidor = ThreadingHTTPServer(("127.0.0.1", 0), _ServidorTiles)
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.servidor.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directorio = self._tmp.name
+        self.proveedor = _Proveedor(self.base_url)
+        _ServidorTiles.solicitudes.clear()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_miss_descarga_y_guarda(self):
+        cache = TileCacheDownloader(self.directorio, 10 ** 6, timeout=5)
+        self.assertEqual(cache.get(self.proveedor, None, 10, 300, 600), TILE)
+        self.assertEqual(_ServidorTiles.solicitudes, ["/10/300/600.png"])
+        self.assertEqual((Path(self.directorio) / "local" / "10" / "300" / "600.png").read_bytes(), TILE)
+
+    def test_hit_no_consulta_el_servidor(self):
+        cache = TileCacheDownloader(self.directorio, 10 ** 6, timeout=5)
+        cache.get(self.proveedor, None, 10, 300, 600)
+        self.assertEqual(cache.get(self.proveedor, None, 10, 300, 600), TILE)
+        self.assertEqual(len(_ServidorTiles.solicitudes), 1)
+
+    def test_offline_sirve_solo_lo_cacheado(self):
+        TileCacheDownloader(self.directorio, 10 ** 6, timeout=5).get(self.proveedor, None, 10, 300, 600)
+        _ServidorTiles.solicitudes.clear()
+
+        offline = TileCacheDownloader(self.directorio, 10 ** 6, offline=True)
+        self.assertEqual(offline.get(self.proveedor, None, 10, 300, 600), TILE)
+        self.assertIsNone(offline.get(self.proveedor, None, 10, 301, 600))
+        self.assertEqual(_ServidorTiles.solicitudes, [])
+
+    def test_error_http_retorna_none_sin_cachear(self):
+        cache = TileCacheDownloader(self.directorio, 10 ** 6, timeout=5)
+        proveedor = _Proveedor(f"{self.base_url}/404")
+        self.assertIsNone(cache.get(proveedor, None, 10, 300, 600))
+        self.assertFalse(any(Path(self.directorio).rglob("*.png")))
+
+    def test_tile_fuera_de_rango(self):
+        cache = TileCacheDownloader(self.directorio, 10 ** 6, timeout=5)
+        self.assertIsNone(cache.get(self.proveedor, None, 2, 4, 0))
+        self.assertEqual(_ServidorTiles.solicitudes, [])
+
+    def test_expulsion_lru_por_tamano(self):
+        cache = TileCacheDownloader(self.directorio, 3 * len(TILE), timeout=5)
+        ahora = time.time()
+        rutas = []
+        for i in range(5):
+            cache.get(self.proveedor, None, 10, 300 + i, 600)
+            ruta = Path(self.directorio) / "local" / "10" / str(300 + i) / "600.png"
+            os.utime(ruta, (ahora - 100 + i, ahora - 100 + i))
+            rutas.append(ruta)
+        # Un acierto actualiza el uso: el tile más antiguo pasa a ser el más reciente
+        cache.get(self.proveedor, None, 10, 300, 600)
+
+        cache.expulsar()
+        self.assertEqual([r.exists() for r in rutas], [True, False, False, True, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -80,3 +80,25 @@ CREATE TABLE los_lagos (
     geom GEOMETRY(MultiPolygon, 4326),
     fid INTEGER
 );
+
+-- 9. Tracks GPS de la inspección (línea simplificada por segmento del GPX)
+CREATE TABLE tracks_denuncia (
+    id_track SERIAL PRIMARY KEY,
+    id_denuncia INTEGER REFERENCES denuncias(id_denuncia),
+    geom GEOMETRY(LineString, 4326) NOT NULL,
+    fecha_inicio TIMESTAMP,
+    fecha_fin TIMESTAMP,
+    puntos_originales INTEGER,
+    puntos_simplificados INTEGER
+);
+
+
+-- ========================
+-- Índices para paginación keyset y conteos por denuncia
+-- ========================
+CREATE INDEX IF NOT EXISTS idx_denuncias_fecha_ingreso_id ON denuncias ((COALESCE(fecha_ingreso, '-infinity'::timestamp)) DESC, id_denuncia DESC);
+CREATE INDEX IF NOT EXISTS idx_denuncias_usuario_fecha_ingreso_id ON denuncias (id_usuario, (COALESCE(fecha_ingreso, '-infinity'::timestamp)) DESC, id_denuncia DESC);
+CREATE INDEX IF NOT EXISTS idx_evidencias_denuncia ON evidencias (id_denuncia);
+CREATE INDEX IF NOT EXISTS idx_analisis_denuncia_denuncia ON analisis_denuncia (id_denuncia);
+CREATE INDEX IF NOT EXISTS idx_resultado_analisis_analisis ON resultado_analisis (id_analisis);
+CREATE INDEX IF NOT EXISTS idx_tracks_denuncia_denuncia ON tracks_denuncia (id_denuncia);
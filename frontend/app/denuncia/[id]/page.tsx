@@ -528,7 +528,7 @@ export default function DenunciaDetallePage({ params }: { params: Promise<{ id:
                       {evidencia.foto_url && (
                         <div className="w-full h-32">
                           <img
-                            src={`${process.env.NEXT_PUBLIC_API_URL}${evidencia.foto_url}`}
+                            src={`${process.env.NEXT_PUBLIC_API_URL}${evidencia.foto_url}?w=640&fmt=webp`}
                             alt="Evidencia"
                             className="object-cover w-full h-full rounded-t-lg cursor-pointer hover:opacity-80 transition-opacity"
                             onClick={() => setSelectedImage(evidencia.foto_url)}
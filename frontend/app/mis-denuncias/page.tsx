@@ -8,6 +8,7 @@ import { Button } from "@/components/ui/button"
 import { Badge } from "@/components/ui/badge"
 import { Loader2, AlertCircle } from "lucide-react"
 import { Alert, AlertDescription } from "@/components/ui/alert"
+import { fetchAllPages } from "@/lib/api-config"
 
 interface Denuncia {
   id_denuncia: number
@@ -52,17 +53,11 @@ export default function MisDenunciasPage() {
 
     try {
       // Cargar denuncias del usuario
-      const denunciasResponse = await fetch(`${process.env.NEXT_PUBLIC_API_URL}/denuncias/mis-denuncias`, {
+      const denunciasData = await fetchAllPages<Denuncia>(`${process.env.NEXT_PUBLIC_API_URL}/denuncias/mis-denuncias`, {
         headers: {
           Authorization: `Bearer ${token}`
         }
       })
-
-      if (!denunciasResponse.ok) {
-        throw new Error(`Error al cargar denuncias: ${denunciasResponse.statusText}`)
-      }
-
-      const denunciasData = await denunciasResponse.json()
       setDenuncias(denunciasData)
 
       // Cargar estados disponibles
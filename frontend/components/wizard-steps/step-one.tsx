@@ -13,6 +13,7 @@ import { CalendarIcon } from "lucide-react"
 import { format } from "date-fns"
 import { es } from "date-fns/locale"
 import { cn } from "@/lib/utils"
+import { fetchAllPages } from "@/lib/api-config"
 import type { InspectionData } from "@/components/inspection-wizard"
 import { useWizardAuth } from "@/lib/wizard-config"
 
@@ -64,7 +65,8 @@ export function StepOne({ data, updateData, setInspectionData, onNext }: StepOne
       try {
         // Cargar usuarios y estados en paralelo para mejor performance
         const [usuariosData, estadosData] = await Promise.all([
-          fetchData('/usuarios/'),
+          // Listado paginado por cursor: se traen todas las páginas
+          fetchAllPages(`${apiUrl}/usuarios/`, { headers: { Authorization: `Bearer ${token}` } }),
           fetchData('/estados_denuncia/')
         ])
         
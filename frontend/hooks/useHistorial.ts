@@ -2,6 +2,7 @@
 
 import { useState, useEffect } from 'react'
 import { useAuth } from './use-auth'
+import { fetchAllPages } from '@/lib/api-config'
 
 interface Denuncia {
   id_denuncia: number
@@ -45,18 +46,13 @@ export function useHistorial(): HistorialData {
         setLoading(true)
         setError(null)
 
-        const response = await fetch('http://localhost:8000/denuncias/historial', {
+        // El historial llega paginado: se recorren todas las páginas para estadísticas y CSV
+        const data = await fetchAllPages<Denuncia>('http://localhost:8000/denuncias/historial', {
           headers: {
             'Authorization': `Bearer ${token}`,
             'Content-Type': 'application/json',
           },
         })
-
-        if (!response.ok) {
-          throw new Error(`Error ${response.status}: ${response.statusText}`)
-        }
-
-        const data = await response.json()
         setDenuncias(data)
       } catch (err) {
         console.error('Error fetching historial:', err)
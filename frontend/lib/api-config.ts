@@ -23,4 +23,29 @@ export const getApiUrl = () => {
   return apiUrl || 'http://localhost:8000'
 }
 
-export const API_URL = getApiUrl()
\ No newline at end of file
+export const API_URL = getApiUrl()
+// Tamaño de página pedido al recorrer listados paginados (máximo del backend: PAGE_SIZE_MAX)
+const PAGE_SIZE = 500
+
+/**
+ * Obtiene un listado paginado completo siguiendo la cabecera X-Next-Cursor
+ * del backend (paginación keyset) hasta la última página.
+ */
+export async function fetchAllPages<T>(url: string, init?: RequestInit): Promise<T[]> {
+  const items: T[] = []
+  let cursor: string | null = null
+  do {
+    const pageUrl = new URL(url)
+    pageUrl.searchParams.set('limit', String(PAGE_SIZE))
+    if (cursor) {
+      pageUrl.searchParams.set('cursor', cursor)
+    }
+    const response = await fetch(pageUrl.toString(), init)
+    if (!response.ok) {
+      throw new Error(`Error ${response.status}: ${response.statusText}`)
+    }
+    items.push(...(await response.json()))
+    cursor = response.headers.get('X-Next-Cursor')
+  } while (cursor)
+  return items
+}